@@ -1,5 +1,8 @@
 import os
 import urllib.parse
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Optional
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import MetaData
@@ -66,13 +69,65 @@ AsyncSessionFactory = sessionmaker(
 )
 
 
+# --- Unit of Work ---
+
+# The session of the unit of work running in the current task, if any.
+_current_session: ContextVar[Optional[AsyncSession]] = ContextVar("db_unit_of_work_session", default=None)
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[AsyncSession]:
+    """
+    Groups the queries of one logical operation into a single session: one
+    pool checkout, one transaction and one commit when the block exits
+    (rolled back if it raises).
+
+    While the block runs, get_db_session()/get_db_connection() and
+    execute_query() reuse this session instead of opening and committing
+    their own, so existing `async for conn in get_db_connection()` code joins
+    the unit of work unchanged. Nested unit_of_work() blocks join the outer one.
+
+    AsyncSession is not safe for concurrent use, so do not hold a unit of
+    work across code that runs queries in parallel tasks (e.g. Runner.run,
+    whose tools may execute concurrently).
+    """
+    session = _current_session.get()
+    if session is not None:
+        yield session
+        return
+
+    async with AsyncSessionFactory() as session:
+        token = _current_session.set(session)
+        try:
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            _current_session.reset(token)
+
+
+def in_unit_of_work(session: Optional[AsyncSession] = None) -> bool:
+    """True if a unit of work is active (and, when given, owns `session`)."""
+    current = _current_session.get()
+    return current is not None and (session is None or current is session)
+
+
 # --- FastAPI Dependency ---
 
 async def get_db_session() -> AsyncSession:
     """
     FastAPI dependency that provides a database session per request.
     This ensures each request has a clean, isolated session from the pool.
+    Inside a unit_of_work() the ambient session is returned instead and is
+    committed by the unit of work.
     """
+    session = _current_session.get()
+    if session is not None:
+        yield session
+        return
+
     async with AsyncSessionFactory() as session:
         try:
             yield session
@@ -1,28 +1,29 @@
 import os
 import json
 from typing import Optional, List
-import uuid
 from dotenv import load_dotenv
-import notion_client
 from notion_client.errors import APIResponseError
-from agents import Agent, function_tool, handoff
+from agents import Agent, RunContextWrapper, function_tool, handoff
 
 from model.response_agent_input import ResponseAgentInput
-from openai import OpenAI
 import difflib
 
-from db import get_db_connection
+from db import get_db_connection, unit_of_work
 from utils.db_helper import execute_query
-from utils.whatsapp_utils import send_whatsapp_message
+from utils.id_generator import new_id
+from services.outbound_dispatcher import dispatch_whatsapp_message
+
+from services.notion_gateway import notion, retrieve_page
+from services.task_index import task_index
+from services.user_directory import get_users_by_notion_ids
+from utils.notion_projection import project_comment, project_list, to_tool_json
 
 from local_agents.notion_response_agent import notion_response_agent
+from local_agents.run_context import ChatRunContext, current_user_id, tasks_database_id
+from local_agents.user_tools import get_notion_user_id_from_name
 
 # --- SETUP ---
 load_dotenv()
-api_key = os.getenv("NOTION_API_KEY")
-if not api_key:
-    raise ValueError("FATAL: NOTION_API_KEY not found. Ensure it is set in your .env file.")
-notion = notion_client.Client(auth=api_key)
 
 def manage_response_agent_handoff(context, input: ResponseAgentInput):
     """
@@ -47,68 +48,16 @@ def _append_commented_by_signature(rich_text_list: list, commenter_notion_user_i
     return rich_text_list
 
 
-@function_tool
-async def get_notion_user_id_from_name(username: str) -> str:
-    """
-    Finds a user's Notion ID. Handles ambiguity by providing options and suggests corrections for misspellings.
-    """
-    # ... (connection logic remains the same)
-    try:
-        async for conn in get_db_connection():
-            # First, try the original query
-            users = await execute_query(
-                conn,
-                """
-                SELECT notion_user_id, username FROM Users WHERE username LIKE :id
-                """,
-                {"id": f"%{username}%"},
-                fetch_one=False
-            )
-
-            if users:
-                # --- EXISTING LOGIC - NO CHANGES NEEDED ---
-                if len(users) == 1:
-                    user = users[0]
-                    return json.dumps({"username": user["username"], "notion_user_id": user["notion_user_id"]})
-                else:
-                    found_names = [user['username'] for user in users]
-                    return json.dumps({
-                        "error": "Ambiguous Name",
-                        "message": "Multiple users found. Ask for clarification.",
-                        "options": found_names
-                    })
-            else:
-                # --- NEW FALLBACK LOGIC FOR MISSPELLINGS ---
-                # If no users were found, fetch all usernames to check for a close match.
-                all_users_records = await execute_query(conn, "SELECT username FROM Users", {}, fetch_one=False)
-                all_usernames = [record['username'] for record in all_users_records]
-                
-                # Find the best single match with a high similarity cutoff (e.g., 0.8)
-                close_matches = difflib.get_close_matches(username, all_usernames, n=1, cutoff=0.8)
-                
-                if close_matches:
-                    # A likely misspelling was found. Return a specific error with the suggestion.
-                    return json.dumps({
-                        "error": "User Not Found With Suggestion",
-                        "message": f"No user found for '{username}', but a similar name was found.",
-                        "suggestion": close_matches[0]
-                    })
-                else:
-                    # No similar name found, return the original generic error.
-                    return json.dumps({
-                        "error": "User Not Found",
-                        "message": f"Could not find any user with the name '{username}'."
-                    })
-    except Exception as e:
-        return f"Error searching for user: {e}"
 
 
 @function_tool
-async def add_comment_to_page(page_id: str, rich_text_json: str, commenter_notion_user_id: str) -> str:
+async def add_comment_to_page(ctx: RunContextWrapper[ChatRunContext], page_id: str, rich_text_json: str, commenter_notion_user_id: str) -> str:
     """
     Adds a new top-level comment to a page. AUTOMATICALLY appends the mandatory 'Commented by @user' signature.
     The 'commenter_notion_user_id' parameter is REQUIRED and must be the Notion ID of the user creating the comment.
     """
+    # The logged-in user comes from the run; the argument is only used outside a chat turn.
+    commenter_notion_user_id = current_user_id(ctx, commenter_notion_user_id)
     if not page_id:
         return json.dumps({"error": "Missing Page ID"})
     if not commenter_notion_user_id:
@@ -117,7 +66,7 @@ async def add_comment_to_page(page_id: str, rich_text_json: str, commenter_notio
     try:
         rich_text_list = json.loads(rich_text_json)
         final_rich_text = _append_commented_by_signature(rich_text_list, commenter_notion_user_id)
-        response = notion.comments.create(parent={"page_id": page_id}, rich_text=final_rich_text)
+        response = await notion.comments.create(parent={"page_id": page_id}, rich_text=final_rich_text)
         comment = ""
         for respond in final_rich_text:
             if(respond['type'] == "text"):
@@ -125,7 +74,7 @@ async def add_comment_to_page(page_id: str, rich_text_json: str, commenter_notio
                     break
                 comment += respond['text']['content']
             if(respond['type'] == "mention"):
-                comment += notion.users.retrieve(respond['mention']['user']['id'])['name']
+                comment += (await notion.users.retrieve(respond['mention']['user']['id']))['name']
         for respond in response['rich_text']:
             if(respond['type'] == "text"):
                 respond['text']['content']
@@ -135,6 +84,9 @@ async def add_comment_to_page(page_id: str, rich_text_json: str, commenter_notio
 
 
         count = 0
+        # Everyone mentioned, plus the commenter, resolved in one indexed query.
+        mentioned_ids = [respond['mention']['user']['id'] for respond in response['rich_text'] if respond['type'] == "mention" and 'user' in respond['mention']]
+        users = await get_users_by_notion_ids([commenter_notion_user_id, *mentioned_ids])
         for respond in response['rich_text']:
             if(respond['type'] == "mention"):
                 try:
@@ -144,69 +96,33 @@ async def add_comment_to_page(page_id: str, rich_text_json: str, commenter_notio
                     # query_for_phone_number = "SELECT phone_number FROM Users WHERE notion_user_id LIKE %s"
                     # cursor.execute(query_for_phone_number, (f"%{nid}%",))
                     # phone_number = cursor.fetchone()
-                    async for conn in get_db_connection():  # get AsyncSession
-                            phone_number = await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT phone_number FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{nid}%"},
-                                                        fetch_one=True
-                            )
+                    phone_number = users.get(nid)
                     # query_for_commentor = "SELECT username FROM Users WHERE notion_user_id LIKE %s"
                     # cursor.execute(query_for_commentor, (f"%{commenter_notion_user_id}%",))
                     # commentor_name = cursor.fetchone()
                     # cursor.close()
-                    async for conn in get_db_connection():  # get AsyncSession
-                            commentor_name =await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT username FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{commenter_notion_user_id}%"},
-                                                        fetch_one=True
-                            )
+                    commentor_name = users.get(commenter_notion_user_id)
                     #print(phone_number[0])
-                    get_task_details = notion.pages.retrieve(page_id=page_id)
+                    get_task_details = await retrieve_page(page_id)
                     task_name = str(get_task_details['properties']['Task']['title'][0]['plain_text'])
                     #print(task_name)
                     ai_repsonse = f"*{commentor_name['username']}* commented in *{task_name}* \n"+f"> {comment}" 
-                    if(commenter_notion_user_id != nid):
-                        print(phone_number,ai_repsonse)
-                        await send_whatsapp_message(phone_number['phone_number'],ai_repsonse )
                     # cursor = conn.cursor()
-                    notification_id = str(uuid.uuid4())
+                    notification_id = new_id()
                     # print(notion_id)
                     # query_for_changer = "SELECT user_id FROM Users WHERE notion_user_id LIKE %s"
                     # cursor.execute(query_for_changer, (f"%{commenter_notion_user_id}%",))
                     # new_notion_id = cursor.fetchone()
-                    async for conn in get_db_connection():  # get AsyncSession
-                            new_notion_id = commentor_name =await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT user_id FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{commenter_notion_user_id}%"},
-                                                        fetch_one=True
-                            )
+                    new_notion_id = commentor_name
                     #print(new_notion_id)
                     # query_for_changer = "SELECT user_id FROM Users WHERE notion_user_id LIKE %s"
                     # cursor.execute(query_for_changer, (f"%{nid}%",))
                     # new_message_assignee_id = cursor.fetchone()
-                    async for conn in get_db_connection():  # get AsyncSession
-                            new_message_assignee_id =await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT user_id FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{nid}%"},
-                                                        fetch_one=True
-                            )
+                    new_message_assignee_id = phone_number
                     print(new_notion_id)
                     print(nid)
-                    client  = OpenAI()
-                    new_thread = client.beta.threads.create()
-                    new_thread_id = new_thread.id
+                    # Local time-ordered id; no OpenAI thread is needed for our own Threads row.
+                    new_thread_id = new_id()
                     print("INSERT INTO notifications(notification_id,sender_id,receiver_id,title) Values(%s,%s,%s,%s)",(f"{notification_id}",f"{commenter_notion_user_id}",f"{nid}",f"{notification_id}",))
                     if(commenter_notion_user_id != nid):
                     #     cursor.execute("""INSERT INTO `threads`
@@ -218,24 +134,22 @@ async def add_comment_to_page(page_id: str, rich_text_json: str, commenter_notio
                     # %s,
                     # %s)
                     # """,(new_thread_id,list(notification_id)[0],"web"))
-                        async for conn in get_db_connection():  # get AsyncSession
-                            await execute_query(
-                                                        conn,
-                                                        """
-                                                        INSERT INTO threads (thread_id, title, type) VALUES (:thread_id,:title,:type)
-                                                        """,
-                                                        {"thread_id":new_thread_id,"title":notification_id,"type":"web"},
-                                                        fetch_one=True
-                            )
-                        async for conn in get_db_connection():  # get AsyncSession
-                            await execute_query(
-                                                        conn,
-                                                        """
-                                                        INSERT INTO notifications(notification_id, receiver_id, sender_id, title, thread_id) VALUES (:notification_id,:receiver_id,:sender_id,:title,:thread_id)
-                                                        """,
-                                                        {"notification_id":notification_id, "receiver_id":new_message_assignee_id['user_id'], "sender_id":new_notion_id['user_id'], "title":ai_repsonse, "thread_id":new_thread_id},
-                                                        fetch_one=True
-                            )
+                        async with unit_of_work():  # thread, notification and WhatsApp job in one commit
+                            async for conn in get_db_connection():  # get AsyncSession
+                                await execute_query(
+                                    conn,
+                                    "INSERT INTO threads (thread_id, title, type) VALUES (:thread_id, :title, :type)",
+                                    {"thread_id": new_thread_id, "title": notification_id, "type": "web"},
+                                    fetch_one=False
+                                )
+                                await execute_query(
+                                    conn,
+                                    "INSERT INTO notifications (notification_id, receiver_id, sender_id, title, thread_id) VALUES (:notification_id, :receiver_id, :sender_id, :title, :thread_id)",
+                                    {"notification_id": notification_id, "receiver_id": new_message_assignee_id['user_id'], "sender_id": new_notion_id['user_id'], "title": ai_repsonse, "thread_id": new_thread_id},
+                                    fetch_one=False
+                                )
+                            # Queued with the rows, so the message goes out only if they commit.
+                            await dispatch_whatsapp_message(phone_number['phone_number'], ai_repsonse)
                 
                 except Exception as e:
                     print("Before Exception",e)
@@ -248,13 +162,13 @@ async def add_comment_to_page(page_id: str, rich_text_json: str, commenter_notio
             else:
                 print(respond)
         print(count)
-        return json.dumps(response, indent=2)
+        return to_tool_json("add_comment_to_page", project_comment(response), raw=response)
     except Exception as e:
         return f"Error adding comment to page: {e}"
 
 
 @function_tool
-def retrieve_comments_by_task_name(task_name: str) -> str:
+async def retrieve_comments_by_task_name(ctx: RunContextWrapper[ChatRunContext], task_name: str) -> str:
     """
     Searches for a task by its name, then retrieves all unresolved comments from it.
     This is best for when you don't know the block or page ID.
@@ -263,37 +177,16 @@ def retrieve_comments_by_task_name(task_name: str) -> str:
         return json.dumps({"error": "Missing task name for search."})
 
     try:
-        # 1. Search for the page (task) by its title
-        search_params = {
-            "query": task_name,
-            "filter": {"property": "object", "value": "page"},
-            "sort": {"direction": "ascending", "timestamp": "last_edited_time"}
-        }
-        search_response = notion.search(**search_params)
-        results = search_response.get("results", [])
+        # 1. Resolve the task name against the local task index
+        match = await task_index.find_unique(task_name, tasks_database_id(ctx), allow_partial=True)
 
-        # 2. Handle search results
-        if not results:
-            return json.dumps({"error": f"No task found with the name '{task_name}'."})
-        
-        if len(results) > 1:
-            exact_matches = []
-            for page in results:
-                try:
-                    page_title = page.get("properties", {}).get("Task", {}).get('title',{})[0].get('plain_text',{})
-                    if page_title.lower() == task_name.lower():
-                        exact_matches.append(page)
-                except (IndexError, KeyError):
-                    continue # Skip malformed pages
-            
-            if len(exact_matches) == 1:
-                found_page = exact_matches[0]
-            else:
-                 return json.dumps({"error": f"Ambiguous task name. Multiple tasks found matching '{task_name}'. Please be more specific."})
-        else:
-            found_page = results[0]
+        # 2. Handle lookup results
+        if match["status"] == "not_found":
+            return json.dumps({"error": f"No task found with the name '{task_name}'.", "suggestions": match["suggestions"]})
+        if match["status"] == "ambiguous":
+            return json.dumps({"error": f"Ambiguous task name. Multiple tasks found matching '{task_name}'. Please be more specific.", "options": match["options"]})
 
-        task_id = found_page.get("id")
+        task_id = match["task"]["task_id"]
         if not task_id:
              return json.dumps({"error": "Found a matching task but could not retrieve its ID."})
 
@@ -304,27 +197,27 @@ def retrieve_comments_by_task_name(task_name: str) -> str:
             return json.dumps({"error": "Missing Block/Page ID"})
         try:
         # The API for retrieving comments requires a block_id
-            response = notion.comments.list(block_id=task_id)
-            return json.dumps(response, indent=2)
+            response = await notion.comments.list(block_id=task_id)
+            return to_tool_json("retrieve_comments_by_task_name", project_list(response, project_comment), raw=response)
         except Exception as e:
             return f"Error retrieving comments: {e}"
     except Exception as e:
         return f"An error occurred: {e}"
 
 @function_tool
-def retrieve_comments(block_id: str) -> str:
+async def retrieve_comments(block_id: str) -> str:
     """Retrieves a list of all unresolved comments from a specific page or block ID."""
     if not block_id: 
         return json.dumps({"error": "Missing Block/Page ID"})
     try:
         # The API for retrieving comments requires a block_id
-        response = notion.comments.list(block_id=block_id)
-        return json.dumps(response, indent=2)
+        response = await notion.comments.list(block_id=block_id)
+        return to_tool_json("retrieve_comments", project_list(response, project_comment), raw=response)
     except Exception as e:
         return f"Error retrieving comments: {e}"
 
 @function_tool
-def find_task_by_name(task_name: str) -> str:
+async def find_task_by_name(ctx: RunContextWrapper[ChatRunContext], task_name: str) -> str:
     """
     Finds a single task by its exact name and returns its ID.
     Use this to get the ID of a task you need to @-mention or "link" in a comment, or to find the page ID to add a comment to.
@@ -332,29 +225,14 @@ def find_task_by_name(task_name: str) -> str:
     if not task_name:
         return json.dumps({"error": "Missing Task Name"})
     try:
-        search_params = {"query": task_name, "filter": {"property": "object", "value": "page"}}
-        search_response = notion.search(**search_params)
-        results = search_response.get("results", [])
-
-        if not results:
-            return json.dumps({"error": "Task Not Found", "message": f"No task found with the name '{task_name}'."})
+        match = await task_index.find_unique(task_name, tasks_database_id(ctx), allow_partial=True)
 
-        exact_matches = []
-        for page in results:
-            try:
-                page_title = page.get("properties", {}).get("Task", {}).get("title", [])[0].get("plain_text", "")
-                if task_name.lower() in page_title.lower():
-                    print(page_title)
-                    exact_matches.append(page)
-            except (IndexError, KeyError):
-                continue
-        print(len(exact_matches))
-        if len(exact_matches) == 1:
-            return json.dumps({"task_name": exact_matches[0].get("properties", {}).get("Task", {}).get("title", [])[0].get("plain_text", ""), "task_id": exact_matches[0]["id"]})
-        elif len(exact_matches) > 1:
-            return json.dumps({"error": "Ambiguous Task Name", "message": f"Multiple tasks found with the name '{task_name}'. Please be more specific."})
+        if match["status"] == "found":
+            return json.dumps({"task_name": match["task"]["task_name"], "task_id": match["task"]["task_id"]})
+        elif match["status"] == "ambiguous":
+            return json.dumps({"error": "Ambiguous Task Name", "message": f"Multiple tasks found with the name '{task_name}'. Please be more specific.", "options": match["options"]})
         else:
-            return json.dumps({"error": "Task Not Found", "message": f"No task with the exact name '{task_name}' found among the results."})
+            return json.dumps({"error": "Task Not Found", "message": f"No task found with the name '{task_name}'.", "suggestions": match["suggestions"]})
 
     except APIResponseError as e:
         return json.dumps({"error": "Notion API Error", "message": f"An error occurred during search: {e}"})
@@ -1,25 +1,33 @@
 import os
 import json
-import uuid
 from zoneinfo import ZoneInfo
 from dotenv import load_dotenv
 from typing import Optional, Dict, Any, List
 from datetime import date, datetime, timedelta, timezone
-import notion_client
-from agents import Agent, function_tool, handoff
+from agents import Agent, RunContextWrapper, function_tool, handoff
 import difflib
 
 from model.response_agent_input import ResponseAgentInput
 from openai import OpenAI  # Assuming these are defined in your agents module
-from db import get_db_connection
+from db import get_db_connection, unit_of_work
 from utils.db_helper import execute_query
+from utils.id_generator import new_id
 from utils.phone_number_utils import (
     get_current_datetime_in_timezone,
     get_timezones_for_phone,
 )
 from utils.whatsapp_utils import send_whatsapp_message
+from services.notion_gateway import notion
+from services.digest_scheduler import DIGEST_KINDS
+from services.reminder_scheduler import reminder_scheduler
+from services.task_index import task_index
+from services.user_directory import get_users_by_notion_ids
+from utils.notion_projection import project_comment, project_list, to_tool_json
+from utils.recurrence import RecurrenceError, first_run_utc, parse_rule, utc_to_local
 
 from local_agents.notion_response_agent import notion_response_agent
+from local_agents.run_context import ChatRunContext, current_user_id, run_context, tasks_database_id, user_language as user_language_of
+from local_agents.user_tools import get_notion_user_id_from_name
 
 load_dotenv()
 NOTION_API_KEY = os.getenv("NOTION_API_KEY")
@@ -30,8 +38,6 @@ if not all([NOTION_API_KEY, TASKS_DATABASE_ID]):
         "One or more required environment variables are missing from .env: NOTION_API_KEY, TASKS_DATABASE_ID"
     )
 
-notion = notion_client.Client(auth=NOTION_API_KEY)
-
 def manage_response_agent_handoff(context, input: ResponseAgentInput):
     """
     Handles the response agent handoff by processing the specialist tool output
@@ -40,7 +46,7 @@ def manage_response_agent_handoff(context, input: ResponseAgentInput):
     print("response agent start") 
     
 @function_tool
-def search_database_by_title(task_name: str) -> str:
+async def search_database_by_title(ctx: RunContextWrapper[ChatRunContext], task_name: str) -> str:
     """
     Searches the Notion database for tasks that exactly match the given title.
 
@@ -56,45 +62,16 @@ def search_database_by_title(task_name: str) -> str:
         return json.dumps({"error": "Missing task name for search."})
 
     try:
-        search_params = {
-            "query": task_name,
-            "filter": {"property": "object", "value": "page"},
-            "sort": {"direction": "ascending", "timestamp": "last_edited_time"},
-        }
-        search_response = notion.search(**search_params)
-        results = search_response.get("results", [])
+        # 1. Resolve the task name against the local task index
+        match = await task_index.find_unique(task_name, tasks_database_id(ctx), allow_partial=True)
 
-        if not results:
-            return json.dumps(
-                {"error": f"No task found with the name '{task_name}'."}
-            )
+        # 2. Handle lookup results
+        if match["status"] == "not_found":
+            return json.dumps({"error": f"No task found with the name '{task_name}'.", "suggestions": match["suggestions"]})
+        if match["status"] == "ambiguous":
+            return json.dumps({"error": f"Ambiguous task name. Multiple tasks found matching '{task_name}'. Please be more specific.", "options": match["options"]})
 
-        if len(results) > 1:
-            exact_matches = []
-            for page in results:
-                try:
-                    page_title = (
-                        page.get("properties", {})
-                        .get("Task", {})
-                        .get("title", {})[0]
-                        .get("plain_text", {})
-                    )
-                    if page_title.lower() == task_name.lower():
-                        exact_matches.append(page)
-                except (IndexError, KeyError):
-                    continue
-            if len(exact_matches) == 0:
-                found_page = exact_matches[0]
-            else:
-                return json.dumps(
-                    {
-                        "error": f"Ambiguous task name. Multiple tasks found matching '{task_name}'. Please be more specific."
-                    }
-                )
-        else:
-            found_page = results[0]
-
-        task_id = found_page.get("id")
+        task_id = match["task"]["task_id"]
         if not task_id:
             return json.dumps(
                 {"error": "Found a matching task but could not retrieve its ID."}
@@ -107,8 +84,8 @@ def search_database_by_title(task_name: str) -> str:
             return json.dumps({"error": "Missing Block/Page ID"})
         try:
             # The API for retrieving comments requires a block_id
-            response = notion.comments.list(block_id=task_id)
-            return json.dumps(response, indent=2)
+            response = await notion.comments.list(block_id=task_id)
+            return to_tool_json("retrieve_comments_by_task_name", project_list(response, project_comment), raw=response)
         except Exception as e:
             return f"Error retrieving comments: {e}"
     except Exception as e:
@@ -116,72 +93,18 @@ def search_database_by_title(task_name: str) -> str:
 
 
 @function_tool
-def retrieve_comments(block_id: str) -> str:
+async def retrieve_comments(block_id: str) -> str:
     """Retrieves a list of all unresolved comments from a specific page or block ID."""
     if not block_id:
         return json.dumps({"error": "Missing Block/Page ID"})
     try:
         # The API for retrieving comments requires a block_id
-        response = notion.comments.list(block_id=block_id)
-        return json.dumps(response, indent=2)
+        response = await notion.comments.list(block_id=block_id)
+        return to_tool_json("retrieve_comments", project_list(response, project_comment), raw=response)
     except Exception as e:
         return f"Error retrieving comments: {e}"
 
 
-@function_tool
-async def get_notion_user_id_from_name(username: str) -> str:
-    """
-    Finds a user's Notion ID. Handles ambiguity by providing options and suggests corrections for misspellings.
-    """
-    # ... (connection logic remains the same)
-    try:
-        async for conn in get_db_connection():
-            # First, try the original query
-            users = await execute_query(
-                conn,
-                """
-                SELECT notion_user_id, username FROM Users WHERE username LIKE :id
-                """,
-                {"id": f"%{username}%"},
-                fetch_one=False
-            )
-
-            if users:
-                # --- EXISTING LOGIC - NO CHANGES NEEDED ---
-                if len(users) == 1:
-                    user = users[0]
-                    return json.dumps({"username": user["username"], "notion_user_id": user["notion_user_id"]})
-                else:
-                    found_names = [user['username'] for user in users]
-                    return json.dumps({
-                        "error": "Ambiguous Name",
-                        "message": "Multiple users found. Ask for clarification.",
-                        "options": found_names
-                    })
-            else:
-                # --- NEW FALLBACK LOGIC FOR MISSPELLINGS ---
-                # If no users were found, fetch all usernames to check for a close match.
-                all_users_records = await execute_query(conn, "SELECT username FROM Users", {}, fetch_one=False)
-                all_usernames = [record['username'] for record in all_users_records]
-                
-                # Find the best single match with a high similarity cutoff (e.g., 0.8)
-                close_matches = difflib.get_close_matches(username, all_usernames, n=1, cutoff=0.8)
-                
-                if close_matches:
-                    # A likely misspelling was found. Return a specific error with the suggestion.
-                    return json.dumps({
-                        "error": "User Not Found With Suggestion",
-                        "message": f"No user found for '{username}', but a similar name was found.",
-                        "suggestion": close_matches[0]
-                    })
-                else:
-                    # No similar name found, return the original generic error.
-                    return json.dumps({
-                        "error": "User Not Found",
-                        "message": f"Could not find any user with the name '{username}'."
-                    })
-    except Exception as e:
-        return f"Error searching for user: {e}"
 
 
 
@@ -368,6 +291,7 @@ async def get_notion_user_id_from_name(username: str) -> str:
 #         print(f"Exception in reminder tool: {e}")
 #         return json.dumps({"error": str(e)})
 async def reminder(
+    ctx: RunContextWrapper[ChatRunContext],
     user_id: str,
     reminder_id: str,
     user_language: str,
@@ -377,6 +301,7 @@ async def reminder(
     reminder_message: str,
     task_name: Optional[str] = None,
     due_date: Optional[str] = None,
+    recurrence: Optional[str] = None,
 ) -> str:
     """
     Schedules a reminder. Differentiates between task-related and casual reminders.
@@ -391,7 +316,19 @@ async def reminder(
         reminder_message: The text content of the reminder notification.
         task_name: The exact name of the task to look up in Notion if is_task_related is True.
         due_date: Optional due date for the task.
+        recurrence: Optional RRULE for a repeating reminder, e.g. "FREQ=WEEKLY;BYDAY=MO" or "FREQ=DAILY".
+                    remind_date/remind_time give the first occurrence and the time of day.
     """
+    # The logged-in user and their language come from the run; the arguments
+    # are only used outside a chat turn.
+    user_id = current_user_id(ctx, user_id)
+    user_language = user_language_of(ctx, user_language)
+    if recurrence:
+        try:
+            recurrence = str(parse_rule(recurrence))
+        except RecurrenceError as e:
+            return json.dumps({"error": "InvalidRecurrence", "message": str(e)})
+
     conn = get_db_connection()
     if isinstance(conn, str):
         return json.dumps({"error": conn})
@@ -406,12 +343,9 @@ async def reminder(
                     "message": "A task_name is required for a task-related reminder."
                 })
             try:
-                # Use task_name for the Notion database query
-                db_query = notion.databases.query(
-                    database_id=TASKS_DATABASE_ID,
-                    filter={"property": "Task", "title": {"equals": task_name}},
-                )
-                matched = db_query.get("results", [])
+                # Resolve task_name against the local task index
+                matches = await task_index.lookup(task_name, tasks_database_id(ctx))
+                matched = matches["exact"]
                 if not matched:
                     return json.dumps({
                         "error": "TaskNotFound",
@@ -438,25 +372,9 @@ async def reminder(
 
         # cursor.execute("SELECT phone_number, username, user_id FROM Users WHERE notion_user_id LIKE %s", (f"{user_id}",))
         # creator_user = cursor.fetchone()
-        async for conn in get_db_connection():  # get AsyncSession
-            target_user = await execute_query(
-                                        conn,
-                                        """
-                                        SELECT phone_number, username, user_id FROM Users WHERE notion_user_id = :user_id
-                                        """,
-                                        {"user_id":f"{reminder_id}"},
-                                        fetch_one=True
-            )
-        
-        async for conn in get_db_connection():  # get AsyncSession
-            creator_user = await execute_query(
-                                        conn,
-                                        """
-                                        SELECT phone_number, username, user_id FROM Users WHERE notion_user_id =:user_id
-                                        """,
-                                        {"user_id":f"{user_id}"},
-                                        fetch_one=True
-            )
+        users = await get_users_by_notion_ids([reminder_id, user_id])
+        target_user = users.get(reminder_id)
+        creator_user = users.get(user_id)
         
         if not target_user: target_user = creator_user
         if not target_user or not creator_user:
@@ -482,15 +400,22 @@ async def reminder(
         
         # --- Database insertion logic remains the same ---
         # cursor = conn.cursor()
-        notification_id = str(uuid.uuid4())
-        new_thread_id = str(uuid.uuid4())
+        notification_id = new_id()
+        new_thread_id = new_id()
         datetime_string = f"{remind_date} {remind_time}"
         
-        # This timezone logic is complex and remains as is
-        target_user_timezone = get_timezones_for_phone(f"+{creator_user['phone_number']}")
+        # The run's timezone is the one the agent's current_time was given in;
+        # otherwise fall back to the creator's phone number.
+        run_timezone = run_context(ctx).timezone
+        target_user_timezone = [run_timezone] if run_timezone else get_timezones_for_phone(f"+{creator_user['phone_number']}")
         created_at_datetime_naive = datetime.strptime(datetime_string, "%Y-%m-%d %H:%M")
         created_at_datetime_aware = created_at_datetime_naive.replace(tzinfo=ZoneInfo(target_user_timezone[0]))
         created_at_utc = created_at_datetime_aware.astimezone(ZoneInfo("UTC"))
+        if recurrence:
+            # First matching occurrence on or after the requested date and time.
+            created_at_utc = first_run_utc(recurrence, created_at_datetime_naive, target_user_timezone[0])
+            if created_at_utc is None:
+                return json.dumps({"error": "InvalidRecurrence", "message": "The recurrence rule has no future occurrences."})
 
         # cursor.execute("INSERT INTO threads (thread_id, title, type) VALUES (%s, %s, %s)", (new_thread_id, notification_id, "web"))
         # cursor.execute(
@@ -499,33 +424,138 @@ async def reminder(
         # )
         # conn.commit()
         # cursor.close()
-        async for conn in get_db_connection():  # get AsyncSession
-            await execute_query(
-                                        conn,
-                                        """
-                                        INSERT INTO threads (thread_id, title, type) VALUES (:thread_id,:title,:type)
-                                        """,
-                                        {"thread_id":new_thread_id,"title":notification_id,"type":"web"},
-                                        fetch_one=True
-            )
-        async for conn in get_db_connection():  # get AsyncSession
-            await execute_query(
-                                        conn,
-                                        """
-                                        INSERT INTO notifications(notification_id, receiver_id, sender_id, title, thread_id, created_at, type) VALUES (:notification_id,:receiver_id,:sender_id,:title,:thread_id,:created_at,:type)
-                                        """,
-                                        {"notification_id":notification_id, "receiver_id":target_user["user_id"], "sender_id":creator_user["user_id"], "title":reminder_text, "thread_id":new_thread_id, "created_at":created_at_utc, "type":"reminder"},
-                                        fetch_one=True
-            )
+        async with unit_of_work():  # thread + notification in one commit
+            async for conn in get_db_connection():  # get AsyncSession
+                await execute_query(
+                    conn,
+                    "INSERT INTO threads (thread_id, title, type) VALUES (:thread_id, :title, :type)",
+                    {"thread_id": new_thread_id, "title": notification_id, "type": "web"},
+                    fetch_one=False
+                )
+                await execute_query(
+                    conn,
+                    """
+                    INSERT INTO notifications (notification_id, receiver_id, sender_id, title, thread_id, created_at, type, recurrence_rule, timezone)
+                    VALUES (:notification_id, :receiver_id, :sender_id, :title, :thread_id, :created_at, :type, :recurrence_rule, :timezone)
+                    """,
+                    {
+                        "notification_id": notification_id,
+                        "receiver_id": target_user["user_id"],
+                        "sender_id": creator_user["user_id"],
+                        "title": reminder_text,
+                        "thread_id": new_thread_id,
+                        "created_at": created_at_utc,
+                        "type": "reminder",
+                        "recurrence_rule": recurrence,
+                        "timezone": target_user_timezone[0] if recurrence else None,
+                    },
+                    fetch_one=False
+                )
+        # Committed; a near-term reminder goes straight onto the scheduler's heap.
+        reminder_scheduler.notify(notification_id, created_at_utc)
 
         confirmation_text = f"I have scheduled a reminder for {target_user['username']} about '{reminder_message}'."
-        return json.dumps({"status": "success", "confirmation": confirmation_text})
+        result = {"status": "success", "confirmation": confirmation_text}
+        if recurrence:
+            result.update({"recurrence": recurrence, "first_reminder_utc": created_at_utc.strftime("%Y-%m-%dT%H:%M:%SZ")})
+        return json.dumps(result)
 
     except Exception as e:
         # Log the full exception for debugging
         print(f"Exception in reminder tool: {e}")
         return json.dumps({"error": str(e)})
 
+
+@function_tool
+async def schedule_digest(
+    ctx: RunContextWrapper[ChatRunContext],
+    user_id: str,
+    user_language: str,
+    digest_type: str = "overdue",
+    recurrence: str = "FREQ=DAILY",
+    digest_time: str = "09:00",
+    enabled: bool = True,
+) -> str:
+    """
+    Schedules (or turns off) a recurring WhatsApp digest of the user's tasks,
+    sent as one message without a chat. A user has at most one digest per type;
+    scheduling again replaces it.
+
+    Args:
+        user_id: The Notion ID of the logged-in user.
+        user_language: The language of the digest ('en', 'ru', 'az').
+        digest_type: 'overdue' (only overdue tasks) or 'open' (all unfinished tasks).
+        recurrence: RRULE for when to send it, e.g. "FREQ=DAILY" or "FREQ=WEEKLY;BYDAY=MO,TH".
+        digest_time: Local time of day to send it, "HH:MM".
+        enabled: False to turn the digest off.
+    """
+    user_id = current_user_id(ctx, user_id)
+    user_language = user_language_of(ctx, user_language)
+    if digest_type not in DIGEST_KINDS:
+        return json.dumps({"error": "InvalidDigestType", "message": f"digest_type must be one of {', '.join(DIGEST_KINDS)}."})
+    try:
+        users = await get_users_by_notion_ids([user_id])
+        user = users.get(user_id)
+        if not user:
+            return json.dumps({"error": "Could not find the user."})
+
+        if not enabled:
+            async for conn in get_db_connection():
+                stopped = await execute_query(
+                    conn,
+                    "UPDATE DigestSchedules SET next_run_at = NULL WHERE user_id = :user_id AND kind = :kind",
+                    {"user_id": user["user_id"], "kind": digest_type},
+                    fetch_one=False
+                )
+            return json.dumps({"status": "success", "digest_type": digest_type, "enabled": False, "found": bool(stopped)})
+
+        try:
+            rule = str(parse_rule(recurrence))
+            at = datetime.strptime(digest_time, "%H:%M").time()
+        except (RecurrenceError, ValueError) as e:
+            return json.dumps({"error": "InvalidRecurrence", "message": str(e)})
+
+        run_timezone = run_context(ctx).timezone
+        timezones = [run_timezone] if run_timezone else get_timezones_for_phone(f"+{user['phone_number']}")
+        timezone_name = timezones[0] if timezones else "UTC"
+        today_local = utc_to_local(datetime.now(timezone.utc).replace(tzinfo=None), timezone_name).date()
+        next_run_at = first_run_utc(rule, datetime.combine(today_local, at), timezone_name)
+        if next_run_at is None:
+            return json.dumps({"error": "InvalidRecurrence", "message": "The recurrence rule has no future occurrences."})
+
+        async for conn in get_db_connection():
+            await execute_query(
+                conn,
+                """
+                INSERT INTO DigestSchedules (schedule_id, user_id, kind, recurrence_rule, timezone, language, next_run_at)
+                VALUES (:schedule_id, :user_id, :kind, :recurrence_rule, :timezone, :language, :next_run_at)
+                ON DUPLICATE KEY UPDATE recurrence_rule = VALUES(recurrence_rule), timezone = VALUES(timezone),
+                    language = VALUES(language), next_run_at = VALUES(next_run_at), lease_owner = NULL, lease_expires_at = NULL
+                """,
+                {
+                    "schedule_id": new_id(),
+                    "user_id": user["user_id"],
+                    "kind": digest_type,
+                    "recurrence_rule": rule,
+                    "timezone": timezone_name,
+                    "language": user_language or "en",
+                    "next_run_at": next_run_at,
+                },
+                fetch_one=False
+            )
+        return json.dumps({
+            "status": "success",
+            "digest_type": digest_type,
+            "recurrence": rule,
+            "digest_time": digest_time,
+            "timezone": timezone_name,
+            "first_digest_utc": next_run_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        })
+
+    except Exception as e:
+        print(f"Exception in schedule_digest tool: {e}")
+        return json.dumps({"error": str(e)})
+
 # --- AGENT DEFINITION (MODIFIED INSTRUCTIONS) ---
 
 reminder_agent = Agent(
@@ -747,6 +777,20 @@ You are a notion reminder agent. Your primary function is to execute tools to se
         }}
 ###
 ---
+### 6: RECURRING REMINDERS AND DIGESTS:*
+    - If the user asks for a reminder that repeats ("every Monday at 9am", "daily at 8", "every 2 weeks on Friday"), call `reminder` with a `recurrence` rule.
+        - `remind_date`/`remind_time` are the first occurrence and the time of day.
+        - Rules use FREQ=DAILY|WEEKLY|MONTHLY, with optional INTERVAL, BYDAY (MO,TU,WE,TH,FR,SA,SU), BYMONTHDAY and UNTIL=YYYYMMDD.
+        - "every Monday 9am" -> `"recurrence": "FREQ=WEEKLY;BYDAY=MO"`, `"remind_time": "09:00"`
+        - "every weekday at 8:30 until the end of the year" -> `"recurrence": "FREQ=DAILY;BYDAY=MO,TU,WE,TH,FR;UNTIL=20251231"`, `"remind_time": "08:30"`
+        - "on the 1st of every month" -> `"recurrence": "FREQ=MONTHLY;BYMONTHDAY=1"`
+    - If the user asks for a regular summary of their own tasks ("daily summary of my overdue tasks", "send me my open tasks every Monday morning"), call `schedule_digest` instead of `reminder`.
+        - `digest_type` is "overdue" for overdue tasks and "open" for all unfinished tasks.
+        - `recurrence` defaults to "FREQ=DAILY"; `digest_time` is "HH:MM" (default "09:00").
+        - To stop a digest, call `schedule_digest` with `enabled=false`.
+    - Use ACTION_TYPE: ReminderSet for both, with the tool's JSON as TOOL_OUTPUT.
+###
+---
 ### **Context & Date:**
     - **Current Date:** `{datetime.now(timezone.utc).date()}`
     - **Current Time:** `{datetime.now(timezone.utc).time()}`
@@ -756,6 +800,7 @@ You are a notion reminder agent. Your primary function is to execute tools to se
     tools=[
         get_notion_user_id_from_name,
         reminder,
+        schedule_digest,
         search_database_by_title,
     ],
     handoffs=[
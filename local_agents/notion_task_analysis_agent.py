@@ -2,75 +2,62 @@ import os
 import json
 from typing import Optional
 from dotenv import load_dotenv
-import notion_client
 from notion_client.errors import APIResponseError
-from agents import Agent, function_tool
+from agents import Agent, RunContextWrapper, function_tool
+
+from services.notion_gateway import notion, retrieve_page
+from services.task_index import task_index
+from utils.notion_projection import project_block, project_comment, project_list, project_page, to_tool_json
+from local_agents.run_context import ChatRunContext, tasks_database_id
 
 
 # --- SETUP ---
-# Standard environment variable loading and Notion client initialization.
+# Standard environment variable loading. The Notion client is shared through services.notion_gateway.
 load_dotenv()
-api_key = os.getenv("NOTION_API_KEY")
-if not api_key:
-    raise ValueError("FATAL: NOTION_API_KEY not found in .env file.")
-notion = notion_client.Client(auth=api_key)
 
 
 # --- AGENT TOOLS ---
 # These tools are consolidated from your other agents to make this agent self-sufficient.
 
 @function_tool
-def find_task_by_name(task_name: str) -> str:
+async def find_task_by_name(ctx: RunContextWrapper[ChatRunContext], task_name: str) -> str:
     """
     Finds a single task by its exact name to get its ID. This is the first step for any analysis.
     """
     if not task_name:
         return json.dumps({"error": "Missing Task Name"})
     try:
-        # Search for pages with a matching title
-        search_params = {"query": task_name, "filter": {"property": "object", "value": "page"}}
-        search_response = notion.search(**search_params)
-        results = search_response.get("results", [])
-
-        if not results:
-            return json.dumps({"error": "Task Not Found", "message": f"No task named '{task_name}' found."})
-
-        # Find an exact match from the search results
-        exact_matches = []
-        for page in results:
-            try:
-                page_title = page.get("properties", {}).get("Task", {}).get("title", [])[0].get("plain_text", "")
-                if page_title.lower() == task_name.lower():
-                    exact_matches.append(page)
-            except (IndexError, KeyError):
-                continue
-        
+        # Resolve the title against the local task index (exact match only)
+        matches = await task_index.lookup(task_name, tasks_database_id(ctx))
+        exact_matches = matches["exact"]
+
         if len(exact_matches) == 1:
-            task_id = exact_matches[0]["id"]
+            task_id = exact_matches[0]["task_id"]
             return json.dumps({"task_name": task_name, "task_id": task_id})
         elif len(exact_matches) > 1:
             return json.dumps({"error": "Ambiguous Task Name", "message": f"Multiple tasks found with the name '{task_name}'."})
         else:
-            return json.dumps({"error": "Task Not Found", "message": f"No task with the exact name '{task_name}' was found."})
+            suggestions = [m["task_name"] for m in matches["prefix"] + matches["fuzzy"]]
+            return json.dumps({"error": "Task Not Found", "message": f"No task with the exact name '{task_name}' was found.", "suggestions": suggestions})
 
     except APIResponseError as e:
         return json.dumps({"error": "Notion API Error", "message": str(e)})
 
 @function_tool
-def retrieve_page_details(page_id: str) -> str:
+async def retrieve_page_details(page_id: str) -> str:
     """
     Retrieves the full Page object, including all its metadata properties like Status, Assignee, and Due Date.
     """
     if not page_id:
         return json.dumps({"error": "Missing Page ID"})
     try:
-        response = notion.pages.retrieve(page_id=page_id)
-        return json.dumps(response, indent=2)
+        response = await retrieve_page(page_id)
+        return to_tool_json("retrieve_page_details", project_page(response), raw=response)
     except APIResponseError as e:
         return f"Error retrieving page details: {e}"
 
 @function_tool
-def retrieve_page_content(block_id: str) -> str:
+async def retrieve_page_content(block_id: str) -> str:
     """
     Retrieves the content blocks (e.g., paragraphs, to-do lists) from within a page.
     """
@@ -78,21 +65,21 @@ def retrieve_page_content(block_id: str) -> str:
         return json.dumps({"error": "Missing Block/Page ID"})
     try:
         # notion.blocks.children.list is the correct method to get page content
-        response = notion.blocks.children.list(block_id=block_id)
-        return json.dumps(response, indent=2)
+        response = await notion.blocks.children.list(block_id=block_id)
+        return to_tool_json("retrieve_page_content", project_list(response, project_block), raw=response)
     except APIResponseError as e:
         return f"Error retrieving page content: {e}"
 
 @function_tool
-def retrieve_comments(block_id: str) -> str:
+async def retrieve_comments(block_id: str) -> str:
     """
     Retrieves a list of all unresolved comments from a specific page ID.
     """
     if not block_id:
         return json.dumps({"error": "Missing Block/Page ID"})
     try:
-        response = notion.comments.list(block_id=block_id)
-        return json.dumps(response, indent=2)
+        response = await notion.comments.list(block_id=block_id)
+        return to_tool_json("retrieve_comments", project_list(response, project_comment), raw=response)
     except APIResponseError as e:
         return f"Error retrieving comments: {e}"
 
@@ -148,17 +135,17 @@ You must use the data from the tool calls to populate this template. If a field
 - **@<Commenter Name>:** <Comment Text>
 
 ### **Data Parsing Guide:**
-- **`<Task Name>`**: From `retrieve_page_details` -> `properties.Task.title[0].plain_text`
+- **`<Task Name>`**: From `retrieve_page_details` -> `properties.Task`
 - **`<Page ID>`**: From `find_task_by_name` -> `task_id`
-- **`<Status>`**: From `retrieve_page_details` -> `properties.Status.status.name`
-- **`<Assignee Name>`**: From `retrieve_page_details` -> `properties.Assignee.people[0].name`
-- **`<Due Date>`**: From `retrieve_page_details` -> `properties['Due Date'].date.start`
-- **`<Priority>`**: From `retrieve_page_details` -> `properties.Priority.select.name`
-- **`<Creator Name>`**: From `retrieve_page_details` -> `created_by.name` (Note: `created_by` is a user object)
-- **`<Last Editor Name>`**: From `retrieve_page_details` -> `last_edited_by.name`
+- **`<Status>`**: From `retrieve_page_details` -> `properties.Status`
+- **`<Assignee Name>`**: From `retrieve_page_details` -> `properties.Assignee[0]`
+- **`<Due Date>`**: From `retrieve_page_details` -> `properties['Due Date']`
+- **`<Priority>`**: From `retrieve_page_details` -> `properties.Priority`
+- **`<Creator Name>`**: From `retrieve_page_details` -> `properties['Created by'][0]`
+- **`<Last Editor Name>`**: From `retrieve_page_details` -> `last_edited_by`
 - **`<URL>`**: From `retrieve_page_details` -> `url`
-- **Page Content Blocks**: Iterate through `retrieve_page_content` results. For each block, find its type (e.g., `paragraph`, `to_do`) and get the text from `[block_type].rich_text[0].plain_text`.
-- **Commenter & Text**: Iterate through `retrieve_comments` results. Get the name from `created_by.name` and the comment from `rich_text[0].plain_text`.
+- **Page Content Blocks**: Iterate through `retrieve_page_content` results. Each block has a `type` (e.g., `paragraph`, `to_do`), its `text`, and `checked` for to-dos.
+- **Commenter & Text**: Iterate through `retrieve_comments` results. Get the name from `created_by` and the comment from `text`.
 """,
     tools=[
         find_task_by_name,
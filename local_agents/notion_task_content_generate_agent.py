@@ -7,6 +7,7 @@ from model.response_agent_input import ResponseAgentInput
 from typing import Optional
 import requests
 
+from utils.notion_projection import to_tool_json
 from local_agents.notion_response_agent import notion_response_agent
 
 # --- SETUP ---
@@ -73,7 +74,7 @@ def youtube_search(query: str, max_results: int = 5) -> str:
                     "url": f"https://www.youtube.com/watch?v={video_id}"
                 })
             
-        return json.dumps(videos, indent=2)
+        return to_tool_json("youtube_search", videos)
 
     except requests.exceptions.RequestException as e:
         return json.dumps({"error": "API Request Error", "message": str(e)})
@@ -1,21 +1,26 @@
 from datetime import datetime
 import os
 import json
-import uuid
 from dotenv import load_dotenv
 from typing import Optional, Dict, Any, List
 from datetime import date, timedelta
 import notion_client
-from agents import Agent, function_tool, handoff
+from agents import Agent, RunContextWrapper, function_tool, handoff
 import difflib
 
 from model.response_agent_input import ResponseAgentInput
-from openai import OpenAI # Assuming these are defined in your agents module
-from db import get_db_connection
+from db import get_db_connection, unit_of_work
 from utils.db_helper import execute_query
-from utils.whatsapp_utils import send_whatsapp_message
+from utils.id_generator import new_id
+from services.outbound_dispatcher import dispatch_whatsapp_message
+from services.notion_gateway import notion, create_page
+from services.task_index import task_index
+from services.user_directory import get_users_by_notion_ids
+from utils.notion_projection import project_comment, project_list, to_tool_json
 
 from local_agents.notion_response_agent import notion_response_agent
+from local_agents.run_context import ChatRunContext, current_user_id, tasks_database_id, user_language
+from local_agents.user_tools import get_notion_user_id_from_name
 
 # --- SETUP (Unchanged) ---
 load_dotenv()
@@ -25,8 +30,6 @@ TASKS_DATABASE_ID = os.getenv("NOTION_TASKS_DATABASE_ID")
 if not all([NOTION_API_KEY, TASKS_DATABASE_ID]):
     raise ValueError("One or more required environment variables are missing from .env: NOTION_API_KEY, TASKS_DATABASE_ID")
 
-notion = notion_client.Client(auth=NOTION_API_KEY)
-
 
 # --- AGENT TOOLS (Unchanged) ---
 
@@ -38,7 +41,7 @@ def manage_response_agent_handoff(context, input: ResponseAgentInput):
     print("response agent start") 
 
 @function_tool
-def search_database_by_title(task_name: str) -> str:
+async def search_database_by_title(ctx: RunContextWrapper[ChatRunContext], task_name: str) -> str:
     """
     Searches the Notion database for tasks that exactly match the given title.
 
@@ -54,43 +57,16 @@ def search_database_by_title(task_name: str) -> str:
         return json.dumps({"error": "Missing task name for search."})
 
     try:    
-        # 1. Search for the page (task) by its title
-        search_params = {
-            "query": task_name,
-            "filter": {"property": "object", "value": "page"},
-            "sort": {"direction": "ascending", "timestamp": "last_edited_time"}
-        }
-        search_response = notion.search(**search_params)
-        results = search_response.get("results", [])
+        # 1. Resolve the task name against the local task index
+        match = await task_index.find_unique(task_name, tasks_database_id(ctx), allow_partial=True)
 
-        # 2. Handle search results
-        if not results:
-            return json.dumps({"error": f"No task found with the name '{task_name}'."})
-        
-        if len(results) > 1:
-            # To avoid ambiguity, you can check if there's an exact match for the title
-            exact_matches = []
-            for page in results:
-                # The title property is structured, so we need to extract the plain text
-                # print(page.get("properties", {}).get("Task", {}).get('title',{})[0].get('plain_text',{}))
-                try:
-                    page_title = page.get("properties", {}).get("Task", {}).get('title',{})[0].get('plain_text',{})
-                    # print(page_title.lower())
-                    # print(task_name.lower())
-                    if page_title.lower() == task_name.lower():
-                        # print(page_title)
-                        exact_matches.append(page)
-                except (IndexError, KeyError):
-                    continue # Skip malformed pages
-            # print(len(exact_matches))
-            if len(exact_matches) == 0:
-                found_page = exact_matches[0]
-            else:
-                 return json.dumps({"error": f"Ambiguous task name. Multiple tasks found matching '{task_name}'. Please be more specific."})
-        else:
-            found_page = results[0]
+        # 2. Handle lookup results
+        if match["status"] == "not_found":
+            return json.dumps({"error": f"No task found with the name '{task_name}'.", "suggestions": match["suggestions"]})
+        if match["status"] == "ambiguous":
+            return json.dumps({"error": f"Ambiguous task name. Multiple tasks found matching '{task_name}'. Please be more specific.", "options": match["options"]})
 
-        task_id = found_page.get("id")
+        task_id = match["task"]["task_id"]
         if not task_id:
              return json.dumps({"error": "Found a matching task but could not retrieve its ID."})
 
@@ -101,73 +77,20 @@ def search_database_by_title(task_name: str) -> str:
             return json.dumps({"error": "Missing Block/Page ID"})
         try:
         # The API for retrieving comments requires a block_id
-            response = notion.comments.list(block_id=task_id)
-            return json.dumps(response, indent=2)
+            response = await notion.comments.list(block_id=task_id)
+            return to_tool_json("retrieve_comments_by_task_name", project_list(response, project_comment), raw=response)
         except Exception as e:
             return f"Error retrieving comments: {e}"
     except Exception as e:
         return f"An error occurred: {e}"
 
 
-@function_tool
-async def get_notion_user_id_from_name(username: str) -> str:
-    """
-    Finds a user's Notion ID. Handles ambiguity by providing options and suggests corrections for misspellings.
-    """
-    # ... (connection logic remains the same)
-    try:
-        async for conn in get_db_connection():
-            # First, try the original query
-            users = await execute_query(
-                conn,
-                """
-                SELECT notion_user_id, username FROM Users WHERE username LIKE :id
-                """,
-                {"id": f"%{username}%"},
-                fetch_one=False
-            )
-
-            if users:
-                # --- EXISTING LOGIC - NO CHANGES NEEDED ---
-                if len(users) == 1:
-                    user = users[0]
-                    return json.dumps({"username": user["username"], "notion_user_id": user["notion_user_id"]})
-                else:
-                    found_names = [user['username'] for user in users]
-                    return json.dumps({
-                        "error": "Ambiguous Name",
-                        "message": "Multiple users found. Ask for clarification.",
-                        "options": found_names
-                    })
-            else:
-                # --- NEW FALLBACK LOGIC FOR MISSPELLINGS ---
-                # If no users were found, fetch all usernames to check for a close match.
-                all_users_records = await execute_query(conn, "SELECT username FROM Users", {}, fetch_one=False)
-                all_usernames = [record['username'] for record in all_users_records]
-                
-                # Find the best single match with a high similarity cutoff (e.g., 0.8)
-                close_matches = difflib.get_close_matches(username, all_usernames, n=1, cutoff=0.8)
-                
-                if close_matches:
-                    # A likely misspelling was found. Return a specific error with the suggestion.
-                    return json.dumps({
-                        "error": "User Not Found With Suggestion",
-                        "message": f"No user found for '{username}', but a similar name was found.",
-                        "suggestion": close_matches[0]
-                    })
-                else:
-                    # No similar name found, return the original generic error.
-                    return json.dumps({
-                        "error": "User Not Found",
-                        "message": f"Could not find any user with the name '{username}'."
-                    })
-    except Exception as e:
-        return f"Error searching for user: {e}"
 
 
 # --- MODIFICATION START: create_task tool is updated ---
 @function_tool
 async def create_task(
+    ctx: RunContextWrapper[ChatRunContext],
     task_name: str,
     creator_id: str,
     assignee_id: Optional[str] = None,
@@ -182,6 +105,10 @@ async def create_task(
     The 'creator_id' parameter is REQUIRED and must be the Notion ID of the user creating the task.
     The 'children_blocks_json' must be a valid JSON string representing a list of Notion block objects.
     """
+    # The logged-in user and their language come from the run; the arguments
+    # are only used outside a chat turn.
+    creator_id = current_user_id(ctx, creator_id)
+    language = user_language(ctx, language)
     if not creator_id:
         return json.dumps({"error": "Missing Creator ID", "message": "The creator_id is required to create a task."})
 
@@ -206,40 +133,55 @@ async def create_task(
         status = "Not started"
     properties["Status"] = {"status": {"name": status}}
 
-    api_args: Dict[str, Any] = {"parent": {"database_id": TASKS_DATABASE_ID}, "properties": properties}
+    api_args: Dict[str, Any] = {"parent": {"database_id": tasks_database_id(ctx)}, "properties": properties}
     
-    conn = get_db_connection()
-    if isinstance(conn, str):
-        return json.dumps({"error": conn})
+    if children_blocks_json:
+        try:
+            api_args["children"] = json.loads(children_blocks_json)
+        except json.JSONDecodeError:
+            return json.dumps({"error": "Invalid JSON", "message": "The 'children_blocks_json' string was not valid."})
+   
+    try:
+        response = await create_page(**api_args)
+        task_index.record_page(response)
+        # --- THIS IS THE CRITICAL CHANGE ---
+        # Extract only the essential data from the raw response
+        props = response.get("properties", {})
+        
+        task_name_res = props.get("Task", {}).get("title", [{}])[0].get("plain_text", "N/A")
+        status_res = props.get("Status", {}).get("status", {}).get("name", "N/A")
+        due_date_res = props.get("Due Date", {}).get("date", {}).get("start", "N/A")
+        priority_res = props.get("Priority", {}).get("select", {}).get("name", "N/A")
+
+        # Create a clean, simple dictionary with only the data you need
+        simplified_output = {
+            "task_name": task_name_res,
+            "status": status_res,
+            "due_date": due_date_res,
+            "priority": priority_res,
+            "page_id": response.get("id") # It's good practice to include the ID
+        }
+        
+        # --- END OF CRITICAL CHANGE ---
+    except notion_client.APIResponseError as e:
+        return json.dumps({"error": "Notion API Error", "details": str(e)})
+
+    # The assignee is only notified, and the notification recorded, once the page exists.
     try:
         # cursor = conn.cursor(dictionary=True)
         # query = "SELECT phone_number,username FROM Users WHERE notion_user_id LIKE %s"
         # cursor.execute(query, (f"{assignee_id}",))
         # user = cursor.fetchone()
         # cursor.close()
-        async for conn in get_db_connection():  # get AsyncSession
-                            user = await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT phone_number,username FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{assignee_id}%"},
-                                                        fetch_one=True
-                            )
         # cursor = conn.cursor(dictionary=True)
         # creator_query = "SELECT phone_number,username FROM Users WHERE notion_user_id LIKE %s"
         # cursor.execute(creator_query, (f"{creator_id}",))
         # creator_user = cursor.fetchone()
         # cursor.close()
-        async for conn in get_db_connection():  # get AsyncSession
-                            creator_user = await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT phone_number,username FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{creator_id}%"},
-                                                        fetch_one=True
-                            )
+        # Assignee and creator are resolved together in one indexed query.
+        users = await get_users_by_notion_ids([assignee_id, creator_id])
+        user = users.get(assignee_id)
+        creator_user = users.get(creator_id)
         print(user)
         print(user['username'])
         print(creator_user['username'])
@@ -248,7 +190,7 @@ async def create_task(
         # """
         ai_response = ""
 
-        if language == 'Russian':
+        if language == 'ru':
             if creator_user['username'] == user['username']:
                 assigner_text = "Вы"
             else:
@@ -256,7 +198,7 @@ async def create_task(
 
             ai_response = f"""Здравствуйте, {user['username']}. *{assigner_text}* только что назначил(а) вам эту задачу: *_{task_name}_*. Это задача с приоритетом *{priority}*. Вам необходимо выполнить её до *{due_date}*.\n*1.{task_name}*\n> Срок выполнения: {due_date}\n> Приоритет: {priority}\n> Статус: {status}\n> Назначил(а): {creator_user['username']}"""
 
-        elif language == 'Azerbaijani':
+        elif language == 'az':
             if creator_user['username'] == user['username']:
                 assigner_text = "Siz"
             else:
@@ -273,25 +215,14 @@ async def create_task(
             ai_response = f"""Hi {user['username']}. *{assigner_text}* just assigned this task *_{task_name}_* to you. This is a *{priority}* priority task, so you will need to complete it by *{due_date}*.\n*1.{task_name}*\n> Due date: {due_date}\n> Priority: {priority}\n> Status: {status}\n> Assigned by: {creator_user['username']}"""
         print(ai_response)
         print(creator_id != assignee_id)
-        if(creator_id != assignee_id):
-            print(user['phone_number'], ai_response)
-            await send_whatsapp_message(user['phone_number'], ai_response)
         # cursor = conn.cursor()
-        notification_id = str(uuid.uuid4())
+        notification_id = new_id()
         # print(notion_id)
         # query_for_changer = "SELECT user_id FROM Users WHERE notion_user_id LIKE %s"
         # cursor.execute(query_for_changer, (f"%{creator_id}%",))
         # new_notion_id = cursor.fetchone()
         # cursor.close()
-        async for conn in get_db_connection():  # get AsyncSession
-                            new_notion_id = await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT user_id FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{creator_id}%"},
-                                                        fetch_one=True
-                            )
+        new_notion_id = creator_user
         # cursor = conn.cursor()
         print(new_notion_id)
         # query_for_changer = "SELECT user_id FROM Users WHERE notion_user_id LIKE %s"
@@ -299,20 +230,11 @@ async def create_task(
         # new_message_assignee_id = cursor.fetchone()
         # cursor.close()
         # cursor = conn.cursor()
-        async for conn in get_db_connection():  # get AsyncSession
-                            new_message_assignee_id = await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT user_id FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{assignee_id}%"},
-                                                        fetch_one=True
-                            )
+        new_message_assignee_id = user
         print(new_notion_id)
         print(assignee_id)
-        client  = OpenAI()
-        new_thread = client.beta.threads.create()
-        new_thread_id = new_thread.id
+        # Local time-ordered id; no OpenAI thread is needed for our own Threads row.
+        new_thread_id = new_id()
         if(creator_id != assignee_id):
             print("INSERT INTO notifications(notification_id,receiver_id,sender_id,title) Values(%s,%s,%s,%s)",(f"{notification_id}",f"{creator_id}",f"{assignee_id}",f"{notification_id}",))
         #     cursor.execute("""INSERT INTO `threads`
@@ -328,57 +250,27 @@ async def create_task(
         #     cursor = conn.cursor()
         #     cursor.execute("INSERT INTO notifications(notification_id,receiver_id,sender_id,title,thread_id) Values(%s,%s,%s,%s,%s)",(list(notification_id)[0],new_message_assignee_id[0],new_notion_id[0],ai_response,new_thread_id,))
             # cursor.close()
-            async for conn in get_db_connection():  # get AsyncSession
-                await execute_query(
-                                                        conn,
-                                                        """
-                                                        INSERT INTO threads (thread_id, title, type) VALUES (:thread_id,:title,:type)
-                                                        """,
-                                                        {"thread_id":new_thread_id,"title":list(notification_id)[0],"type":"web"},
-                                                        fetch_one=True
-                )
-            async for conn in get_db_connection():  # get AsyncSession
-                await execute_query(
-                                                        conn,
-                                                        """
-                                                        INSERT INTO notifications(notification_id, receiver_id, sender_id, title, thread_id) VALUES (:notification_id,:receiver_id,:sender_id,:title,:thread_id)
-                                                        """,
-                                                        {"notification_id":list(notification_id)[0], "receiver_id":new_message_assignee_id['user_id'], "sender_id":new_notion_id['user_id'], "title":ai_response, "thread_id":new_thread_id},
-                                                        fetch_one=True
-                )
+            async with unit_of_work():  # thread, notification and WhatsApp job in one commit
+                async for conn in get_db_connection():  # get AsyncSession
+                    await execute_query(
+                        conn,
+                        "INSERT INTO threads (thread_id, title, type) VALUES (:thread_id, :title, :type)",
+                        {"thread_id": new_thread_id, "title": notification_id, "type": "web"},
+                        fetch_one=False
+                    )
+                    await execute_query(
+                        conn,
+                        "INSERT INTO notifications (notification_id, receiver_id, sender_id, title, thread_id) VALUES (:notification_id, :receiver_id, :sender_id, :title, :thread_id)",
+                        {"notification_id": notification_id, "receiver_id": new_message_assignee_id['user_id'], "sender_id": new_notion_id['user_id'], "title": ai_response, "thread_id": new_thread_id},
+                        fetch_one=False
+                    )
+                # Queued with the rows, so the message goes out only if they commit.
+                await dispatch_whatsapp_message(user['phone_number'], ai_response)
     except Exception as e:
         print("Exception",e)     
-    if children_blocks_json:
-        try:
-            api_args["children"] = json.loads(children_blocks_json)
-        except json.JSONDecodeError:
-            return json.dumps({"error": "Invalid JSON", "message": "The 'children_blocks_json' string was not valid."})
-   
-    try:
-        response = notion.pages.create(**api_args)
-        # --- THIS IS THE CRITICAL CHANGE ---
-        # Extract only the essential data from the raw response
-        props = response.get("properties", {})
-        
-        task_name_res = props.get("Task", {}).get("title", [{}])[0].get("plain_text", "N/A")
-        status_res = props.get("Status", {}).get("status", {}).get("name", "N/A")
-        due_date_res = props.get("Due Date", {}).get("date", {}).get("start", "N/A")
-        priority_res = props.get("Priority", {}).get("select", {}).get("name", "N/A")
 
-        # Create a clean, simple dictionary with only the data you need
-        simplified_output = {
-            "task_name": task_name_res,
-            "status": status_res,
-            "due_date": due_date_res,
-            "priority": priority_res,
-            "page_id": response.get("id") # It's good practice to include the ID
-        }
-        
-        # Return the simplified dictionary as a JSON string
-        return json.dumps(simplified_output, indent=2)
-        # --- END OF CRITICAL CHANGE ---
-    except notion_client.APIResponseError as e:
-        return json.dumps({"error": "Notion API Error", "details": str(e)})
+    # Return the simplified dictionary as a JSON string
+    return to_tool_json("create_task", simplified_output, raw=response)
 # --- MODIFICATION END ---
 
 
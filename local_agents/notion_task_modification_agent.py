@@ -1,35 +1,38 @@
 #local_agents\notion_task_modification_agent.py
 import os
 import json
-import uuid
 from dotenv import load_dotenv
 import notion_client
-from agents import Agent, function_tool, handoff
+from agents import Agent, RunContextWrapper, function_tool, handoff
 from model.response_agent_input import ResponseAgentInput
 import mysql.connector
 from datetime import date, timedelta
 from typing import List, Dict, Optional
 
-from openai import OpenAI
-from db import get_db_connection
+from db import get_db_connection, unit_of_work
 from utils.db_helper import execute_query
-from utils.whatsapp_utils import send_whatsapp_message
+from utils.id_generator import new_id
+from services.outbound_dispatcher import dispatch_whatsapp_message
+from services.notion_gateway import notion, retrieve_page, update_page, archive_page, query_database_rows
+from utils.notion_projection import project_block, project_list, project_page, project_task, projection_sampled, to_tool_json
+from services.task_index import task_index
+from services.user_directory import get_users_by_notion_ids
 import difflib
 
 from local_agents.notion_response_agent import notion_response_agent
+from local_agents.run_context import ChatRunContext, current_user_id, tasks_database_id, user_language
+from local_agents.user_tools import get_notion_user_id_from_name
 
 # --- SETUP ---
 load_dotenv()
 NOTION_API_KEY = os.getenv("NOTION_API_KEY")
 TASKS_DATABASE_ID = os.getenv("NOTION_TASKS_DATABASE_ID")
+FIND_TASKS_MAX_ROWS = int(os.getenv("FIND_TASKS_MAX_ROWS", "500"))
 
 # Validate that the required environment variables are set
 if not all([NOTION_API_KEY, TASKS_DATABASE_ID]):
     raise ValueError("One or more required environment variables are missing: NOTION_API_KEY, TASKS_DATABASE_ID")
 
-# Initialize the Notion client
-notion = notion_client.Client(auth=NOTION_API_KEY)
-
 def manage_response_agent_handoff(context, input: ResponseAgentInput):
     """
     Handles the response agent handoff by processing the specialist tool output
@@ -39,93 +42,53 @@ def manage_response_agent_handoff(context, input: ResponseAgentInput):
     
 
 @function_tool
-def find_tasks(filter_json: Optional[str] = None) -> str:
+async def find_tasks(ctx: RunContextWrapper[ChatRunContext], filter_json: Optional[str] = None) -> str:
     """
     Finds and retrieves a list of tasks from the Notion database based on a JSON filter.
     Use this to find a task's ID when the user provides its name.
     """
     try:
-        query_params: Dict = {"database_id": TASKS_DATABASE_ID}
+        filter = None
         if filter_json:
-            query_params["filter"] = json.loads(filter_json)
-            
-        response = notion.databases.query(**query_params)
-        return json.dumps(response, indent=2)
+            filter = json.loads(filter_json)
+
+        # Follows every page of results (up to FIND_TASKS_MAX_ROWS) and keeps
+        # only the task fields the agents read.
+        # Raw pages are only kept when this call measures the projection.
+        sampled = projection_sampled()
+        raw_rows: List[Dict] = []
+        def project(page):
+            if sampled:
+                raw_rows.append(page)
+            return project_task(page)
+        response = await query_database_rows(tasks_database_id(ctx), filter=filter, max_rows=FIND_TASKS_MAX_ROWS, project=project)
+        return to_tool_json("find_tasks", response, raw={"results": raw_rows} if sampled else None, sampled=sampled)
         
     except json.JSONDecodeError:
         return json.dumps({"error": "Invalid JSON", "message": "The filter_json string was not valid JSON."})
     except notion_client.APIResponseError as e:
         return json.dumps({"error": "Notion API Error", "details": str(e)})
 
-@function_tool
-async def get_notion_user_id_from_name(username: str) -> str:
-    """
-    Finds a user's Notion ID. Handles ambiguity by providing options and suggests corrections for misspellings.
-    """
-    # ... (connection logic remains the same)
-    try:
-        async for conn in get_db_connection():
-            # First, try the original query
-            users = await execute_query(
-                conn,
-                """
-                SELECT notion_user_id, username FROM Users WHERE username LIKE :id
-                """,
-                {"id": f"%{username}%"},
-                fetch_one=False
-            )
-
-            if users:
-                # --- EXISTING LOGIC - NO CHANGES NEEDED ---
-                if len(users) == 1:
-                    user = users[0]
-                    return json.dumps({"username": user["username"], "notion_user_id": user["notion_user_id"]})
-                else:
-                    found_names = [user['username'] for user in users]
-                    return json.dumps({
-                        "error": "Ambiguous Name",
-                        "message": "Multiple users found. Ask for clarification.",
-                        "options": found_names
-                    })
-            else:
-                # --- NEW FALLBACK LOGIC FOR MISSPELLINGS ---
-                # If no users were found, fetch all usernames to check for a close match.
-                all_users_records = await execute_query(conn, "SELECT username FROM Users", {}, fetch_one=False)
-                all_usernames = [record['username'] for record in all_users_records]
-                
-                # Find the best single match with a high similarity cutoff (e.g., 0.8)
-                close_matches = difflib.get_close_matches(username, all_usernames, n=1, cutoff=0.8)
-                
-                if close_matches:
-                    # A likely misspelling was found. Return a specific error with the suggestion.
-                    return json.dumps({
-                        "error": "User Not Found With Suggestion",
-                        "message": f"No user found for '{username}', but a similar name was found.",
-                        "suggestion": close_matches[0]
-                    })
-                else:
-                    # No similar name found, return the original generic error.
-                    return json.dumps({
-                        "error": "User Not Found",
-                        "message": f"Could not find any user with the name '{username}'."
-                    })
-    except Exception as e:
-        return f"Error searching for user: {e}"
     
 @function_tool
-async def update_task_properties(task_page_id: str, properties_to_update_json: str,notion_id:str,language:str) -> str:
+async def update_task_properties(ctx: RunContextWrapper[ChatRunContext], task_page_id: str, properties_to_update_json: str,notion_id:str,language:str) -> str:
     """
     Updates specific METADATA PROPERTIES of an existing task page (e.g., Status, Assignee, Due Date).
     This tool CANNOT change the text content inside the page body.
     The 'properties_to_update_json' must be a valid JSON string.
     Example for updating status: '{"Status": {"status": {"name": "In Progress"}}}'
     """
+    # The logged-in user and their language come from the run; the arguments
+    # are only used outside a chat turn.
+    notion_id = current_user_id(ctx, notion_id)
+    language = user_language(ctx, language)
     if not task_page_id:
         return json.dumps({"error": "Missing Task Page ID", "message": "The ID of the task page to update is required."})
     try:
         properties = json.loads(properties_to_update_json)
-        get_task_details = notion.pages.retrieve(page_id=task_page_id)
-        response = notion.pages.update(page_id=task_page_id, properties=properties)
+        get_task_details = await retrieve_page(task_page_id)
+        response = await update_page(task_page_id, properties=properties)
+        task_index.record_page(response)
         # for details in get_task_details['properties']:
         #     print(f"{details} is {get_task_details['properties'][details]}")
         #     print(details)
@@ -134,44 +97,44 @@ async def update_task_properties(task_page_id: str, properties_to_update_json: s
         print(task_name)
         try:
             # print(get_task_details['properties'])
-            username = notion.users.retrieve(notion_id)['name']
+            username = (await notion.users.retrieve(notion_id))['name']
             print(username)
-            if language == 'Russian':
+            if language == 'ru':
                 message = f"*{username}* обновил(а) свойства в *{task_name}*.\n"
-            elif language == 'Azerbaijani':
+            elif language == 'az':
                 message = f"*{username}* *{task_name}* tapşırığında xüsusiyyətləri yenilədi.\n"
             else:
                 message = f"*{username}* updated property in *{task_name or not_applicable}*.  \n"
             
             for property in properties:
                 if(property == "Assignee"):
-                    if language == 'Russian':
+                    if language == 'ru':
                         message += f"""> Исполнитель\n> *{get_task_details['properties']['Assignee']['people'][0]['name'] or not_applicable}* -> *You*\n"""
-                    elif language == 'Azerbaijani':
+                    elif language == 'az':
                         message += f"""> İcraçı\n> *{get_task_details['properties']['Assignee']['people'][0]['name'] or not_applicable}* -> *You*\n"""
                     else:
                         message += f"""> Assignee\n> *{get_task_details['properties']['Assignee']['people'][0]['name'] or not_applicable}* -> *You*\n"""
                     print(properties[property]['people'][0] or not_applicable)
                 if(property == "Due Date"):
-                    if language == 'Russian':
+                    if language == 'ru':
                         message += f"""> Срок выполнения\n> *{get_task_details['properties']['Due Date']['date']['start'] or not_applicable}* -> *{properties[property]['date']['start'] or not_applicable}*\n"""
-                    elif language == 'Azerbaijani':
+                    elif language == 'az':
                         message += f"""> Son Tarix\n> *{get_task_details['properties']['Due Date']['date']['start'] or not_applicable}* -> *{properties[property]['date']['start'] or not_applicable}*\n"""
                     else:
                         message += f"""> Due Date\n> *{get_task_details['properties']['Due Date']['date']['start'] or not_applicable}* -> *{properties[property]['date']['start'] or not_applicable}*\n"""
                     print(properties[property]['date']['start'] or not_applicable)
                 if(property == "Status"):
-                    if language == 'Russian':
+                    if language == 'ru':
                         message += f"""> Статус\n> *{get_task_details['properties']['Status']['status']['name'] or not_applicable}* -> *{properties[property]['status']['name'] or not_applicable}*\n"""
-                    elif language == 'Azerbaijani':
+                    elif language == 'az':
                         message += f"""> Status\n> *{get_task_details['properties']['Status']['status']['name'] or not_applicable}* -> *{properties[property]['status']['name'] or not_applicable}*\n"""
                     else:
                         message += f"> Status\n> *{get_task_details['properties']['Status']['status']['name'] or not_applicable}* -> *{properties[property]['status']['name'] or not_applicable}*\n"
                     print(properties[property]['status']['name'] or not_applicable)
                 if(property == "Priority"):
-                    if language == 'Russian':
+                    if language == 'ru':
                         message += f"""> Приоритет\n> *{get_task_details['properties']['Priority']['select']['name'] or not_applicable}* -> *{properties[property]['select']['name'] or not_applicable}* \n"""
-                    elif language == 'Azerbaijani':
+                    elif language == 'az':
                         message += f"""> Prioritet\n> *{get_task_details['properties']['Priority']['select']['name'] or not_applicable}* -> *{properties[property]['select']['name'] or not_applicable}* \n"""
                     else:
                         message += f"> Priority\n> *{get_task_details['properties']['Priority']['select']['name'] or not_applicable}* -> *{properties[property]['select']['name'] or not_applicable}* \n"
@@ -190,89 +153,54 @@ async def update_task_properties(task_page_id: str, properties_to_update_json: s
             # cursor.execute(query_for_phone_number, (f"%{message_assignee_id}%",))
             # phone_number = cursor.fetchone()
             # cursor.close()
-            async for conn in get_db_connection():  # get AsyncSession
-                            phone_number = await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT phone_number FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{message_assignee_id}%"},
-                                                        fetch_one=True
-                            )
             # cursor = conn.cursor()
             # query_for_changer = "SELECT username FROM Users WHERE notion_user_id LIKE %s"
             # cursor.execute(query_for_changer, (f"%{notion_id}%",))
             # changer = cursor.fetchone()
-            async for conn in get_db_connection():  # get AsyncSession
-                            changer = await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT username FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{notion_id}%"},
-                                                        fetch_one=True
-                            )
+            # Assignee and changer are resolved together in one indexed query.
+            users = await get_users_by_notion_ids([message_assignee_id, notion_id])
+            phone_number = users.get(message_assignee_id)
+            changer = users.get(notion_id)
             print(changer)
             # cursor.close()
             print(phone_number)
             ai_repsonse = f"{message}"
-            if(notion_id != message_assignee_id):
-                await send_whatsapp_message(phone_number['phone_number'],ai_repsonse)
             # cursor = conn.cursor()
-            notification_id = {str(uuid.uuid4()),}
+            notification_id = new_id()
             print(notion_id)
             # query_for_changer = "SELECT user_id FROM Users WHERE notion_user_id LIKE %s"
             # cursor.execute(query_for_changer, (f"%{notion_id}%",))
             # new_notion_id = cursor.fetchone()
-            async for conn in get_db_connection():  # get AsyncSession
-                            new_notion_id = await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT user_id FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {"id":f"%{notion_id}%"},
-                                                        fetch_one=True
-                            )
+            new_notion_id = changer
             print(new_notion_id)
             # query_for_changer = "SELECT user_id FROM Users WHERE notion_user_id LIKE %s"
             # cursor.execute(query_for_changer, (f"%{message_assignee_id}%",))
             # new_message_assignee_id = cursor.fetchone()
             # cursor.close()
-            async for conn in get_db_connection():  # get AsyncSession
-                            new_message_assignee_id = await execute_query(
-                                                        conn,
-                                                        """
-                                                        SELECT user_id FROM Users WHERE notion_user_id LIKE :id
-                                                        """,
-                                                        {f"%{message_assignee_id}%"},
-                                                        fetch_one=True
-                            )
+            new_message_assignee_id = phone_number
             # cursor = conn.cursor()
             print(new_notion_id)
             # print(message_assignee_id)
-            client  = OpenAI()
-            new_thread = client.beta.threads.create()
-            new_thread_id = new_thread.id
+            # Local time-ordered id; no OpenAI thread is needed for our own Threads row.
+            new_thread_id = new_id()
             print("INSERT INTO notifications(notification_id,sender_id,receiver_id,title) Values(%s,%s,%s,%s)",(f"{notification_id}",f"{notion_id}",f"{message_assignee_id}",f"{notification_id}",))
-            if new_message_assignee_id[0]!=new_notion_id[0]:
-                async for conn in get_db_connection():  # get AsyncSession
-                            await execute_query(
-                                                        conn,
-                                                        """
-                                                        INSERT INTO threads (thread_id, title, type) VALUES (:thread_id,:title,:type)
-                                                        """,
-                                                        {"thread_id":new_thread_id,"title":list(notification_id)[0],"type":"web"},
-                                                        fetch_one=True
-                            )
-                async for conn in get_db_connection():  # get AsyncSession
-                            await execute_query(
-                                                        conn,
-                                                        """
-                                                        INSERT INTO notifications(notification_id, receiver_id, sender_id, title, thread_id) VALUES (:notification_id,:receiver_id,:sender_id,:title,:thread_id)
-                                                        """,
-                                                        {"notification_id":list(notification_id)[0], "receiver_id":new_message_assignee_id['user_id'], "sender_id":new_notion_id['user_id'], "title":ai_repsonse, "thread_id":new_thread_id},
-                                                        fetch_one=True
-                            )
+            if new_message_assignee_id['user_id'] != new_notion_id['user_id']:
+                async with unit_of_work():  # thread, notification and WhatsApp job in one commit
+                    async for conn in get_db_connection():  # get AsyncSession
+                        await execute_query(
+                            conn,
+                            "INSERT INTO threads (thread_id, title, type) VALUES (:thread_id, :title, :type)",
+                            {"thread_id": new_thread_id, "title": notification_id, "type": "web"},
+                            fetch_one=False
+                        )
+                        await execute_query(
+                            conn,
+                            "INSERT INTO notifications (notification_id, receiver_id, sender_id, title, thread_id) VALUES (:notification_id, :receiver_id, :sender_id, :title, :thread_id)",
+                            {"notification_id": notification_id, "receiver_id": new_message_assignee_id['user_id'], "sender_id": new_notion_id['user_id'], "title": ai_repsonse, "thread_id": new_thread_id},
+                            fetch_one=False
+                        )
+                    # Queued with the rows, so the message goes out only if they commit.
+                    await dispatch_whatsapp_message(phone_number['phone_number'], ai_repsonse)
     #             cursor.execute("""INSERT INTO `threads`
     # (`thread_id`,
     # `title`,
@@ -289,12 +217,12 @@ async def update_task_properties(task_page_id: str, properties_to_update_json: s
         except Exception as e:
             print("Exception",e)
         # print(user['phone_number'])
-        return json.dumps(response, indent=2)
+        return to_tool_json("update_task_properties", project_page(response), raw=response)
     except Exception as e:
         return f"Error updating task properties {task_page_id}: {e}"
 
 @function_tool
-def delete_task(task_page_id: str) -> str:
+async def delete_task(task_page_id: str) -> str:
     """
     Deletes a task by archiving its page in Notion. This is a soft delete.
     Requires the ID of the task page to be deleted.
@@ -302,14 +230,15 @@ def delete_task(task_page_id: str) -> str:
     if not task_page_id:
         return json.dumps({"error": "Missing Task Page ID", "message": "The ID of the task page to delete is required."})
     try:
-        response = notion.pages.update(page_id=task_page_id, archived=True)
-        return json.dumps(response, indent=2)
+        response = await archive_page(task_page_id)
+        task_index.record_page(response)
+        return to_tool_json("delete_task", project_page(response), raw=response)
     except Exception as e:
         return f"Error deleting task {task_page_id}: {e}"
 
 # --- NEW TOOL FOR CONTENT MODIFICATION ---
 @function_tool
-def append_content_to_page(page_id: str, children_blocks_json: str) -> str:
+async def append_content_to_page(page_id: str, children_blocks_json: str) -> str:
     """
     Appends new content blocks (like paragraphs, to-do lists, or headings) to the BODY of a specific page.
     Use this tool when the user asks to add or list text, todos, or other content inside the task page itself.
@@ -320,8 +249,8 @@ def append_content_to_page(page_id: str, children_blocks_json: str) -> str:
     try:
         # The input is a JSON string, which needs to be parsed into a Python list of block objects.
         children_blocks: List[Dict] = json.loads(children_blocks_json)
-        response = notion.blocks.children.append(block_id=page_id, children=children_blocks)
-        return json.dumps(response, indent=2)
+        response = await notion.blocks.children.append(block_id=page_id, children=children_blocks)
+        return to_tool_json("append_content_to_page", project_list(response, project_block), raw=response)
     except Exception as e:
         return f"Error appending content to page {page_id}: {e}"
 
@@ -384,7 +313,7 @@ You are a notion task modification agent. Your primary function is to execute to
                 ACTION_TYPE: TasksRetrieved
                 LANGUAGE: en
                 ORIGINAL_QUERY: (language='en') list my tasks for this week [Notion_Task_Retrieval_Agent]
-                TOOL_OUTPUT: {{"results": [{{"id": "task-id-1", "properties": {{"Task": {{"title": [{{"plain_text": "Review overdue items"}}]}}, "Due Date": {{"date": {{"start": "2025-09-19"}}}}, "Priority": {{"select": {{"name": "High"}}}}, "Assignee": {{...}} }} }}, {{"id": "task-id-2", "properties": {{...}} }}]}}
+                TOOL_OUTPUT: {{"results":[{{"id":"task-id-1","url":"...","Task":"Review overdue items","Status":"In progress","Due Date":"2025-09-19","Priority":"High","Assignee":[...]}},{{"id":"task-id-2",...}}],"count":2,"truncated":false}}
         ####
                 
         #### **Multi-Query Scenario**
@@ -393,7 +322,7 @@ You are a notion task modification agent. Your primary function is to execute to
                 ACTION_TYPE: TasksRetrieved
                 LANGUAGE: en
                 ORIGINAL_QUERY: (language='en') Show me my tasks for today [Notion_Task_Retrieval_Agent] and then remind me to call Anna [Reminder_Agent]
-                TOOL_OUTPUT: {{"results": [{{"id": "task-id-3", "properties": {{"Task": {{"title": [{{"plain_text": "Finalize report"}}]}}, "Due Date": {{"date": {{"start": "2025-09-21"}}}}, "Priority": {{"select": {{"name": "High"}}}}, "Assignee": {{...}} }} }}]}}
+                TOOL_OUTPUT: {{"results":[{{"id":"task-id-3","url":"...","Task":"Finalize report","Status":"Not started","Due Date":"2025-09-21","Priority":"High","Assignee":[...]}}],"count":1,"truncated":false}}
         ####
     ###
 ###
@@ -501,7 +430,7 @@ You are a notion task modification agent. Your primary function is to execute to
     - **Current Date:** `{date.today().isoformat()}`
     - **Logged-in User ID:** `{{logged_in_user_id}}`
     - **Database ID:** `{{database_id}}`
-    - **[task name]:** Extract the task name from the successful tool call's JSON response (`properties.Name.title[0].plain_text`).
+    - **[task name]:** Extract the task name from the successful tool call's JSON response (`properties.Task`).
 ###
 """,
     tools=[
@@ -1,29 +1,31 @@
 import os
 import json
 from dotenv import load_dotenv
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 from datetime import date
 import notion_client
-from agents import Agent, function_tool, handoff
+from agents import Agent, RunContextWrapper, function_tool, handoff
 
 from model.response_agent_input import ResponseAgentInput
 from utils.db_helper import execute_query
 from db import get_db_connection
+from services.notion_gateway import query_database_rows
+from utils.notion_projection import project_task, projection_sampled, to_tool_json
 import difflib
 
 # --- SETUP ---
 load_dotenv()
 NOTION_API_KEY = os.getenv("NOTION_API_KEY")
 TASKS_DATABASE_ID = os.getenv("NOTION_TASKS_DATABASE_ID")
+FIND_TASKS_MAX_ROWS = int(os.getenv("FIND_TASKS_MAX_ROWS", "500"))
 
 # Validate that the required environment variables are set
 if not all([NOTION_API_KEY, TASKS_DATABASE_ID]):
     raise ValueError("One or more required environment variables are missing: NOTION_API_KEY, TASKS_DATABASE_ID")
 
-# Initialize the Notion client
-notion = notion_client.Client(auth=NOTION_API_KEY)
-
 from local_agents.notion_response_agent import notion_response_agent
+from local_agents.run_context import ChatRunContext, tasks_database_id
+from local_agents.user_tools import get_notion_user_id_from_name
 
 # --- AGENT TOOLS ---
 
@@ -34,78 +36,33 @@ def manage_response_agent_handoff(context, input: ResponseAgentInput):
     """
     print("response agent start") 
 
-@function_tool
-async def get_notion_user_id_from_name(username: str) -> str:
-    """
-    Finds a user's Notion ID. Handles ambiguity by providing options and suggests corrections for misspellings.
-    """
-    # ... (connection logic remains the same)
-    try:
-        async for conn in get_db_connection():
-            # First, try the original query
-            users = await execute_query(
-                conn,
-                """
-                SELECT notion_user_id, username FROM Users WHERE username LIKE :id
-                """,
-                {"id": f"%{username}%"},
-                fetch_one=False
-            )
-
-            if users:
-                # --- EXISTING LOGIC - NO CHANGES NEEDED ---
-                if len(users) == 1:
-                    user = users[0]
-                    return json.dumps({"username": user["username"], "notion_user_id": user["notion_user_id"]})
-                else:
-                    found_names = [user['username'] for user in users]
-                    return json.dumps({
-                        "error": "Ambiguous Name",
-                        "message": "Multiple users found. Ask for clarification.",
-                        "options": found_names
-                    })
-            else:
-                # --- NEW FALLBACK LOGIC FOR MISSPELLINGS ---
-                # If no users were found, fetch all usernames to check for a close match.
-                all_users_records = await execute_query(conn, "SELECT username FROM Users", {}, fetch_one=False)
-                all_usernames = [record['username'] for record in all_users_records]
-                
-                # Find the best single match with a high similarity cutoff (e.g., 0.8)
-                close_matches = difflib.get_close_matches(username, all_usernames, n=1, cutoff=0.8)
-                
-                if close_matches:
-                    # A likely misspelling was found. Return a specific error with the suggestion.
-                    return json.dumps({
-                        "error": "User Not Found With Suggestion",
-                        "message": f"No user found for '{username}', but a similar name was found.",
-                        "suggestion": close_matches[0]
-                    })
-                else:
-                    # No similar name found, return the original generic error.
-                    return json.dumps({
-                        "error": "User Not Found",
-                        "message": f"Could not find any user with the name '{username}'."
-                    })
-    except Exception as e:
-        return f"Error searching for user: {e}"
 
 
 @function_tool
-def find_tasks(database_id:str,filter_json: Optional[str] = None) -> str:
+async def find_tasks(ctx: RunContextWrapper[ChatRunContext], database_id:str,filter_json: Optional[str] = None) -> str:
     """
     Finds and retrieves a list of tasks from the Notion database based on a JSON filter.
     This is the primary tool for all task search and retrieval queries.
     """
+    # The department's database from the run wins over the id the model copied from the prompt.
+    database_id = tasks_database_id(ctx, database_id)
     try:
-        print(database_id)
-        response = ""
-        query_params: Dict = {"database_id": database_id}
+        filter = None
         if filter_json:
             # The agent will construct this JSON string based on user input.
-            query_params["filter"] = json.loads(filter_json)
-            
-        response = notion.databases.query(**query_params)
-        return json.dumps(response, indent=2)
+            filter = json.loads(filter_json)
+
+        # Follows every page of results (up to FIND_TASKS_MAX_ROWS) and keeps
+        # only the task fields the agents read.
+        # Raw pages are only kept when this call measures the projection.
+        sampled = projection_sampled()
+        raw_rows: List[Dict] = []
+        def project(page):
+            if sampled:
+                raw_rows.append(page)
+            return project_task(page)
+        response = await query_database_rows(database_id, filter=filter, max_rows=FIND_TASKS_MAX_ROWS, project=project)
+        return to_tool_json("find_tasks", response, raw={"results": raw_rows} if sampled else None, sampled=sampled)
         
     except json.JSONDecodeError:
         return json.dumps({"error": "Invalid JSON", "message": "The filter_json string was not valid JSON."})
@@ -161,7 +118,7 @@ You are a notion task retrieval agent. Your entire response **MUST** be through
                     ACTION_TYPE: TasksRetrieved
                     LANGUAGE: en
                     ORIGINAL_QUERY: (language='en') Show me my tasks for this week [Notion_Task_Retrieval_Agent]
-                    TOOL_OUTPUT: {{"results": [{{"id": "task-id-1", "properties": {{"Task": {{"title": [{{"plain_text": "Review overdue items"}}]}}, "Due Date": {{"date": {{"start": "2025-09-19"}}}}, "Priority": {{"select": {{"name": "High"}}}}, "Created by": {{"people": [{{"name": "John Doe"}}]}} }} }}, {{"id": "task-id-2", "properties": {{...}} }}]}}
+                    TOOL_OUTPUT: {{"results":[{{"id":"task-id-1","url":"...","Task":"Review overdue items","Status":"In progress","Due Date":"2025-09-19","Priority":"High","Assignee":["John Doe"],"Created by":["John Doe"]}},{{"id":"task-id-2",...}}],"count":2,"truncated":false}}
         
         **Multi-Query Scenario:**        
             -   **Query Received:** `(language='en') Show me my high-priority tasks [Notion_Task_Retrieval_Agent] and then create a task to "Review them" [Notion_Task_Creation_Agent]`
@@ -169,7 +126,7 @@ You are a notion task retrieval agent. Your entire response **MUST** be through
                 ACTION_TYPE: TasksRetrieved
                 LANGUAGE: en
                 ORIGINAL_QUERY: (language='en') Show me my high-priority tasks [Notion_Task_Retrieval_Agent] and then create a task to "Review them" [Notion_Task_Creation_Agent]
-                TOOL_OUTPUT: {{"results": [{{"id": "task-id-A", "properties": {{"Task": {{"title": [{{"plain_text": "Finalize Q4 budget"}}]}}, "Due Date": {{"date": {{"start": "2025-09-22"}}}}, "Priority": {{"select": {{"name": "High"}}}}, "Created by": {{"people": [{{"name": "Jane Doe"}}]}} }} }}, {{"id": "task-id-B", "properties": {{...}} }}]}}
+                TOOL_OUTPUT: {{"results":[{{"id":"task-id-A","url":"...","Task":"Finalize Q4 budget","Status":"Not started","Due Date":"2025-09-22","Priority":"High","Assignee":["Jane Doe"],"Created by":["Jane Doe"]}},{{"id":"task-id-B",...}}],"count":2,"truncated":false}}
     ###            
 ###
     
@@ -261,10 +218,10 @@ You are a notion task retrieval agent. Your entire response **MUST** be through
     - **Current Time:** `{{current_time}}`  (provided in prompt context)
     - **Logged-in User ID:** `{{logged_in_user_id}}`
     - **Database ID:** `{{database_id}}`
-    - **Task Name:** from `results[n].properties.Name.title[0].plain_text`
-    - **Due Date:** from `results[n].properties['Due Date'].date.start`
-    - **Priority:** from `results[n].properties.Priority.select.name`
-    - **Assigned by:** from `results[n].properties['Created by'].people[0].name` (Use "N/A" if this field is empty)
+    - **Task Name:** from `results[n].Task`
+    - **Due Date:** from `results[n]['Due Date']`
+    - **Priority:** from `results[n].Priority`
+    - **Assigned by:** from `results[n]['Created by'][0]` (Use "N/A" if this field is empty)
 ###
 """,
     # The agent is given only the tools it needs to do its job.
@@ -2,14 +2,14 @@
 import os
 import json
 from dotenv import load_dotenv
-import notion_client
 from agents import Agent, function_tool, handoff
 
 from model.response_agent_input import ResponseAgentInput
+from services.notion_gateway import notion
+from utils.notion_projection import project_list, project_user, to_tool_json
 
 # --- SETUP ---
 load_dotenv()
-notion = notion_client.Client(auth=os.getenv("NOTION_API_KEY"))
 
 from local_agents.notion_response_agent import notion_response_agent
 
@@ -23,32 +23,27 @@ def manage_response_agent_handoff(context, input: ResponseAgentInput):
     print("response agent start") 
 
 @function_tool
-def list_all_users() -> str:
+async def list_all_users() -> str:
     """
     Retrieves a paginated list of all HUMAN users (people) in the Notion workspace. This tool automatically excludes all bots and integrations.
     """
     try:
-        response = notion.users.list()
+        response = await notion.users.list()
         all_users = response.get("results", [])
         
         # --- MODIFICATION START: Filter out bots ---
         person_users = [user for user in all_users if user.get("type") == "person"]
         
         # Create a new response object containing only the filtered users
-        filtered_response = {
-            "object": "list",
-            "results": person_users,
-            "next_cursor": response.get("next_cursor"),
-            "has_more": response.get("has_more")
-        }
+        filtered_response = project_list({**response, "results": person_users}, project_user)
         # --- MODIFICATION END ---
         
-        return json.dumps(filtered_response, indent=2)
+        return to_tool_json("list_all_users", filtered_response, raw={**response, "results": person_users})
     except Exception as e:
         return f"Error listing users: {e}"
 
 @function_tool
-def find_user_by_name(name: str) -> str:
+async def find_user_by_name(name: str) -> str:
     """
     Finds a single user by their exact display name (case-insensitive) and returns their full user object.
     This is a high-level tool that first lists all users and then searches the results.
@@ -57,13 +52,13 @@ def find_user_by_name(name: str) -> str:
     if not name:
         return json.dumps({"error": "Missing Name", "message": "I need the name of the user you want to find. What is their name?"})
     try:
-        all_users_response = notion.users.list()
+        all_users_response = await notion.users.list()
         all_users = all_users_response.get("results", [])
         
         found_user = next((user for user in all_users if user.get("name", "").lower() == name.lower()), None)
         
         if found_user:
-            return json.dumps(found_user, indent=2)
+            return to_tool_json("find_user_by_name", project_user(found_user), raw=found_user)
         else:
             return json.dumps({"error": "User not found", "message": f"No user with the name '{name}' was found in the workspace."})
             
@@ -71,23 +66,23 @@ def find_user_by_name(name: str) -> str:
         return f"Error finding user by name: {e}"
 
 @function_tool
-def retrieve_user_by_id(user_id: str) -> str:
+async def retrieve_user_by_id(user_id: str) -> str:
     """Retrieves detailed information about a single user by their unique ID."""
     # Added Block: Check for missing user_id.
     if not user_id:
         return json.dumps({"error": "Missing User ID", "message": "I need the ID of the user you want to retrieve. What is their ID?"})
     try:
-        response = notion.users.retrieve(user_id=user_id)
-        return json.dumps(response, indent=2)
+        response = await notion.users.retrieve(user_id=user_id)
+        return to_tool_json("retrieve_user_by_id", project_user(response), raw=response)
     except Exception as e:
         return f"Error retrieving user {user_id}: {e}"
 
 @function_tool
-def retrieve_bot_info() -> str:
+async def retrieve_bot_info() -> str:
     """Retrieves information about the bot user associated with the current API token."""
     try:
-        response = notion.users.me()
-        return json.dumps(response, indent=2)
+        response = await notion.users.me()
+        return to_tool_json("retrieve_bot_info", project_user(response), raw=response)
     except Exception as e:
         return f"Error retrieving bot user info: {e}"
 
@@ -0,0 +1,91 @@
+# local_agents/run_context.py
+
+import os
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from dotenv import load_dotenv
+
+# --- SETUP ---
+load_dotenv()
+# Fallback for runs without a department (and for tools called outside a run).
+DEFAULT_TASKS_DATABASE_ID = os.getenv("NOTION_TASKS_DATABASE_ID")
+# The languages the agents answer in, by code.
+LANGUAGE_NAMES = {"en": "English", "ru": "Russian", "az": "Azerbaijani"}
+# Letters only the Azerbaijani alphabets use (Latin and Cyrillic).
+_AZERBAIJANI_LETTERS = set("əƏıİğĞәӘҹҸҝҜғҒөӨүҮһҺ")
+
+
+@dataclass
+class ChatRunContext:
+    """
+    Per-turn state handed to every agent and tool through the Agents SDK run
+    context (Runner.run(..., context=...)). Tools read the department's
+    database from here instead of process-wide settings, so turns for
+    different departments can run concurrently in one worker.
+
+    Tools receive it as their first parameter, typed
+    RunContextWrapper[ChatRunContext]; the model never sees it.
+    """
+
+    thread_id: Optional[str] = None
+    database_id: Optional[str] = None       # the department's Notion tasks database
+    notion_user_id: Optional[str] = None    # the logged-in user
+    language: Optional[str] = None          # 'en', 'ru' or 'az' when known up front
+    timezone: Optional[str] = None          # IANA name, e.g. "Asia/Baku"
+
+
+def run_context(ctx: Any) -> ChatRunContext:
+    """The ChatRunContext of a tool's RunContextWrapper, or an empty one outside a chat turn."""
+    context = getattr(ctx, "context", None)
+    return context if isinstance(context, ChatRunContext) else ChatRunContext()
+
+
+def tasks_database_id(ctx: Any, fallback: Optional[str] = None) -> Optional[str]:
+    """
+    The tasks database for this run: the run context's department database,
+    else `fallback` (e.g. an id the model passed in), else the default.
+    """
+    return run_context(ctx).database_id or fallback or DEFAULT_TASKS_DATABASE_ID
+
+
+def current_user_id(ctx: Any, fallback: Optional[str] = None) -> Optional[str]:
+    """The logged-in user's Notion ID from the run context, else `fallback`."""
+    return run_context(ctx).notion_user_id or fallback
+
+
+def user_language(ctx: Any, fallback: Optional[str] = None) -> Optional[str]:
+    """
+    The user's language code ('en', 'ru' or 'az') from the run context, else
+    `fallback`, which may be a code or a name such as 'Russian'.
+    """
+    language = run_context(ctx).language
+    if language:
+        return language
+    value = (fallback or "").strip().lower()
+    for code, name in LANGUAGE_NAMES.items():
+        if value in (code, name.lower()):
+            return code
+    return fallback
+
+
+def detect_language(text: str) -> Optional[str]:
+    """
+    'az', 'ru' or 'en' for a user message, or None when it is not clearly one
+    of them. Azerbaijani and Russian are told apart by their letters; Latin
+    text is checked with langdetect when it is installed.
+    """
+    if not text or not any(ch.isalpha() for ch in text):
+        return None
+    if any(ch in _AZERBAIJANI_LETTERS for ch in text):
+        return "az"
+    if any("\u0400" <= ch <= "\u04ff" for ch in text):
+        return "ru"
+    try:
+        from langdetect import detect, DetectorFactory
+        DetectorFactory.seed = 0
+        return "en" if detect(text) == "en" else None
+    except ImportError:
+        return "en" if text.isascii() else None
+    except Exception:
+        return None
@@ -0,0 +1,40 @@
+# local_agents/user_tools.py
+
+import json
+from agents import function_tool
+
+from services.user_directory import user_directory
+
+
+@function_tool
+async def get_notion_user_id_from_name(username: str) -> str:
+    """
+    Finds a user's Notion ID. Handles ambiguity by providing options and suggests corrections for misspellings.
+    """
+    try:
+        matches = await user_directory.search(username)
+
+        # An exact name wins over names that merely contain it.
+        users = matches["exact"] or matches["partial"]
+        if len(users) == 1:
+            user = users[0]
+            return json.dumps({"username": user["username"], "notion_user_id": user["notion_user_id"]})
+        if users:
+            return json.dumps({
+                "error": "Ambiguous Name",
+                "message": "Multiple users found. Ask for clarification.",
+                "options": [user["username"] for user in users]
+            })
+        if matches["suggestions"]:
+            # A likely misspelling was found. Return a specific error with the suggestion.
+            return json.dumps({
+                "error": "User Not Found With Suggestion",
+                "message": f"No user found for '{username}', but a similar name was found.",
+                "suggestion": matches["suggestions"][0]["username"]
+            })
+        return json.dumps({
+            "error": "User Not Found",
+            "message": f"Could not find any user with the name '{username}'."
+        })
+    except Exception as e:
+        return f"Error searching for user: {e}"
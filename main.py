@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import sys
 from fastapi import Depends, FastAPI, HTTPException,status
@@ -10,6 +11,17 @@ from utils.logging_config import configure_logging
 from schema.graphql_schema import schema
 from strawberry.fastapi import GraphQLRouter
 from routes.webhook import router as webhook_router
+from services.digest_scheduler import digest_scheduler
+from services.idempotency import webhook_idempotency
+from services.job_queue import job_pool, send_pool
+from services.notion_gateway import close_notion_client
+from services.outbound_dispatcher import outbound_dispatcher
+from services.reminder_scheduler import reminder_scheduler
+from services.task_index import run_task_index_sync_loop
+from services.thread_cache import thread_cache
+from services.transcription import transcription_service
+from services.user_directory import user_directory
+from services.whatsapp_client import whatsapp_client
 
 
 load_dotenv(override=True)
@@ -69,6 +81,46 @@ async def startup_event():
 
     logger.info("Logging configured successfully!")
 
+    # Keep the local task index synced in the background; lookups never wait for Notion.
+    app.state.task_index_sync = asyncio.create_task(run_task_index_sync_loop())
+    # Load the user directory now and keep it refreshed for name/phone lookups.
+    app.state.user_directory_refresh = asyncio.create_task(user_directory.run_refresh_loop())
+    # Expire old WhatsApp message ids from the webhook dedup table.
+    app.state.webhook_dedup_prune = asyncio.create_task(webhook_idempotency.run_prune_loop())
+    # Open the pooled Graph API client before any job can send or download.
+    whatsapp_client.start()
+    # Process queued WhatsApp webhook jobs in this instance, and send
+    # outbound WhatsApp messages on a separate pool.
+    job_pool.start()
+    send_pool.start()
+    # Send reminders over WhatsApp when they fall due.
+    app.state.reminder_scheduler = asyncio.create_task(reminder_scheduler.run())
+    # Send scheduled task digests, one WhatsApp message per user.
+    app.state.digest_scheduler = asyncio.create_task(digest_scheduler.run())
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """
+    Stop the job workers, then release shared outbound connection pools on
+    application shutdown.
+    """
+    app.state.reminder_scheduler.cancel()
+    logger.info(f"Reminder scheduler stats: {reminder_scheduler.stats()}")
+    app.state.digest_scheduler.cancel()
+    logger.info(f"Digest scheduler stats: {digest_scheduler.stats()}")
+    await job_pool.stop()
+    await send_pool.stop()
+    logger.info(f"Outbound WhatsApp stats: {outbound_dispatcher.stats()}")
+    app.state.user_directory_refresh.cancel()
+    app.state.task_index_sync.cancel()
+    app.state.webhook_dedup_prune.cancel()
+    logger.info(f"Webhook dedup stats: {webhook_idempotency.stats()}")
+    await close_notion_client()
+    await thread_cache.close()
+    await transcription_service.close()
+    await whatsapp_client.close()
+
 app.include_router(auth.router, prefix="/auth")
 
 app.include_router(chat.router)
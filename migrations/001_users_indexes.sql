@@ -0,0 +1,6 @@
+-- Equality lookups used by services/user_directory.py.
+-- Replaces the `notion_user_id LIKE '%...%'` scans in the agent tools.
+
+CREATE INDEX idx_users_notion_user_id ON Users (notion_user_id);
+CREATE INDEX idx_users_phone_number ON Users (phone_number);
+CREATE INDEX idx_users_username ON Users (username);
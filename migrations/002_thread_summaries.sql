@@ -0,0 +1,14 @@
+-- Rolling per-thread summaries maintained by services/history_manager.py.
+-- summarized_through is the created_at of the newest message folded into the
+-- summary; later messages are kept verbatim.
+
+CREATE TABLE ThreadSummaries (
+    thread_id VARCHAR(255) NOT NULL PRIMARY KEY,
+    summary TEXT NOT NULL,
+    summarized_through DATETIME NOT NULL,
+    message_count INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Incremental history reads: WHERE thread_id = ? AND created_at >= ? ORDER BY created_at.
+CREATE INDEX idx_messages_thread_created ON Messages (thread_id, created_at);
@@ -0,0 +1,33 @@
+-- Durable job queue for WhatsApp webhook processing (services/job_queue.py).
+-- Claiming uses SELECT ... FOR UPDATE SKIP LOCKED, which needs MySQL 8.0+.
+--
+-- available_at doubles as the lease: a claimed job's available_at is moved to
+-- the end of its lease, so a job whose worker died becomes claimable again.
+-- Finished jobs are deleted; jobs that exhaust their attempts are moved to
+-- WebhookJobsDeadLetter.
+
+CREATE TABLE WebhookJobs (
+    job_id VARCHAR(36) NOT NULL PRIMARY KEY,
+    kind VARCHAR(64) NOT NULL,
+    payload JSON NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    attempts INT NOT NULL DEFAULT 0,
+    max_attempts INT NOT NULL DEFAULT 5,
+    available_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    locked_by VARCHAR(64) NULL,
+    last_error TEXT NULL,
+    created_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    updated_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3)
+);
+
+CREATE INDEX idx_webhook_jobs_available ON WebhookJobs (available_at);
+
+CREATE TABLE WebhookJobsDeadLetter (
+    job_id VARCHAR(36) NOT NULL PRIMARY KEY,
+    kind VARCHAR(64) NOT NULL,
+    payload JSON NOT NULL,
+    attempts INT NOT NULL,
+    last_error TEXT NULL,
+    created_at DATETIME(3) NOT NULL,
+    failed_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3)
+);
@@ -0,0 +1,12 @@
+-- WhatsApp message ids that have already been accepted by the webhook
+-- (services/idempotency.py). The primary key makes INSERT IGNORE an atomic
+-- check-and-claim, so a redelivered message is never enqueued twice.
+
+CREATE TABLE ProcessedWebhookMessages (
+    message_id VARCHAR(255) NOT NULL PRIMARY KEY,
+    from_number VARCHAR(32) NULL,
+    received_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3)
+);
+
+-- Retention pruning: DELETE ... WHERE received_at < ?
+CREATE INDEX idx_processed_webhook_messages_received ON ProcessedWebhookMessages (received_at);
@@ -0,0 +1,11 @@
+-- Per-sender ordering for WebhookJobs (services/job_queue.py).
+-- Jobs sharing a lane_key run one at a time in seq order: a job is only
+-- claimable while no job with the same lane_key and a lower seq is left in
+-- the table. Jobs without a lane_key are unordered.
+
+ALTER TABLE WebhookJobs
+    ADD COLUMN lane_key VARCHAR(64) NULL,
+    ADD COLUMN seq BIGINT NOT NULL AUTO_INCREMENT,
+    ADD UNIQUE KEY uq_webhook_jobs_seq (seq);
+
+CREATE INDEX idx_webhook_jobs_lane ON WebhookJobs (lane_key, seq);
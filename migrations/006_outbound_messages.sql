@@ -0,0 +1,22 @@
+-- Outbound WhatsApp messages sent by services/outbound_dispatcher.py, keyed
+-- by the id Graph returns, so `statuses` webhook events can be correlated.
+-- status_rank only moves forward (sent < delivered < read < failed).
+
+CREATE TABLE OutboundMessages (
+    message_id VARCHAR(255) NOT NULL PRIMARY KEY,
+    outbound_id CHAR(36) NOT NULL,
+    recipient VARCHAR(32) NOT NULL,
+    kind VARCHAR(32) NOT NULL,
+    part INT NOT NULL DEFAULT 1,
+    parts INT NOT NULL DEFAULT 1,
+    status VARCHAR(16) NOT NULL,
+    status_rank TINYINT NOT NULL,
+    error TEXT NULL,
+    created_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    updated_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3)
+);
+
+-- All parts of one dispatched message.
+CREATE INDEX idx_outbound_messages_outbound ON OutboundMessages (outbound_id);
+-- Delivery history per recipient.
+CREATE INDEX idx_outbound_messages_recipient ON OutboundMessages (recipient, created_at);
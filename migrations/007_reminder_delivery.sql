@@ -0,0 +1,15 @@
+-- Delivery state for reminders sent by services/reminder_scheduler.py.
+-- A reminder is due at created_at (UTC) and pending while sent_at IS NULL;
+-- lease_owner/lease_expires_at mark a scheduler instance's claim on it.
+
+ALTER TABLE Notifications
+    ADD COLUMN sent_at DATETIME(3) NULL,
+    ADD COLUMN lease_owner VARCHAR(64) NULL,
+    ADD COLUMN lease_expires_at DATETIME(3) NULL;
+
+-- Reminders already past were only ever shown in-app; don't send them now.
+UPDATE Notifications SET sent_at = created_at
+WHERE type = 'reminder' AND created_at <= UTC_TIMESTAMP(3);
+
+-- Range scan for pending reminders due within the scheduler's horizon.
+CREATE INDEX idx_notifications_due ON Notifications (type, sent_at, created_at);
@@ -0,0 +1,31 @@
+-- Recurring reminders and scheduled task digests (utils/recurrence.py,
+-- services/reminder_scheduler.py, services/digest_scheduler.py).
+
+-- A recurring reminder's rule and the IANA timezone its occurrences are
+-- computed in. When one occurrence is sent, the scheduler inserts the next
+-- one as a new row, so each occurrence keeps its own sent_at.
+ALTER TABLE Notifications
+    ADD COLUMN recurrence_rule VARCHAR(255) NULL,
+    ADD COLUMN timezone VARCHAR(64) NULL;
+
+-- One schedule per user and digest kind ('overdue' or 'open'). next_run_at
+-- is UTC and NULL once the schedule is turned off or its rule has ended;
+-- lease_owner/lease_expires_at mark a scheduler instance's claim on it.
+CREATE TABLE DigestSchedules (
+    schedule_id CHAR(36) NOT NULL PRIMARY KEY,
+    user_id VARCHAR(255) NOT NULL,
+    kind VARCHAR(16) NOT NULL,
+    recurrence_rule VARCHAR(255) NOT NULL,
+    timezone VARCHAR(64) NOT NULL,
+    language VARCHAR(8) NOT NULL DEFAULT 'en',
+    next_run_at DATETIME(3) NULL,
+    last_run_at DATETIME(3) NULL,
+    lease_owner VARCHAR(64) NULL,
+    lease_expires_at DATETIME(3) NULL,
+    created_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
+    updated_at DATETIME(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3) ON UPDATE CURRENT_TIMESTAMP(3),
+    UNIQUE KEY uq_digest_schedules_user_kind (user_id, kind)
+);
+
+-- Due schedules, polled by the digest scheduler.
+CREATE INDEX idx_digest_schedules_due ON DigestSchedules (next_run_at);
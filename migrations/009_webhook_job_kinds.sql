@@ -0,0 +1,5 @@
+-- Separate worker pools per job kind (services/job_queue.py): outbound
+-- WhatsApp sends are claimed by their own pool, everything else by the
+-- default pool, so each claim filters on kind as well as available_at.
+
+CREATE INDEX idx_webhook_jobs_kind_available ON WebhookJobs (kind, available_at);
@@ -1,22 +1,26 @@
 from fastapi import APIRouter, HTTPException,Depends, Form, UploadFile, File, WebSocket, WebSocketDisconnect, Query
-from pydub import AudioSegment
-from openai import OpenAI
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
 import io
 import os
+import json
+from contextlib import aclosing
 from typing import List
 from local_agents.notion_supervisor_agent import chatbot_supervisor_agent
 from routes.auth import get_current_user_id, get_user_id_from_token
 from schema.chat_schema import *
-from db import get_db_connection
+from db import get_db_connection, unit_of_work
 from agents import Runner
 from schema.notification_schema import Notification, UpdateNotificationRequest
-from services.chat_handler import handle_chat
-import uuid
+from services.chat_handler import handle_chat, handle_chat_stream
+from services.thread_cache import thread_cache
+from services.transcription import StreamingTranscription, transcribe_audio
+from services.user_directory import get_user_by_id
 import datetime
 from local_agents.notion_whatsapp_supervisor_agent import whatsapp_supervisor_agent
 from utils.db_helper import execute_query
-
-client = OpenAI()
+from utils.id_generator import is_valid_id, new_id
+from utils.formatter import format_db_rows_for_response
 
 router = APIRouter()
 
@@ -24,50 +28,62 @@ router = APIRouter()
 @router.post("/chat/new", response_model=NewChatResponse, tags=["Web Chat"])
 async def start_new_chat(chat_title: str, type: str = "web",user_id: str = Depends(get_current_user_id)):
     try:
-        thread_id = str(uuid.uuid4())
+        thread_id = new_id()
         conn = get_db_connection()
         if not conn: raise HTTPException(status_code=500, detail="Database connection failed")
         # cursor = conn.cursor()
         # cursor.execute("INSERT INTO Threads (thread_id, title, type) VALUES (%s, %s, %s)", (thread_id, chat_title, "web"))
         # conn.commit()
-        async for conn in get_db_connection():  # get AsyncSession
-            await execute_query(
-                                conn,
-                                "INSERT INTO Threads (thread_id, title, type) VALUES (:thread_id, :title, :type)",
-                                {"thread_id": thread_id, "title":chat_title, "type":"web"},
-                                fetch_one=False
-            )
-        # cursor.execute("INSERT INTO UserThread(thread_id,user_id) VALUES (%s, %s)", (thread_id, user_id))
-        # conn.commit()
-        # cursor.close()
-        async for conn in get_db_connection():  # get AsyncSession
-            await execute_query(
-                                conn,
-                                "SELECT message_id, author_type, content FROM Messages WHERE thread_id = :thread_id ORDER BY created_at ASC",
-                                {"thread_id": thread_id},
-                                fetch_one=False
-            )
+        # Thread and its UserThread link are created in one transaction.
+        async with unit_of_work():
+            async for conn in get_db_connection():  # get AsyncSession
+                await execute_query(
+                                    conn,
+                                    "INSERT INTO Threads (thread_id, title, type) VALUES (:thread_id, :title, :type)",
+                                    {"thread_id": thread_id, "title":chat_title, "type":"web"},
+                                    fetch_one=False
+                )
+            # cursor.execute("INSERT INTO UserThread(thread_id,user_id) VALUES (%s, %s)", (thread_id, user_id))
+            # conn.commit()
+            # cursor.close()
+            async for conn in get_db_connection():  # get AsyncSession
+                await execute_query(
+                                    conn,
+                                    "INSERT INTO UserThread (thread_id, user_id) VALUES (:thread_id, :user_id)",
+                                    {"thread_id": thread_id, "user_id": user_id},
+                                    fetch_one=False
+                )
         return NewChatResponse(thread_id=thread_id)
     except Exception as e:
         return e
 
-@router.post("/text_chat", tags=["Web Chat"])
-async def chat_with_agent(request: ChatRequest,user_id: str = Depends(get_current_user_id)):
-    try:
-        conn = get_db_connection()
-        if not conn: raise HTTPException(status_code=500, detail="Database connection failed")
+def _require_id(value: str, name: str = "thread_id") -> str:
+    """Rejects malformed ids (400) before they reach a query; UUIDv7, legacy UUID4 and "thread_..." ids pass."""
+    if not is_valid_id(value):
+        raise HTTPException(status_code=400, detail=f"Invalid {name} '{value}'.")
+    return value
 
-        # user_thread_cursor = conn.cursor()
-        # user_thread_cursor.execute("SELECT * FROM UserThread WHERE user_id = %s AND thread_id = %s", (user_id, request.thread_id))
-        # if not user_thread_cursor.fetchone():
-        #     user_thread_cursor.execute("INSERT INTO UserThread (user_id, thread_id) VALUES (%s, %s)", (user_id, request.thread_id))
-        #     conn.commit()
-        # user_thread_cursor.close()
+
+async def _web_chat_user(user_id: str, thread_id: str):
+    """
+    Links the user to the thread and returns (notion_user_id, database_id)
+    for the agent run. Raises 400 for a malformed thread id and 404 if the
+    user has no department database.
+    """
+    _require_id(thread_id)
+    # user_thread_cursor = conn.cursor()
+    # user_thread_cursor.execute("SELECT * FROM UserThread WHERE user_id = %s AND thread_id = %s", (user_id, thread_id))
+    # if not user_thread_cursor.fetchone():
+    #     user_thread_cursor.execute("INSERT INTO UserThread (user_id, thread_id) VALUES (%s, %s)", (user_id, thread_id))
+    #     conn.commit()
+    # user_thread_cursor.close()
+    # One session and commit for the thread link and user/department lookups.
+    async with unit_of_work():
         async for conn in get_db_connection():  # get AsyncSession
             user_thread = await execute_query(
                                 conn,
                                 "SELECT * FROM UserThread WHERE user_id = :user_id AND thread_id = :thread_id",
-                                {"user_id": user_id,"thread_id":request.thread_id},
+                                {"user_id": user_id,"thread_id":thread_id},
                                 fetch_one=True
             )
 
@@ -76,10 +92,10 @@ async def chat_with_agent(request: ChatRequest,user_id: str = Depends(get_curren
                 user_thread = await execute_query(
                                     conn,
                                     "INSERT INTO UserThread (user_id, thread_id) VALUES (:user_id, :thread_id)",
-                                    {"user_id": user_id,"thread_id":request.thread_id},
+                                    {"user_id": user_id,"thread_id":thread_id},
                                     fetch_one=True
                 )
-        
+    
         # cursor = conn.cursor(dictionary=True)
         # query = """
         #     SELECT u.notion_user_id, d.database_id 
@@ -105,14 +121,23 @@ async def chat_with_agent(request: ChatRequest,user_id: str = Depends(get_curren
                                     fetch_one=True
                 )
 
-        if not user_data:
-            raise HTTPException(status_code=404, detail=f"User '{user_id}' not found.")
+    if not user_data:
+        raise HTTPException(status_code=404, detail=f"User '{user_id}' not found.")
 
-        notion_id = user_data.get('notion_user_id')
-        department_database_id = user_data.get('database_id')
-        
-        if not department_database_id:
-            raise HTTPException(status_code=404, detail=f"User '{user_id}' is not assigned to a department with a Notion database ID.")
+    notion_id = user_data.get('notion_user_id')
+    department_database_id = user_data.get('database_id')
+    
+    if not department_database_id:
+        raise HTTPException(status_code=404, detail=f"User '{user_id}' is not assigned to a department with a Notion database ID.")
+    return notion_id, department_database_id
+
+
+@router.post("/text_chat", tags=["Web Chat"])
+async def chat_with_agent(request: ChatRequest,user_id: str = Depends(get_current_user_id)):
+    try:
+        conn = get_db_connection()
+        if not conn: raise HTTPException(status_code=500, detail="Database connection failed")
+        notion_id, department_database_id = await _web_chat_user(user_id, request.thread_id)
 
         return await handle_chat(
             thread_id=request.thread_id, 
@@ -125,6 +150,87 @@ async def chat_with_agent(request: ChatRequest,user_id: str = Depends(get_curren
         print(e)
         return []
 
+
+def _sse(event) -> str:
+    return f"event: {event['type']}\ndata: {json.dumps(jsonable_encoder(event))}\n\n"
+
+
+@router.post("/text_chat/stream", tags=["Web Chat"])
+async def chat_with_agent_stream(request: ChatRequest, user_id: str = Depends(get_current_user_id)):
+    """
+    Same turn as POST /text_chat, streamed as Server-Sent Events while the
+    agents run: agent, handoff, tool_call, tool_output and token events,
+    then "done" with the saved thread (or "error"). See handle_chat_stream.
+    """
+    notion_id, department_database_id = await _web_chat_user(user_id, request.thread_id)
+
+    async def events():
+        async for event in handle_chat_stream(
+            thread_id=request.thread_id,
+            prompt=request.message,
+            agent_to_use=chatbot_supervisor_agent,
+            database_id=department_database_id,
+            current_user_id=notion_id
+        ):
+            yield _sse(event)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Proxies must not buffer the stream, or tokens arrive all at once.
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.websocket("/ws/text_chat")
+async def text_chat_stream(websocket: WebSocket, thread_id: str, token: str):
+    """
+    WebSocket form of POST /text_chat/stream. Each text frame is one turn,
+    either the message itself or {"message": ...}; the turn's events are
+    sent back as JSON frames, ending with "done" or "error".
+    """
+    try:
+        user_id = await get_user_id_from_token(token)
+        if not user_id:
+            await websocket.close(code=4001, reason="Invalid authentication token")
+            return
+    except HTTPException:
+        await websocket.close(code=4001, reason="Invalid authentication token")
+        return
+
+    await websocket.accept()
+    try:
+        notion_id, department_database_id = await _web_chat_user(user_id, thread_id)
+    except HTTPException as e:
+        await websocket.send_json({"type": "error", "detail": e.detail})
+        await websocket.close()
+        return
+
+    try:
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+                prompt = message.get("message") if isinstance(message, dict) else text
+            except ValueError:
+                prompt = text
+            if not isinstance(prompt, str) or not prompt.strip():
+                await websocket.send_json({"type": "error", "detail": "Empty message."})
+                continue
+            turn = handle_chat_stream(
+                thread_id=thread_id,
+                prompt=prompt,
+                agent_to_use=chatbot_supervisor_agent,
+                database_id=department_database_id,
+                current_user_id=notion_id
+            )
+            # Closing the turn on a failed send releases the thread lock right away.
+            async with aclosing(turn):
+                async for event in turn:
+                    await websocket.send_json(jsonable_encoder(event))
+    except WebSocketDisconnect:
+        print(f"Text chat WebSocket disconnected for thread {thread_id}.")
+
 # --- FIXES APPLIED TO THIS FUNCTION ---
 @router.post("/voice_chat", tags=["Web Chat"])
 async def voice_chat_with_agent(
@@ -132,32 +238,15 @@ async def voice_chat_with_agent(
     file: UploadFile = File(...),
     user_id: str = Depends(get_current_user_id)
 ):
+    _require_id(thread_id)
     if not file.content_type.startswith("audio/"):
         raise HTTPException(status_code=400, detail="Invalid file type. Please upload an audio file.")
     
     try:
         file_bytes = await file.read()
-        file_buffer = io.BytesIO(file_bytes)
-        
-        # FIX 1: Rewind the in-memory file to the start before reading.
-        file_buffer.seek(0)
         
-        file_extension = os.path.splitext(file.filename)[1].lower() or ".wav"
-        
-        # Pydub can often infer the format, which is more robust for uploads.
-        audio = AudioSegment.from_file(file_buffer)
-        
-        wav_buffer = io.BytesIO()
-        audio.export(wav_buffer, format="wav")
-        wav_buffer.seek(0)
-        wav_buffer.name = "input.wav"
-
-        transcription = client.audio.transcriptions.create(
-            model="gpt-4o-mini-transcribe",
-            file=wav_buffer,
-            response_format="json"
-        )
-        prompt = transcription.text
+        # ffmpeg probes the format, which is more robust for uploads.
+        prompt = await transcribe_audio(file_bytes)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Audio transcription failed: {str(e)}")
 
@@ -171,48 +260,50 @@ async def voice_chat_with_agent(
         #     user_thread_cursor.execute("INSERT INTO UserThread (user_id, thread_id) VALUES (%s, %s)", (user_id, thread_id))
         #     conn.commit()
         # user_thread_cursor.close()
-        async for conn in get_db_connection():  # get AsyncSession
-            user_thread = await execute_query(
-                                conn,
-                                "SELECT * FROM UserThread WHERE user_id = :user_id AND thread_id = :thread_id",
-                                {"user_id": user_id,"thread_id":thread_id},
-                                fetch_one=True
-            )
-
-        if not user_thread:
+        # One session and commit for the thread link and user/department lookups.
+        async with unit_of_work():
             async for conn in get_db_connection():  # get AsyncSession
                 user_thread = await execute_query(
                                     conn,
-                                    "INSERT INTO UserThread (user_id, thread_id) VALUES (:user_id, :thread_id)",
+                                    "SELECT * FROM UserThread WHERE user_id = :user_id AND thread_id = :thread_id",
                                     {"user_id": user_id,"thread_id":thread_id},
                                     fetch_one=True
                 )
+
+            if not user_thread:
+                async for conn in get_db_connection():  # get AsyncSession
+                    user_thread = await execute_query(
+                                        conn,
+                                        "INSERT INTO UserThread (user_id, thread_id) VALUES (:user_id, :thread_id)",
+                                        {"user_id": user_id,"thread_id":thread_id},
+                                        fetch_one=True
+                    )
         
         
-        # cursor = conn.cursor(dictionary=True)
-        # query = """
-        #     SELECT u.notion_user_id, d.database_id 
-        #     FROM Users u
-        #     LEFT JOIN DepartmentUser du ON u.user_id = du.user_id
-        #     LEFT JOIN Departments d ON du.department_id = d.department_id
-        #     WHERE u.user_id = %s;
-        # """
-        # cursor.execute(query, (user_id,))
-        # user_data = cursor.fetchone()
-        # cursor.close()
-        async for conn in get_db_connection():  # get AsyncSession
-                user_data = await execute_query(
-                                    conn,
-                                    """
-                                        SELECT u.notion_user_id, d.database_id 
-                                        FROM Users u
-                                        LEFT JOIN DepartmentUser du ON u.user_id = du.user_id
-                                        LEFT JOIN Departments d ON du.department_id = d.department_id
-                                        WHERE u.user_id = :user_id;
-                                    """,
-                                    {"user_id": user_id},
-                                    fetch_one=True
-                )
+            # cursor = conn.cursor(dictionary=True)
+            # query = """
+            #     SELECT u.notion_user_id, d.database_id 
+            #     FROM Users u
+            #     LEFT JOIN DepartmentUser du ON u.user_id = du.user_id
+            #     LEFT JOIN Departments d ON du.department_id = d.department_id
+            #     WHERE u.user_id = %s;
+            # """
+            # cursor.execute(query, (user_id,))
+            # user_data = cursor.fetchone()
+            # cursor.close()
+            async for conn in get_db_connection():  # get AsyncSession
+                    user_data = await execute_query(
+                                        conn,
+                                        """
+                                            SELECT u.notion_user_id, d.database_id 
+                                            FROM Users u
+                                            LEFT JOIN DepartmentUser du ON u.user_id = du.user_id
+                                            LEFT JOIN Departments d ON du.department_id = d.department_id
+                                            WHERE u.user_id = :user_id;
+                                        """,
+                                        {"user_id": user_id},
+                                        fetch_one=True
+                    )
 
         if not user_data:
             raise HTTPException(status_code=404, detail=f"User '{user_id}' not found.")
@@ -236,8 +327,113 @@ async def voice_chat_with_agent(
 
 # FIX 2: The duplicate voice_chat_with_agent function has been removed.
 
+async def _get_voice_user(user_id: str):
+    async for conn in get_db_connection():  # get AsyncSession
+        user_data = await execute_query(
+                            conn,
+                            """
+                                SELECT u.notion_user_id, d.database_id 
+                                FROM Users u
+                                LEFT JOIN DepartmentUser du ON u.user_id = du.user_id
+                                LEFT JOIN Departments d ON du.department_id = d.department_id
+                                WHERE u.user_id = :user_id;
+                            """,
+                            {"user_id": user_id},
+                            fetch_one=True
+        )
+    return user_data
+
+
+def _is_end_of_recording(text: str) -> bool:
+    text = text.strip()
+    if text == "end":
+        return True
+    try:
+        return json.loads(text).get("type") == "end"
+    except (ValueError, AttributeError):
+        return False
+
+
+async def _stream_voice_chat(websocket: WebSocket, thread_id: str, user_id: str):
+    """
+    Streaming protocol for /ws/voice_chat?stream=true.
+
+    Client -> server: binary audio chunks (MediaRecorder WebM), then the text
+    message "end" (or {"type": "end"}) when recording stops.
+    Server -> client, as JSON:
+      {"type": "partial", "index": n, "text": ...}   one per transcribed segment
+      {"type": "transcript", "text": ...}            full transcript, agent run starts
+      {"type": "response", "messages": [...]}        the thread after the agent's reply
+      {"type": "error", "detail": ...}
+    If the client disconnects instead of sending "end", the recording is still
+    transcribed and the agent still runs; nothing more is sent.
+    """
+    connected = True
+
+    async def send(payload):
+        nonlocal connected
+        if not connected:
+            return
+        try:
+            await websocket.send_json(payload)
+        except Exception:
+            connected = False
+
+    async def on_segment(index: int, text: str):
+        await send({"type": "partial", "index": index, "text": text})
+
+    transcript = StreamingTranscription(format="webm", on_segment=on_segment)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                connected = False
+                break
+            if message.get("bytes"):
+                transcript.feed(message["bytes"])
+            elif message.get("text") is not None and _is_end_of_recording(message["text"]):
+                break
+    except WebSocketDisconnect:
+        connected = False
+    except Exception:
+        await transcript.aclose()
+        raise
+
+    if not len(transcript):
+        await send({"type": "error", "detail": "No audio data received."})
+        if connected:
+            await websocket.close()
+        return
+
+    try:
+        prompt = await transcript.finish()
+        if not prompt:
+            await send({"type": "error", "detail": "No speech detected."})
+            return
+        await send({"type": "transcript", "text": prompt})
+
+        user_data = await _get_voice_user(user_id)
+        if not user_data or not user_data.get('database_id'):
+            await send({"type": "error", "detail": f"User '{user_id}' is not assigned to a department with a Notion database ID."})
+            return
+        response = await handle_chat(
+            thread_id=thread_id,
+            prompt=prompt,
+            agent_to_use=chatbot_supervisor_agent,
+            database_id=user_data['database_id'],
+            current_user_id=user_data.get('notion_user_id')
+        )
+        await send({"type": "response", **jsonable_encoder(response)})
+    except Exception as e:
+        print(f"An error occurred during voice stream processing: {e}")
+        await send({"type": "error", "detail": f"An error occurred while handling the chat: {e}"})
+    finally:
+        if connected:
+            await websocket.close()
+
+
 @router.websocket("/ws/voice_chat")
-async def voice_chat_stream(websocket: WebSocket, thread_id: str, token: str):
+async def voice_chat_stream(websocket: WebSocket, thread_id: str, token: str, stream: bool = False):
     try:
         user_id = await get_user_id_from_token(token)
         if not user_id:
@@ -246,8 +442,14 @@ async def voice_chat_stream(websocket: WebSocket, thread_id: str, token: str):
     except HTTPException:
         await websocket.close(code=4001, reason="Invalid authentication token")
         return
+    if not is_valid_id(thread_id):
+        await websocket.close(code=4400, reason="Invalid thread_id")
+        return
 
     await websocket.accept()
+    if stream:
+        await _stream_voice_chat(websocket, thread_id, user_id)
+        return
     audio_buffer = io.BytesIO()
 
     try:
@@ -263,20 +465,7 @@ async def voice_chat_stream(websocket: WebSocket, thread_id: str, token: str):
             return
 
         try:
-            audio_buffer.seek(0) # Rewind for reading
-            audio = AudioSegment.from_file(audio_buffer, format="webm")
-            
-            wav_buffer = io.BytesIO()
-            audio.export(wav_buffer, format="wav")
-            wav_buffer.seek(0)
-            wav_buffer.name = "streamed_audio.wav"
-
-            transcription = client.audio.transcriptions.create(
-                model="gpt-4o-mini-transcribe",
-                file=wav_buffer,
-                response_format="json"
-            )
-            prompt = transcription.text
+            prompt = await transcribe_audio(audio_buffer.getvalue(), format="webm")
             print(f"Transcription successful: {prompt}")
 
             # conn = get_db_connection()
@@ -291,19 +480,7 @@ async def voice_chat_stream(websocket: WebSocket, thread_id: str, token: str):
             # cursor.execute(query, (user_id,))
             # user_data = cursor.fetchone()
             # cursor.close()
-            async for conn in get_db_connection():  # get AsyncSession
-                user_data = await execute_query(
-                                    conn,
-                                    """
-                                        SELECT u.notion_user_id, d.database_id 
-                                        FROM Users u
-                                        LEFT JOIN DepartmentUser du ON u.user_id = du.user_id
-                                        LEFT JOIN Departments d ON du.department_id = d.department_id
-                                        WHERE u.user_id = :user_id;
-                                    """,
-                                    {"user_id": user_id},
-                                    fetch_one=True
-                )
+            user_data = await _get_voice_user(user_id)
 
             if user_data:
                 notion_id = user_data.get('notion_user_id')
@@ -322,22 +499,24 @@ async def voice_chat_stream(websocket: WebSocket, thread_id: str, token: str):
 # ... (The rest of your file remains unchanged) ...
 @router.get("/chat/{thread_id}", response_model=ChatHistoryResponse, tags=["Web Chat"])
 async def get_chat_history(thread_id: str,user_id: str = Depends(get_current_user_id)):
+    _require_id(thread_id)
     conn = get_db_connection()
     if not conn: raise HTTPException(status_code=500, detail="Database connection failed")
     # cursor = conn.cursor(dictionary=True)
     # cursor.execute("SELECT message_id as id, author_type as role, content as text, IF(author_type='user', 'You', 'Bot') as 'from_' FROM Messages WHERE thread_id = %s ORDER BY created_at ASC", (thread_id,))
     # history = cursor.fetchall()
     # cursor.close()
-    async for conn in get_db_connection():  # get AsyncSession
-                history = await execute_query(
-                                    conn,
-                                    """
-                                        SELECT message_id as id, author_type as role, content as text, IF(author_type='user', 'You', 'Bot') as 'from_' FROM Messages WHERE thread_id = :thread_id ORDER BY created_at ASC
-                                    """,
-                                    {"thread_id": thread_id},
-                                    fetch_one=False
-                )
-    return ChatHistoryResponse(messages=history)
+    # async for conn in get_db_connection():  # get AsyncSession
+    #             history = await execute_query(
+    #                                 conn,
+    #                                 """
+    #                                     SELECT message_id as id, author_type as role, content as text, IF(author_type='user', 'You', 'Bot') as 'from_' FROM Messages WHERE thread_id = :thread_id ORDER BY created_at ASC
+    #                                 """,
+    #                                 {"thread_id": thread_id},
+    #                                 fetch_one=False
+    #             )
+    history = await thread_cache.get_messages(thread_id)
+    return ChatHistoryResponse(messages=format_db_rows_for_response(history))
 
 @router.get("/chats", response_model=List[ChatTitle], tags=["Web Chat"])
 async def get_all_web_chat_titles(user_id: str = Depends(get_current_user_id)):
@@ -413,7 +592,7 @@ async def get_user_notifications(user_id:str = Depends(get_current_user_id)):
 
 @router.post("/whatsapp/chat/new", response_model=NewChatResponse, tags=["WhatsApp"])
 async def start_new_whatsapp_chat(chat_title: str, type: str = "whatsapp",user_id: str = Depends(get_current_user_id)):
-    thread_id = str(uuid.uuid4())
+    thread_id = new_id()
     # conn = get_db_connection()
     # if not conn: raise HTTPException(status_code=500, detail="Database connection failed")
     # cursor = conn.cursor()
@@ -433,6 +612,7 @@ async def start_new_whatsapp_chat(chat_title: str, type: str = "whatsapp",user_i
 
 @router.post("/whatsapp/chat", response_model=ChatHistoryResponse, tags=["WhatsApp"])
 async def chat_with_whatsapp_agent(request: WhatsAppChatRequest,user_id: str = Depends(get_current_user_id)):
+    _require_id(request.thread_id)
     conn = get_db_connection()
     if not conn: raise HTTPException(status_code=500, detail="Database connection failed")
     
@@ -442,43 +622,38 @@ async def chat_with_whatsapp_agent(request: WhatsAppChatRequest,user_id: str = D
     #     user_thread_cursor.execute("INSERT INTO UserThread (user_id, thread_id) VALUES (%s, %s)", (request.user_id, request.thread_id))
     #     conn.commit()
     # user_thread_cursor.close()
-    async for conn in get_db_connection():  # get AsyncSession
-                await execute_query(
-                                    conn,
-                                    """
-                                        INSERT INTO UserThread (user_id, thread_id) VALUES (:user_id,:thread_id)
-                                    """,
-                                    {"user_id":request.user_id,"thread_id":request.thread_id},
-                                    fetch_one=False
-                )
+    # One session and commit for the thread link and user/department lookups.
+    async with unit_of_work():
+        async for conn in get_db_connection():  # get AsyncSession
+                    await execute_query(
+                                        conn,
+                                        """
+                                            INSERT INTO UserThread (user_id, thread_id) VALUES (:user_id,:thread_id)
+                                        """,
+                                        {"user_id":request.user_id,"thread_id":request.thread_id},
+                                        fetch_one=False
+                    )
 
-    # cursor = conn.cursor(dictionary=True)
-    # query = "SELECT d.database_id FROM Departments d JOIN DepartmentUser du ON d.department_id = du.department_id WHERE du.user_id = %s;"
-    # cursor.execute(query, (request.user_id,))
-    # department_info = cursor.fetchone()
-    async for conn in get_db_connection():  # get AsyncSession
-                department_info = await execute_query(
-                                    conn,
-                                    """
-                                        SELECT d.database_id FROM Departments d JOIN DepartmentUser du ON d.department_id = du.department_id WHERE du.user_id = :user_id;
-                                    """,
-                                    {"user_id":request.user_id},
-                                    fetch_one=True
-                )
+        # cursor = conn.cursor(dictionary=True)
+        # query = "SELECT d.database_id FROM Departments d JOIN DepartmentUser du ON d.department_id = du.department_id WHERE du.user_id = %s;"
+        # cursor.execute(query, (request.user_id,))
+        # department_info = cursor.fetchone()
+        async for conn in get_db_connection():  # get AsyncSession
+                    department_info = await execute_query(
+                                        conn,
+                                        """
+                                            SELECT d.database_id FROM Departments d JOIN DepartmentUser du ON d.department_id = du.department_id WHERE du.user_id = :user_id;
+                                        """,
+                                        {"user_id":request.user_id},
+                                        fetch_one=True
+                    )
     
-    # query_notion_id = "SELECT notion_user_id FROM Users WHERE user_id= %s;"
-    # cursor.execute(query_notion_id, (request.user_id,))
-    # notion_id = cursor.fetchone()
-    # cursor.close()
-    async for conn in get_db_connection():  # get AsyncSession
-                notion_id = await execute_query(
-                                    conn,
-                                    """
-                                        SELECT notion_user_id FROM Users WHERE user_id= %s;
-                                    """,
-                                    {"user_id":request.user_id},
-                                    fetch_one=True
-                )
+        # query_notion_id = "SELECT notion_user_id FROM Users WHERE user_id= %s;"
+        # cursor.execute(query_notion_id, (request.user_id,))
+        # notion_id = cursor.fetchone()
+        # cursor.close()
+        user = await get_user_by_id(request.user_id)
+        notion_id = user["notion_user_id"] if user else None
 
     if not department_info or not department_info["database_id"]:
         raise HTTPException(status_code=404, detail=f"User '{request.user_id}' is not Assigned to a department with a Notion database ID.")
@@ -515,6 +690,7 @@ async def get_all_whatsapp_chat_titles():
 
 @router.post("/chat/archive/{thread_id}",tags=["Web Chat"])
 async def archive_chat(thread_id:str):
+    _require_id(thread_id)
     conn = None 
     try:
         conn = get_db_connection()
@@ -561,6 +737,8 @@ async def update_notification_status(
     request: UpdateNotificationRequest,
     user_id: str = Depends(get_current_user_id),
 ):
+    # Notification ids are not format-checked: rows written before UUIDv7 ids
+    # hold a single-character id, and the query only matches existing rows.
     conn = get_db_connection()
     if not conn:
         raise HTTPException(status_code=500, detail="Database connection failed")
@@ -5,55 +5,45 @@ import codecs
 import json
 import os
 import logging
-import uuid
-import io
 
 from fastapi import (
-    APIRouter, HTTPException, Request, Response, status, BackgroundTasks, 
+    APIRouter, HTTPException, Request, Response, status, 
     Query as FastapiQuery, Form, File, UploadFile
 )
-from db import get_db_connection
+from db import get_db_connection, unit_of_work
 from services.chat_handler import handle_chat
+from services.idempotency import webhook_idempotency
+from services.job_queue import enqueue_job, job_handler
+from services.outbound_dispatcher import dispatch_whatsapp_message, outbound_dispatcher
+from services.transcription import transcribe_audio
+from services.user_directory import get_user_by_phone
 from utils.db_helper import execute_query
+from utils.id_generator import new_id
 from utils.phone_number_utils import get_current_datetime_in_timezone, get_timezones_for_phone
-from utils.whatsapp_utils import send_whatsapp_message, get_whatsapp_media_bytes # Import the new function
+from utils.whatsapp_utils import get_whatsapp_media_bytes # Import the new function
 import datetime
 from local_agents.notion_whatsapp_supervisor_agent import whatsapp_supervisor_agent
-from openai import OpenAI
-from pydub import AudioSegment
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN")
-client = OpenAI()
 
 INACTIVITY_TIMEOUT_HOURS = 6
+# Debounce window per sender: consecutive messages arriving within it are
+# answered in one agent turn. The window restarts with every message but
+# never extends past WHATSAPP_DEBOUNCE_MAX_SECONDS after the first one.
+WHATSAPP_DEBOUNCE_SECONDS = float(os.getenv("WHATSAPP_DEBOUNCE_SECONDS", "1.5"))
+WHATSAPP_DEBOUNCE_MAX_SECONDS = float(os.getenv("WHATSAPP_DEBOUNCE_MAX_SECONDS", "6"))
+WHATSAPP_MAX_MERGED_MESSAGES = int(os.getenv("WHATSAPP_MAX_MERGED_MESSAGES", "10"))
 
 async def transcribe_audio_bytes(audio_bytes: bytes) -> str:
     """A helper function to transcribe audio bytes using OpenAI."""
     try:
-        audio_buffer = io.BytesIO(audio_bytes)
-        
-        # --- THIS IS THE FIX ---
-        # Rewind the buffer to the beginning before passing it to pydub.
-        audio_buffer.seek(0)
-        # -----------------------
-        
-        # Determine format. WhatsApp is typically 'ogg'. Uploaded files can vary.
-        # Pydub can often infer the format, but being explicit is safer.
-        # We will let pydub infer for now, as it's more flexible for the test endpoint.
-        audio = AudioSegment.from_file(audio_buffer)
-        
-        wav_buffer = io.BytesIO()
-        audio.export(wav_buffer, format="wav")
-        wav_buffer.seek(0)
-        wav_buffer.name = "input.wav"
-
-        transcription = client.audio.transcriptions.create(
-            model="gpt-4o-mini-transcribe",
-            file=wav_buffer,
-            response_format="text"
-        )
+        # Decoding runs in the transcription service's process pool and the
+        # upload is async, so voice notes no longer block the event loop.
+        # WhatsApp is typically 'ogg'; uploads to the test endpoint vary, so
+        # ffmpeg probes the format.
+        transcription = await transcribe_audio(audio_bytes)
         logger.info(f"Transcription successful. Text: '{transcription}'")
         return transcription
     except Exception as e:
@@ -66,13 +56,7 @@ async def handlemessage(from_number: str, message_body: str):
     if not conn:
         raise HTTPException(status_code=500, detail="Database connection failed")
 
-    async for conn in get_db_connection():  # get AsyncSession
-        user_data = await execute_query(
-            conn,
-            "SELECT user_id, notion_user_id FROM Users WHERE phone_number = :phone_number",
-            {"phone_number": from_number},
-            fetch_one=True
-        )
+    user_data = await get_user_by_phone(from_number)
     # cursor = conn.cursor(dictionary=True)
     
     # query_notion_id = "SELECT user_id, notion_user_id FROM Users WHERE phone_number = %s;"
@@ -97,68 +81,70 @@ async def handlemessage(from_number: str, message_body: str):
     # last_thread = cursor.fetchone()
     # cursor.close()
     # print(last_thread)
-    async for conn in get_db_connection():  # get AsyncSession
-        last_thread = await execute_query(
-            conn,
-            """
-            SELECT t.thread_id, t.created_at
-            FROM Threads t JOIN UserThread ut ON t.thread_id = ut.thread_id
-            WHERE ut.user_id = :user_id AND t.type = 'whatsapp'
-            ORDER BY t.created_at DESC LIMIT 1;
-            """,
-            {"user_id": user_id},
-            fetch_one=True
-        )
-    thread_id = None
-    if last_thread:
-        # cursor = conn.cursor()
-        # query_last_message_time = "SELECT created_at FROM Messages WHERE thread_id = %s ORDER BY created_at DESC LIMIT 1;"
-        # cursor.execute(query_last_message_time, (last_thread[0],))
-        # last_message = cursor.fetchone()
-        # print(last_message)
-        # cursor.close()
-        print(last_thread)
+    # Thread lookup and (if needed) creation share one session and commit.
+    async with unit_of_work():
         async for conn in get_db_connection():  # get AsyncSession
-            last_message = await execute_query(
+            last_thread = await execute_query(
                 conn,
                 """
-                SELECT created_at FROM Messages WHERE thread_id = :thread_id ORDER BY created_at DESC LIMIT 1;
+                SELECT t.thread_id, t.created_at
+                FROM Threads t JOIN UserThread ut ON t.thread_id = ut.thread_id
+                WHERE ut.user_id = :user_id AND t.type = 'whatsapp'
+                ORDER BY t.created_at DESC LIMIT 1;
                 """,
-                {"thread_id": last_thread['thread_id']},
+                {"user_id": user_id},
                 fetch_one=True
             )
+        thread_id = None
+        if last_thread:
+            # cursor = conn.cursor()
+            # query_last_message_time = "SELECT created_at FROM Messages WHERE thread_id = %s ORDER BY created_at DESC LIMIT 1;"
+            # cursor.execute(query_last_message_time, (last_thread[0],))
+            # last_message = cursor.fetchone()
+            # print(last_message)
+            # cursor.close()
+            print(last_thread)
+            async for conn in get_db_connection():  # get AsyncSession
+                last_message = await execute_query(
+                    conn,
+                    """
+                    SELECT created_at FROM Messages WHERE thread_id = :thread_id ORDER BY created_at DESC LIMIT 1;
+                    """,
+                    {"thread_id": last_thread['thread_id']},
+                    fetch_one=True
+                )
         
-        time_limit = datetime.datetime.now() - datetime.timedelta(hours=INACTIVITY_TIMEOUT_HOURS)
+            time_limit = datetime.datetime.now() - datetime.timedelta(hours=INACTIVITY_TIMEOUT_HOURS)
         
-        if last_message and last_message['created_at'] > time_limit:
-            thread_id = last_thread['thread_id']
-            logger.info(f"Continuing recent thread for {from_number}: {thread_id}")
-    # cursor = conn.cursor()
-    if thread_id is None:
-        new_thread_obj = client.beta.threads.create()
-        thread_id = new_thread_obj.id
+            if last_message and last_message['created_at'] > time_limit:
+                thread_id = last_thread['thread_id']
+                logger.info(f"Continuing recent thread for {from_number}: {thread_id}")
+        # cursor = conn.cursor()
+        if thread_id is None:
+            # Local time-ordered id instead of an OpenAI Assistants thread round trip.
+            thread_id = new_id()
         
-        # cursor.execute("INSERT INTO Threads (thread_id, title, type) VALUES (%s, %s, %s)", (thread_id, f"Whatsapp+{from_number}", "whatsapp"))
-        # cursor.execute("INSERT INTO UserThread (user_id, thread_id) VALUES (%s, %s)", (user_id, thread_id))
-        # conn.commit()
-        # logger.info(f"Created new thread for {from_number} due to inactivity: {thread_id}")
-        async for conn in get_db_connection():  # get AsyncSession
-            await execute_query(
-                conn,
-                """
-                INSERT INTO Threads (thread_id, title, type) VALUES (:thread_id, :title, :type);
-                """,
-                {"thread_id": thread_id,"title":f"Whatsapp+{from_number}","type":"whatsapp"},
-                fetch_one=False
-            )
-            await execute_query(
-                conn,
-                """
-               INSERT INTO UserThread (user_id, thread_id) VALUES (:user_id, :thread_id)
-                """,
-                {"user_id":user_id,"thread_id": thread_id},
-                fetch_one=False
-            )
+            # cursor.execute("INSERT INTO Threads (thread_id, title, type) VALUES (%s, %s, %s)", (thread_id, f"Whatsapp+{from_number}", "whatsapp"))
+            # cursor.execute("INSERT INTO UserThread (user_id, thread_id) VALUES (%s, %s)", (user_id, thread_id))
+            # conn.commit()
+            # logger.info(f"Created new thread for {from_number} due to inactivity: {thread_id}")
+            async for conn in get_db_connection():  # get AsyncSession
+                await execute_query(
+                    conn,
+                    """
+                    INSERT INTO Threads (thread_id, title, type) VALUES (:thread_id, :title, :type);
+                    """,
+                    {"thread_id": thread_id,"title":f"Whatsapp+{from_number}","type":"whatsapp"},
+                    fetch_one=False
+                )
+                await execute_query(
+                    conn,
+                    """
+                   INSERT INTO UserThread (user_id, thread_id) VALUES (:user_id, :thread_id)
+                    """,
+                    {"user_id":user_id,"thread_id": thread_id},
+                    fetch_one=False
+                )
 
     # cursor.close()
     
@@ -208,51 +194,114 @@ async def test_voice(from_number: str = Form(...), file: UploadFile = File(...))
 
 # --- MODIFY THIS MAIN WEBHOOK HANDLER ---
 @router.post("/webhook")
-async def handle_webhook(request: Request,background_tasks: BackgroundTasks):
+async def handle_webhook(request: Request):
     body = await request.json()
     logger.info(f"Incoming webhook message: {json.dumps(body, indent=2)}")
 
     if body.get("object") != "whatsapp_business_account":
         return Response(status_code=status.HTTP_404_NOT_FOUND)
 
-    try:
-        value = body["entry"][0]["changes"][0]["value"]
-    except (KeyError, IndexError):
-        return Response(status_code=200)
+    # Meta may batch several entries, changes, messages and statuses into one
+    # delivery; every one of them is handled.
+    messages = []
+    for entry in body.get("entry") or []:
+        for change in entry.get("changes") or []:
+            value = change.get("value") or {}
+            for status_data in value.get("statuses") or []:
+                logger.info(f"Status update for {status_data.get('id')}: {status_data.get('status')}")
+                try:
+                    await outbound_dispatcher.record_status(status_data)
+                except Exception as e:
+                    logger.error(f"Could not record status of {status_data.get('id')}: {e}")
+            for message_entry in value.get("messages") or []:
+                if message_entry.get("type") in ("text", "audio") and message_entry.get("from"):
+                    messages.append(message_entry)
+                else:
+                    logger.info(f"Ignoring unsupported WhatsApp message type '{message_entry.get('type')}' ({message_entry.get('id')})")
 
-    if "statuses" in value:
-        status_data = value["statuses"][0]
-        logger.info(f"Status update for {status_data['id']}: {status_data['status']}")
+    if not messages:
         return Response(status_code=200)
 
-    if "messages" in value:
-        message_entry = value["messages"][0]
-        from_number = message_entry["from"]
-        
-        message_body = ""
-        
-        # Handle TEXT messages (existing logic)
-        if message_entry.get("type") == "text":
-            message_body = message_entry["text"]["body"]
-        
-        # Handle AUDIO messages (new logic)
-        elif message_entry.get("type") == "audio":
-            logger.info(f"Received audio message from {from_number}")
-            audio_id = message_entry["audio"]["id"]
-            audio_bytes = await get_whatsapp_media_bytes(audio_id)
-            if audio_bytes:
-                message_body = await transcribe_audio_bytes(audio_bytes)
-            else:
-                message_body = "Failed to process the received audio."
-        
-        # If we have a message body from either text or audio, process it.
-        if message_body:
-            # ai_response = await handlemessage(from_number, message_body)
-            # await send_whatsapp_message(from_number, ai_response)
-            background_tasks.add_task(process_message, from_number, message_body) 
+    # ai_response = await handlemessage(from_number, message_body)
+    # await send_whatsapp_message(from_number, ai_response)
+    # Persist the raw messages and ack right away; media download,
+    # transcription and the agent runs happen in the job workers. Each
+    # sender is its own lane, so one user's messages are processed in order
+    # while different users run in parallel.
+    # Claiming the message ids commits together with the enqueues, so a
+    # redelivered webhook is acked without being processed again.
+    claimed_ids = []
+    try:
+        async with unit_of_work():
+            for message_entry in messages:
+                message_id = message_entry.get("id")
+                if message_id and not await webhook_idempotency.claim(message_id, message_entry["from"]):
+                    logger.info(f"Duplicate delivery of WhatsApp message {message_id} ignored.")
+                    continue
+                await enqueue_job(
+                    "whatsapp_message",
+                    {"from": message_entry["from"], "message": message_entry},
+                    delay_seconds=WHATSAPP_DEBOUNCE_SECONDS,
+                    lane_key=message_entry["from"],
+                    debounce_max_seconds=WHATSAPP_DEBOUNCE_MAX_SECONDS,
+                )
+                if message_id:
+                    claimed_ids.append(message_id)
+    except Exception as e:
+        logger.error(f"Could not enqueue {len(messages)} WhatsApp message(s): {e}")
+        # Not acked, so Meta redelivers the batch later; ids claimed in an
+        # earlier delivery are still skipped.
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    for message_id in claimed_ids:
+        webhook_idempotency.remember(message_id)
     return Response(status_code=200)
 
 
-async def process_message(from_number: str, msg_body: str):   
+@job_handler("whatsapp_message", batch_size=WHATSAPP_MAX_MERGED_MESSAGES)
+async def process_whatsapp_messages(payloads: list):
+    """
+    Job handler for a burst of inbound WhatsApp messages from one sender
+    (the debounce window batches them), answered in a single agent turn.
+    The sender's job lane runs one batch at a time, so turns for one number
+    never overlap; the turn runs inside the job, so a released job has no
+    reply still in flight.
+    """
+    from_number = payloads[0]["from"]
+    bodies = await asyncio.gather(*(_message_body(payload) for payload in payloads))
+    bodies = [body for body in bodies if body]
+    if not bodies:
+        return
+    if len(bodies) > 1:
+        logger.info(f"Merged {len(bodies)} messages from {from_number} into one prompt.")
+    await process_message(from_number, "\n".join(bodies))
+
+
+async def _message_body(payload: dict) -> str:
+    """Text of a text message, or the transcription of an audio message."""
+    message_entry = payload["message"]
+    from_number = payload["from"]
+
+    message_body = ""
+
+    # Handle TEXT messages (existing logic)
+    if message_entry.get("type") == "text":
+        message_body = message_entry["text"]["body"]
+
+    # Handle AUDIO messages (new logic)
+    elif message_entry.get("type") == "audio":
+        logger.info(f"Received audio message from {from_number}")
+        audio_id = message_entry["audio"]["id"]
+        audio_bytes = await get_whatsapp_media_bytes(audio_id)
+        if not audio_bytes:
+            # Raising lets the queue retry the download with backoff.
+            raise RuntimeError(f"Could not download WhatsApp media {audio_id}")
+        message_body = await transcribe_audio_bytes(audio_bytes)
+
+    return message_body
+
+
+async def process_message(from_number: str, msg_body: str):
+    """One agent turn and one reply."""
     ai_response = await handlemessage(from_number, msg_body)
-    await send_whatsapp_message(from_number, ai_response)
\ No newline at end of file
+    await dispatch_whatsapp_message(from_number, ai_response, kind="reply")
+    return ai_response
\ No newline at end of file
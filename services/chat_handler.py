@@ -1,19 +1,27 @@
 from datetime import date
 import logging
 import re
-from agents import Runner
 from fastapi import HTTPException
 import mysql
-from db import get_db_connection
+from db import get_db_connection, unit_of_work
+from local_agents.run_context import ChatRunContext, detect_language
 from schema.chat_schema import ChatHistoryResponse, Message
+from services.history_manager import history_manager
+from services.thread_cache import thread_cache
 from utils.db_helper import execute_query
+from utils.id_generator import new_id
 from utils.formatter import format_db_rows_for_response
+from utils.lanes import KeyedLock
 import uuid
-from typing import Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 from agents import Agent, Runner
-import os
 import json
-import re
+
+logger = logging.getLogger(__name__)
+
+# Turns on the same thread run one at a time; each turn reads the history
+# written by the previous one.
+thread_locks = KeyedLock(name="chat_threads")
 
 async def handle_chat(
     thread_id: str,
@@ -23,8 +31,79 @@ async def handle_chat(
     current_user_id: Optional[str] = None,
     date:Optional[str] = date.today().isoformat()
 ):
-    original_db_id = os.getenv("NOTION_TASKS_DATABASE_ID")
-    print(date)
+    async with thread_locks.hold(thread_id):
+        return await _handle_chat(thread_id, prompt, agent_to_use, database_id, current_user_id, date)
+
+
+async def handle_chat_stream(
+    thread_id: str,
+    prompt: str,
+    agent_to_use: Agent,
+    database_id: Optional[str] = None,
+    current_user_id: Optional[str] = None,
+    date:Optional[str] = date.today().isoformat()
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streaming variant of handle_chat: same history, prompt and persistence,
+    but the agents run through Runner.run_streamed and their progress is
+    yielded as it happens:
+
+      {"type": "agent", "agent": name}                  an agent took over
+      {"type": "handoff", "from": name, "to": name}
+      {"type": "tool_call", "agent": name, "tool": name}
+      {"type": "tool_output", "agent": name}
+      {"type": "token", "agent": name, "delta": text}   response text as it is generated
+      {"type": "done", "response": ChatHistoryResponse} after the reply is saved
+      {"type": "error", "detail": text}
+
+    Tokens are a draft of the reply; the saved reply in "done" can differ,
+    e.g. when a created task is rendered from the tool output.
+    """
+    async with thread_locks.hold(thread_id):
+        try:
+            current_conversation, tasks_in_thread, context = await _prepare_turn(thread_id, prompt, database_id, current_user_id, date)
+
+            next_agent, more = agent_to_use, True
+            for step in range(3):  # the requested agent plus up to two follow-through steps
+                current_agent = next_agent.name
+                try:
+                    result = Runner.run_streamed(next_agent, current_conversation, context=context)
+                    async for event in result.stream_events():
+                        payload = _stream_event_payload(event)
+                        if payload is None:
+                            continue
+                        if payload["type"] == "agent":
+                            current_agent = payload["agent"]
+                        elif payload["type"] == "token":
+                            payload["agent"] = current_agent
+                        yield payload
+                    current_conversation = result.to_input_list()
+                except Exception:
+                    if step == 0:
+                        raise
+                    break
+                if not more:
+                    break
+                next_agent, more = _follow_through_agent(current_conversation)
+                if next_agent is None:
+                    break
+
+            response = await _complete_turn(thread_id, current_conversation, tasks_in_thread)
+            yield {"type": "done", "response": response}
+        except Exception as e:
+            print(f"--- FATAL ERROR in handle_chat_stream: {e} ---")
+            yield {"type": "error", "detail": f"An error occurred: {e}"}
+
+
+async def _handle_chat(
+    thread_id: str,
+    prompt: str,
+    agent_to_use: Agent,
+    database_id: Optional[str] = None,
+    current_user_id: Optional[str] = None,
+    date:Optional[str] = date.today().isoformat()
+):
+    logger.debug(f"handle_chat thread={thread_id} date={date}")
     # conn = get_db_connection()
     # if not conn:
     #     raise HTTPException(status_code=500, detail="Database connection failed")
@@ -35,180 +114,254 @@ async def handle_chat(
     #     return conn.cursor(dictionary=True)
 
     try:
-        # 1. Prepare conversation history with context
-        # cursor = get_safe_cursor()
-        # cursor.execute(
-        #     "SELECT author_type, content FROM Messages WHERE thread_id = %s ORDER BY created_at ASC",
-        #     (thread_id,)
-        # )
-        # db_history = cursor.fetchall()
-        # cursor.close()
-        async for conn in get_db_connection():  # get AsyncSession
-            db_history = await execute_query(
-                conn,
-                "SELECT author_type, content FROM Messages WHERE thread_id = :thread_id ORDER BY created_at ASC",
-                {"thread_id": thread_id},
-                fetch_one=False
-            )
+        current_conversation, tasks_in_thread, context = await _prepare_turn(thread_id, prompt, database_id, current_user_id, date)
+        updated_conversation = await _run_turn(agent_to_use, current_conversation, context)
+        return await _complete_turn(thread_id, updated_conversation, tasks_in_thread)
+
+    except Exception as e:
+        error_message = f"An error occurred: {e}"
+        print(f"--- FATAL ERROR in handle_chat: {e} ---")
+        return ChatHistoryResponse(
+            messages=[Message(from_="Bot", text=error_message, id=str(uuid.uuid4()))]
+        )
 
-        current_conversation = [
-            {"role": row['author_type'], "content": row['content']}
-            for row in db_history
-        ]
-
-        # cursor = get_safe_cursor()
-        # cursor.execute(
-        #     "SELECT task_id, task_name FROM ThreadTasks WHERE thread_id = %s ORDER BY created_at ASC",
-        #     (thread_id,)
-        # )
-        # task_rows = cursor.fetchall()
-        # cursor.close()
+    # finally:
+    #     if conn and conn.is_connected():
+    #         conn.close()
+
+
+def _run_context(thread_id: str, prompt: str, database_id: Optional[str], current_user_id: Optional[str], date) -> ChatRunContext:
+    """
+    Per-turn context for the agents' tools. The department's database, the
+    logged-in user and their language travel with the run, so tools never
+    depend on the model copying them into arguments, and turns for different
+    departments never see each other's database.
+    """
+    tzinfo = getattr(date, "tzinfo", None)
+    return ChatRunContext(
+        thread_id=thread_id,
+        database_id=database_id,
+        notion_user_id=current_user_id,
+        language=detect_language(prompt),
+        timezone=getattr(tzinfo, "key", None),  # set for the webhook's ZoneInfo datetimes
+    )
+
+
+async def _prepare_turn(
+    thread_id: str,
+    prompt: str,
+    database_id: Optional[str],
+    current_user_id: Optional[str],
+    date,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], ChatRunContext]:
+    """
+    Saves the user message and builds the agent input: the thread history
+    plus the prompt with its task, user, database and date context.
+    Returns (conversation, tasks_in_thread, run context).
+    """
+    # 1. Prepare conversation history with context
+    # cursor = get_safe_cursor()
+    # cursor.execute(
+    #     "SELECT author_type, content FROM Messages WHERE thread_id = %s ORDER BY created_at ASC",
+    #     (thread_id,)
+    # )
+    # db_history = cursor.fetchall()
+    # cursor.close()
+    # History reads and the user message write share one session and commit;
+    # the unit of work is closed before the agents run.
+    user_message_id = new_id()
+    async with unit_of_work():
+        # Summary of older turns + the recent window; only rows newer than
+        # the thread's cursor are read from Messages.
+        current_conversation = await history_manager.load(thread_id)
         async for conn in get_db_connection():  # get AsyncSession
             task_rows = await execute_query(
                 conn,
-                "SELECT author_type, content FROM Messages WHERE thread_id = :thread_id ORDER BY created_at ASC",
+                "SELECT task_id, task_name FROM ThreadTasks WHERE thread_id = :thread_id ORDER BY created_at ASC",
                 {"thread_id": thread_id},
                 fetch_one=False
             )
-        
-        tasks_in_thread = [
-            {"id": row['task_id'], "name": row.get('task_name')}
-            for row in task_rows if row.get('task_id')
-        ]
-
-        task_context_info = ""
-        if tasks_in_thread:
-            task_list_str = json.dumps(tasks_in_thread)
-            task_context_info = (
-                f"HISTORICAL CONTEXT:\n"
-                f"- The following tasks have been created in this conversation: {task_list_str}\n"
-                f"- If the user says 'the task' or 'that task,' they mean the last one in this list.\n"
-                f"----\n\n"
-            )
-
-        # --- FIX: build the prompt safely ---
-        agent_prompt = f"{task_context_info}{prompt}"
-
-        if current_user_id:
-            agent_prompt += f"\n(logged_in_user_id='{current_user_id}')"
-
-        if database_id:
-            agent_prompt += f"\n(database_id=`{database_id}`)"
-
-        # Provide dynamic, user-local current date/time to agents
-        if date is not None:
-            try:
-                # If a timezone-aware datetime was passed in from the webhook, use it
-                current_date_str = None
-                current_time_str = None
-                # Avoid importing date type here since parameter name shadows it
-                if hasattr(date, "date") and hasattr(date, "time"):
-                    current_date_str = date.date().isoformat()
-                    # ISO time without microseconds for readability
-                    current_time_str = date.time().replace(microsecond=0).isoformat()
-                elif hasattr(date, "isoformat"):
-                    # If it's a date or string-like with isoformat
-                    current_date_str = date.isoformat() if callable(date.isoformat) else str(date)
-                else:
-                    current_date_str = str(date)
-
-                if current_date_str:
-                    agent_prompt += f"\n(current_date='{current_date_str}')"
-                if current_time_str:
-                    agent_prompt += f"\n(current_time='{current_time_str}')"
-            except Exception:
-                # Non-fatal; proceed without adding date/time context
-                pass
-
-        # 2. Save user message and run the agent
-        user_message_id = str(uuid.uuid4())
-        # cursor = get_safe_cursor()
-        # cursor.execute(
-        #     "INSERT INTO Messages (message_id, thread_id, author_type, content) VALUES (%s, %s, %s, %s)",
-        #     (user_message_id, thread_id, "user", prompt)
-        # )
-        # conn.commit()
-        # cursor.close()
-        async for conn in get_db_connection():  # get AsyncSession
+            # 2. Save user message (the agent run follows below)
             await execute_query(
                 conn,
                 "INSERT INTO Messages (message_id, thread_id, author_type, content) VALUES (:message_id, :thread_id, :author_type, :content)",
                 {"message_id": user_message_id,"thread_id": thread_id,"author_type": "user","content": prompt},
                 fetch_one=False
             )
+    await thread_cache.append(thread_id, user_message_id, "user", prompt)
+
+    # cursor = get_safe_cursor()
+    # cursor.execute(
+    #     "SELECT task_id, task_name FROM ThreadTasks WHERE thread_id = %s ORDER BY created_at ASC",
+    #     (thread_id,)
+    # )
+    # task_rows = cursor.fetchall()
+    # cursor.close()
+    
+    tasks_in_thread = [
+        {"id": row['task_id'], "name": row.get('task_name')}
+        for row in task_rows if row.get('task_id')
+    ]
+
+    task_context_info = ""
+    if tasks_in_thread:
+        task_list_str = json.dumps(tasks_in_thread)
+        task_context_info = (
+            f"HISTORICAL CONTEXT:\n"
+            f"- The following tasks have been created in this conversation: {task_list_str}\n"
+            f"- If the user says 'the task' or 'that task,' they mean the last one in this list.\n"
+            f"----\n\n"
+        )
 
-        current_conversation.append({"role": "user", "content": agent_prompt})
-
-        result = await Runner.run(agent_to_use, current_conversation)
-        updated_conversation = result.to_input_list()
-
-        # If the supervisor emitted only an annotated routing string and did not
-        # actually perform a handoff, follow through by invoking the target agent
-        # directly. Also, if a specialist returns a structured ACTION_TYPE block
-        # without handing off, run the Notion_Response_Agent as a fallback.
-        def _extract_handoff_agent(text: str) -> Optional[str]:
-            if not isinstance(text, str):
-                return None
-            # Look for a bracketed agent name like [Notion_Task_Creation_Agent]
-            m = re.search(r"\[([^\]]+?_Agent)\]", text)
-            if m:
-                return m.group(1).strip()
-            return None
-
-        # Identify last assistant text
-        last_ai_text = ""
-        for msg in reversed(updated_conversation):
-            if msg.get("role") == "assistant":
-                content = msg.get("content", "")
-                last_ai_text = "".join(
-                    [part.get("text", "") for part in content if isinstance(part, dict)]
-                ) if isinstance(content, list) else str(content)
-                break
+    # --- FIX: build the prompt safely ---
+    agent_prompt = f"{task_context_info}{prompt}"
 
-        def _looks_like_supervisor_route(text: str) -> bool:
-            return isinstance(text, str) and text.strip().startswith("(language=") and "[Notion_" in text
+    if current_user_id:
+        agent_prompt += f"\n(logged_in_user_id='{current_user_id}')"
 
-        def _looks_like_structured_action_block(text: str) -> bool:
-            return isinstance(text, str) and ("ACTION_TYPE:" in text and "TOOL_OUTPUT:" in text)
+    if database_id:
+        agent_prompt += f"\n(database_id=`{database_id}`)"
 
+    # Provide dynamic, user-local current date/time to agents
+    if date is not None:
         try:
-            from local_agents.notion_whatsapp_supervisor_agent import ALL_WHATSAPP_AGENTS  # lazy import
+            # If a timezone-aware datetime was passed in from the webhook, use it
+            current_date_str = None
+            current_time_str = None
+            # Avoid importing date type here since parameter name shadows it
+            if hasattr(date, "date") and hasattr(date, "time"):
+                current_date_str = date.date().isoformat()
+                # ISO time without microseconds for readability
+                current_time_str = date.time().replace(microsecond=0).isoformat()
+            elif hasattr(date, "isoformat"):
+                # If it's a date or string-like with isoformat
+                current_date_str = date.isoformat() if callable(date.isoformat) else str(date)
+            else:
+                current_date_str = str(date)
+
+            if current_date_str:
+                agent_prompt += f"\n(current_date='{current_date_str}')"
+            if current_time_str:
+                agent_prompt += f"\n(current_time='{current_time_str}')"
         except Exception:
-            ALL_WHATSAPP_AGENTS = {}
-
-        # Attempt up to two follow-through steps
-        for _ in range(2):
-            if _looks_like_supervisor_route(last_ai_text):
-                try:
-                    agent_name = _extract_handoff_agent(last_ai_text)
-                    if agent_name and agent_name in ALL_WHATSAPP_AGENTS:
-                        next_agent = ALL_WHATSAPP_AGENTS[agent_name]
-                        result = await Runner.run(next_agent, updated_conversation)
-                        updated_conversation = result.to_input_list()
-                        # refresh last_ai_text for next decision
-                        last_ai_text = ""
-                        for msg in reversed(updated_conversation):
-                            if msg.get("role") == "assistant":
-                                content = msg.get("content", "")
-                                last_ai_text = "".join(
-                                    [part.get("text", "") for part in content if isinstance(part, dict)]
-                                ) if isinstance(content, list) else str(content)
-                                break
-                        continue
-                except Exception:
-                    break
-            elif _looks_like_structured_action_block(last_ai_text):
-                try:
-                    # Run the response agent explicitly if needed
-                    response_agent = ALL_WHATSAPP_AGENTS.get("Notion_Response_Agent")
-                    if response_agent:
-                        result = await Runner.run(response_agent, updated_conversation)
-                        updated_conversation = result.to_input_list()
-                        break
-                except Exception:
-                    break
+            # Non-fatal; proceed without adding date/time context
+            pass
+
+    # 2. Run the agent
+    # cursor = get_safe_cursor()
+    # cursor.execute(
+    #     "INSERT INTO Messages (message_id, thread_id, author_type, content) VALUES (%s, %s, %s, %s)",
+    #     (user_message_id, thread_id, "user", prompt)
+    # )
+    # conn.commit()
+    # cursor.close()
+    current_conversation.append({"role": "user", "content": agent_prompt})
+    return current_conversation, tasks_in_thread, _run_context(thread_id, prompt, database_id, current_user_id, date)
+
+
+def _last_assistant_text(conversation: List[Dict[str, Any]]) -> str:
+    for msg in reversed(conversation):
+        if msg.get("role") == "assistant":
+            content = msg.get("content", "")
+            return "".join(
+                [part.get("text", "") for part in content if isinstance(part, dict)]
+            ) if isinstance(content, list) else str(content)
+    return ""
+
+
+# If the supervisor emitted only an annotated routing string and did not
+# actually perform a handoff, follow through by invoking the target agent
+# directly. Also, if a specialist returns a structured ACTION_TYPE block
+# without handing off, run the Notion_Response_Agent as a fallback.
+def _extract_handoff_agent(text: str) -> Optional[str]:
+    if not isinstance(text, str):
+        return None
+    # Look for a bracketed agent name like [Notion_Task_Creation_Agent]
+    m = re.search(r"\[([^\]]+?_Agent)\]", text)
+    if m:
+        return m.group(1).strip()
+    return None
+
+
+def _looks_like_supervisor_route(text: str) -> bool:
+    return isinstance(text, str) and text.strip().startswith("(language=") and "[Notion_" in text
+
+
+def _looks_like_structured_action_block(text: str) -> bool:
+    return isinstance(text, str) and ("ACTION_TYPE:" in text and "TOOL_OUTPUT:" in text)
+
+
+def _follow_through_agent(conversation: List[Dict[str, Any]]) -> Tuple[Optional[Agent], bool]:
+    """
+    Returns (agent to run next, whether more follow-through may come after
+    it), or (None, False) when the turn is complete.
+    """
+    try:
+        from local_agents.notion_whatsapp_supervisor_agent import ALL_WHATSAPP_AGENTS  # lazy import
+    except Exception:
+        ALL_WHATSAPP_AGENTS = {}
+
+    last_ai_text = _last_assistant_text(conversation)
+    if _looks_like_supervisor_route(last_ai_text):
+        agent_name = _extract_handoff_agent(last_ai_text)
+        if agent_name and agent_name in ALL_WHATSAPP_AGENTS:
+            return ALL_WHATSAPP_AGENTS[agent_name], True
+    elif _looks_like_structured_action_block(last_ai_text):
+        # Run the response agent explicitly if needed
+        response_agent = ALL_WHATSAPP_AGENTS.get("Notion_Response_Agent")
+        if response_agent:
+            return response_agent, False
+    return None, False
+
+
+async def _run_turn(agent_to_use: Agent, current_conversation: List[Dict[str, Any]], context: ChatRunContext) -> List[Dict[str, Any]]:
+    result = await Runner.run(agent_to_use, current_conversation, context=context)
+    updated_conversation = result.to_input_list()
+
+    # Attempt up to two follow-through steps
+    for _ in range(2):
+        next_agent, more = _follow_through_agent(updated_conversation)
+        if next_agent is None:
             break
-
+        try:
+            result = await Runner.run(next_agent, updated_conversation, context=context)
+            updated_conversation = result.to_input_list()
+        except Exception:
+            break
+        if not more:
+            break
+    return updated_conversation
+
+
+def _stream_event_payload(event) -> Optional[Dict[str, Any]]:
+    """Maps an Agents SDK stream event to a handle_chat_stream event, or None to skip it."""
+    if event.type == "agent_updated_stream_event":
+        return {"type": "agent", "agent": event.new_agent.name}
+    if event.type == "raw_response_event":
+        if getattr(event.data, "type", None) == "response.output_text.delta":
+            return {"type": "token", "delta": event.data.delta}
+        return None
+    if event.type == "run_item_stream_event":
+        item = event.item
+        agent_name = getattr(getattr(item, "agent", None), "name", None)
+        if event.name == "tool_called":
+            return {"type": "tool_call", "agent": agent_name, "tool": getattr(item.raw_item, "name", None)}
+        if event.name == "tool_output":
+            return {"type": "tool_output", "agent": agent_name}
+        if event.name in ("handoff_occured", "handoff_occurred"):
+            return {"type": "handoff", "from": item.source_agent.name, "to": item.target_agent.name}
+    return None
+
+
+async def _complete_turn(
+    thread_id: str,
+    updated_conversation: List[Dict[str, Any]],
+    tasks_in_thread: List[Dict[str, Any]],
+) -> ChatHistoryResponse:
+    """Saves the assistant reply (and any created task) and returns the thread."""
+    # ThreadTasks and assistant message writes share one unit of work.
+    saved_message_id = None
+    async with unit_of_work():
         # 3. Process agent's turn to generate the final response
         final_response_text = ""
 
@@ -268,7 +421,9 @@ async def handle_chat(
         )
 
         if final_assistant_message:
-            message_id = final_assistant_message.get("id", str(uuid.uuid4()))
+            # Always our own UUIDv7, never the SDK's "msg_..." id, so replies
+            # sort by message_id among rows with the same created_at.
+            message_id = new_id()
 
             if not final_response_text:
                 content = final_assistant_message.get("content", "")
@@ -292,36 +447,22 @@ async def handle_chat(
                                 {"message_id": message_id,"thread_id": thread_id,"author_type": "assistant","content":final_response_text},
                                 fetch_one=False
                     )
-
-        # 5. Return full updated chat history
-        # conn.ping(reconnect=True)
-        # cursor = get_safe_cursor()
-        # cursor.execute(
-        #     "SELECT message_id, author_type, content FROM Messages WHERE thread_id = %s ORDER BY created_at ASC",
-        #     (thread_id,)
-        # )
-        # final_db_history = cursor.fetchall()
-        # cursor.close()
-        async for conn in get_db_connection():  # get AsyncSession
-            final_db_history = await execute_query(
-                                conn,
-                                "SELECT message_id, author_type, content FROM Messages WHERE thread_id = :thread_id ORDER BY created_at ASC",
-                                {"thread_id": thread_id},
-                                fetch_one=False
-            )
-
-        formatted_messages = format_db_rows_for_response(final_db_history)
-        return ChatHistoryResponse(messages=formatted_messages)
-
-    except Exception as e:
-        error_message = f"An error occurred: {e}"
-        print(f"--- FATAL ERROR in handle_chat: {e} ---")
-        return ChatHistoryResponse(
-            messages=[Message(from_="Bot", text=error_message, id=str(uuid.uuid4()))]
-        )
-
-    finally:
-        if database_id and original_db_id:
-            os.environ["NOTION_TASKS_DATABASE_ID"] = original_db_id
-        # if conn and conn.is_connected():
-        #     conn.close()
+                saved_message_id = message_id
+
+    if saved_message_id:
+        await thread_cache.append(thread_id, saved_message_id, "assistant", final_response_text)
+
+    # 5. Return full updated chat history
+    # conn.ping(reconnect=True)
+    # cursor = get_safe_cursor()
+    # cursor.execute(
+    #     "SELECT message_id, author_type, content FROM Messages WHERE thread_id = %s ORDER BY created_at ASC",
+    #     (thread_id,)
+    # )
+    # final_db_history = cursor.fetchall()
+    # cursor.close()
+    # Served from the write-through thread cache; Messages is only read on a miss.
+    final_db_history = await thread_cache.get_messages(thread_id)
+
+    formatted_messages = format_db_rows_for_response(final_db_history)
+    return ChatHistoryResponse(messages=formatted_messages)
@@ -0,0 +1,294 @@
+# services/digest_scheduler.py
+
+import os
+import uuid
+import socket
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from db import get_db_connection, unit_of_work
+from services.notion_gateway import iter_database_query
+from services.outbound_dispatcher import dispatch_whatsapp_message
+from utils.db_helper import execute_query
+from utils.notion_projection import project_task
+from utils.recurrence import RecurrenceError, next_run_utc, utc_to_local
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+DEFAULT_TASKS_DATABASE_ID = os.getenv("NOTION_TASKS_DATABASE_ID")
+DIGEST_POLL_SECONDS = float(os.getenv("DIGEST_POLL_SECONDS", "60"))
+DIGEST_BATCH_SIZE = int(os.getenv("DIGEST_BATCH_SIZE", "500"))
+# A claimed schedule is invisible to other instances for this long.
+DIGEST_LEASE_SECONDS = float(os.getenv("DIGEST_LEASE_SECONDS", "300"))
+# Tasks listed per message; the rest are summarised as "...and N more".
+DIGEST_MAX_ITEMS = int(os.getenv("DIGEST_MAX_ITEMS", "15"))
+# Status values that mean a task is finished.
+DIGEST_DONE_STATUSES = [s.strip() for s in os.getenv("DIGEST_DONE_STATUSES", "Done").split(",") if s.strip()]
+
+DIGEST_KINDS = ("overdue", "open")
+
+DIGEST_TEMPLATES = {
+    "en": {
+        "overdue": "Hi {name}, you have {count} overdue task(s):",
+        "open": "Hi {name}, you have {count} open task(s):",
+        "overdue_mark": "overdue",
+        "due": "due",
+        "more": "...and {count} more.",
+    },
+    "ru": {
+        "overdue": "Здравствуйте, {name}! Просроченных задач: {count}.",
+        "open": "Здравствуйте, {name}! Открытых задач: {count}.",
+        "overdue_mark": "просрочено",
+        "due": "срок",
+        "more": "...и ещё {count}.",
+    },
+    "az": {
+        "overdue": "Salam, {name}! Gecikmiş tapşırıqlarınız: {count}.",
+        "open": "Salam, {name}! Açıq tapşırıqlarınız: {count}.",
+        "overdue_mark": "gecikib",
+        "due": "son tarix",
+        "more": "...və daha {count}.",
+    },
+}
+
+
+def _due_date(task: Dict[str, Any]) -> Optional[str]:
+    """The YYYY-MM-DD a task is due, whether 'Due Date' holds a date, a datetime or a range."""
+    due = task.get("Due Date")
+    if isinstance(due, dict):
+        due = due.get("end") or due.get("start")
+    return due[:10] if due else None
+
+
+def _project_digest_task(page: Dict[str, Any]) -> Dict[str, Any]:
+    """project_task plus the assignees' Notion user ids, which the digest is grouped by."""
+    task = project_task(page)
+    people = ((page.get("properties") or {}).get("Assignee") or {}).get("people") or []
+    task["assignee_ids"] = [person.get("id") for person in people if person.get("id")]
+    task["due"] = _due_date(task)
+    return task
+
+
+def format_digest(kind: str, language: str, username: str, tasks: List[Dict[str, Any]], today: str) -> Optional[str]:
+    """
+    Builds one WhatsApp message from a user's open tasks, or None when there
+    is nothing to report. `today` is the user's local date (YYYY-MM-DD).
+    """
+    texts = DIGEST_TEMPLATES.get(language) or DIGEST_TEMPLATES["en"]
+    if kind == "overdue":
+        tasks = [task for task in tasks if task["due"] and task["due"] < today]
+    if not tasks:
+        return None
+    tasks = sorted(tasks, key=lambda task: (task["due"] is None, task["due"] or ""))
+    lines = [texts[kind].format(name=username or "", count=len(tasks))]
+    for task in tasks[:DIGEST_MAX_ITEMS]:
+        details = []
+        if task["due"]:
+            details.append(f"{texts['due']} {task['due']}")
+            if kind == "open" and task["due"] < today:
+                details.append(texts["overdue_mark"])
+        if task.get("Priority"):
+            details.append(task["Priority"])
+        lines.append(f"• {task['Task'] or '(untitled)'}" + (f" ({', '.join(details)})" if details else ""))
+    if len(tasks) > DIGEST_MAX_ITEMS:
+        lines.append(texts["more"].format(count=len(tasks) - DIGEST_MAX_ITEMS))
+    return "\n".join(lines)
+
+
+class DigestScheduler:
+    """
+    Sends scheduled task digests ("my overdue tasks every morning") as one
+    WhatsApp message per user, without running the agent pipeline.
+
+    Every DIGEST_POLL_SECONDS the due DigestSchedules rows are claimed with a
+    lease (indexed on next_run_at) and grouped by department. Each
+    department's tasks database is queried once for all unfinished, assigned
+    tasks, and the result is split by assignee in memory. A department with
+    a hundred digests due at 9:00 costs one paginated Notion query, not a
+    hundred agent runs.
+
+    Advancing a schedule to its next occurrence commits together with the
+    queued WhatsApp message, as in ReminderScheduler. If a department's
+    query fails, its schedules keep their lease and are retried once it expires.
+    """
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()[:40]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.metrics = {
+            "claimed": 0, "sent": 0, "empty": 0, "no_phone": 0, "lease_lost": 0,
+            "department_queries": 0, "department_failures": 0, "tasks_scanned": 0,
+        }
+
+    async def _claim(self) -> List[Dict[str, Any]]:
+        lease_us = int(DIGEST_LEASE_SECONDS * 1_000_000)
+        async with unit_of_work():
+            async for conn in get_db_connection():
+                rows = await execute_query(
+                    conn,
+                    """
+                    SELECT schedule_id FROM DigestSchedules
+                    WHERE next_run_at <= UTC_TIMESTAMP(3)
+                      AND (lease_expires_at IS NULL OR lease_expires_at < UTC_TIMESTAMP(3))
+                    ORDER BY next_run_at
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED
+                    """,
+                    {"limit": DIGEST_BATCH_SIZE},
+                    fetch_one=False
+                )
+                if not rows:
+                    return []
+                ids = {f"id_{i}": row["schedule_id"] for i, row in enumerate(rows)}
+                placeholders = ", ".join(f":{key}" for key in ids)
+                await execute_query(
+                    conn,
+                    f"""
+                    UPDATE DigestSchedules
+                    SET lease_owner = :owner, lease_expires_at = UTC_TIMESTAMP(3) + INTERVAL :lease_us MICROSECOND
+                    WHERE schedule_id IN ({placeholders})
+                    """,
+                    {"owner": self.owner, "lease_us": lease_us, **ids},
+                    fetch_one=False
+                )
+                schedules = await execute_query(
+                    conn,
+                    f"""
+                    SELECT s.schedule_id, s.kind, s.recurrence_rule, s.timezone, s.language, s.next_run_at,
+                           u.notion_user_id, u.phone_number, u.username, d.database_id
+                    FROM DigestSchedules s
+                    JOIN Users u ON u.user_id = s.user_id
+                    LEFT JOIN DepartmentUser du ON du.user_id = u.user_id
+                    LEFT JOIN Departments d ON d.department_id = du.department_id
+                    WHERE s.schedule_id IN ({placeholders})
+                    """,
+                    ids,
+                    fetch_one=False
+                )
+        claimed: Dict[str, Dict[str, Any]] = {}
+        for schedule in schedules:
+            # A user in several departments: keep the first one with a database.
+            current = claimed.get(schedule["schedule_id"])
+            if current is None or (not current["database_id"] and schedule["database_id"]):
+                claimed[schedule["schedule_id"]] = dict(schedule)
+        orphaned = {key: schedule_id for key, schedule_id in ids.items() if schedule_id not in claimed}
+        if orphaned:
+            # The user was deleted; stop the schedule instead of re-claiming it forever.
+            async for conn in get_db_connection():
+                await execute_query(
+                    conn,
+                    f"UPDATE DigestSchedules SET next_run_at = NULL, lease_owner = NULL WHERE schedule_id IN ({', '.join(f':{key}' for key in orphaned)})",
+                    orphaned,
+                    fetch_one=False
+                )
+        self.metrics["claimed"] += len(claimed)
+        return list(claimed.values())
+
+    async def _open_tasks_by_assignee(self, database_id: str) -> Dict[str, List[Dict[str, Any]]]:
+        """One query for every unfinished, assigned task of a department, grouped by assignee."""
+        conditions: List[Dict[str, Any]] = [{"property": "Assignee", "people": {"is_not_empty": True}}]
+        conditions += [{"property": "Status", "status": {"does_not_equal": status}} for status in DIGEST_DONE_STATUSES]
+        by_assignee: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self.metrics["department_queries"] += 1
+        async for task in iter_database_query(
+            database_id,
+            filter={"and": conditions},
+            sorts=[{"property": "Due Date", "direction": "ascending"}],
+            project=_project_digest_task,
+        ):
+            self.metrics["tasks_scanned"] += 1
+            for assignee_id in task["assignee_ids"]:
+                by_assignee[assignee_id].append(task)
+        return by_assignee
+
+    async def _finish(self, schedule: Dict[str, Any], message: Optional[str]) -> None:
+        """Moves the schedule to its next occurrence and queues its message, in one transaction."""
+        try:
+            next_run_at = next_run_utc(schedule["recurrence_rule"], schedule["next_run_at"], schedule["timezone"])
+        except RecurrenceError as e:
+            logger.error(f"Digest schedule {schedule['schedule_id']} has an invalid recurrence rule, stopping it: {e}")
+            next_run_at = None
+        async with unit_of_work():
+            async for conn in get_db_connection():
+                advanced = await execute_query(
+                    conn,
+                    """
+                    UPDATE DigestSchedules
+                    SET next_run_at = :next_run_at, last_run_at = UTC_TIMESTAMP(3), lease_owner = NULL, lease_expires_at = NULL
+                    WHERE schedule_id = :schedule_id AND lease_owner = :owner
+                    """,
+                    {"schedule_id": schedule["schedule_id"], "next_run_at": next_run_at, "owner": self.owner},
+                    fetch_one=False
+                )
+            if not advanced:
+                self.metrics["lease_lost"] += 1
+                return
+            if message:
+                await dispatch_whatsapp_message(schedule["phone_number"], message, kind="digest")
+        if message:
+            self.metrics["sent"] += 1
+        else:
+            self.metrics["empty"] += 1
+
+    async def run_once(self) -> int:
+        """Sends one batch of due digests. Returns how many schedules were claimed."""
+        schedules = await self._claim()
+        by_database: Dict[Optional[str], List[Dict[str, Any]]] = defaultdict(list)
+        for schedule in schedules:
+            by_database[schedule["database_id"] or DEFAULT_TASKS_DATABASE_ID].append(schedule)
+
+        for database_id, department_schedules in by_database.items():
+            if not database_id:
+                logger.warning(f"{len(department_schedules)} digest(s) have no tasks database; skipping them.")
+                tasks_by_assignee: Dict[str, List[Dict[str, Any]]] = {}
+            else:
+                try:
+                    tasks_by_assignee = await self._open_tasks_by_assignee(database_id)
+                except Exception as e:
+                    # Leases expire and the schedules are retried on a later poll.
+                    self.metrics["department_failures"] += 1
+                    logger.error(f"Digest query for database {database_id} failed: {e}")
+                    continue
+            now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+            for schedule in department_schedules:
+                message = None
+                if schedule["phone_number"]:
+                    today = utc_to_local(now_utc, schedule["timezone"]).date().isoformat()
+                    message = format_digest(
+                        schedule["kind"],
+                        schedule["language"],
+                        schedule["username"],
+                        tasks_by_assignee.get(schedule["notion_user_id"], []),
+                        today,
+                    )
+                else:
+                    self.metrics["no_phone"] += 1
+                try:
+                    await self._finish(schedule, message)
+                except Exception as e:
+                    logger.error(f"Could not finish digest schedule {schedule['schedule_id']}: {e}")
+        return len(schedules)
+
+    async def run(self) -> None:
+        """Scheduler loop; started as a background task on startup."""
+        logger.info(f"Digest scheduler {self.owner} started.")
+        while True:
+            try:
+                # Keep going while full batches come back (e.g. everyone at 9:00).
+                while await self.run_once() >= DIGEST_BATCH_SIZE:
+                    pass
+            except Exception as e:
+                logger.error(f"Digest scheduler pass failed: {e}")
+            await asyncio.sleep(DIGEST_POLL_SECONDS)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self.metrics)
+
+
+digest_scheduler = DigestScheduler()
@@ -0,0 +1,272 @@
+# services/history_manager.py
+
+import os
+import asyncio
+import logging
+import weakref
+import contextvars
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+from db import get_db_connection, unit_of_work
+from utils.cache import TTLCache
+from utils.db_helper import execute_query
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+# Most recent messages sent to the agents word for word.
+HISTORY_VERBATIM_MESSAGES = int(os.getenv("HISTORY_VERBATIM_MESSAGES", "20"))
+# Rough token budget (chars / 4) for summary + verbatim messages.
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "6000"))
+# Older messages are folded into the summary once this many have piled up.
+HISTORY_SUMMARY_BATCH = int(os.getenv("HISTORY_SUMMARY_BATCH", "10"))
+HISTORY_SUMMARY_MAX_FOLD = int(os.getenv("HISTORY_SUMMARY_MAX_FOLD", "60"))
+# Unsummarised messages kept in memory per thread. Only reached while folding
+# keeps failing; the oldest are then dropped (they are still in Messages and
+# are read again once the window is reloaded from ThreadSummaries).
+HISTORY_MAX_PENDING_MESSAGES = int(os.getenv(
+    "HISTORY_MAX_PENDING_MESSAGES", str(HISTORY_VERBATIM_MESSAGES + HISTORY_SUMMARY_MAX_FOLD)
+))
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gpt-4.1-mini")
+HISTORY_SUMMARY_TIMEOUT_SECONDS = float(os.getenv("HISTORY_SUMMARY_TIMEOUT_SECONDS", "30"))
+HISTORY_WINDOW_CACHE_SIZE = int(os.getenv("HISTORY_WINDOW_CACHE_SIZE", "1024"))
+# WhatsApp threads go idle after 6 hours, so windows are not worth keeping longer.
+HISTORY_WINDOW_TTL_SECONDS = float(os.getenv("HISTORY_WINDOW_TTL_SECONDS", str(6 * 3600)))
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and a task-management assistant "
+    "backed by Notion. Update the existing summary with the new messages. Keep task names, page IDs, "
+    "people, dates, priorities, statuses and any open questions or pending confirmations. "
+    "Drop greetings and filler. Answer with the updated summary only, at most 200 words."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text or "") // 4 + 4
+
+
+@dataclass
+class ThreadWindow:
+    """What we know about one thread: the stored summary and the unsummarised tail."""
+    summary: str = ""
+    summarized_through: Optional[datetime] = None
+    summarized_count: int = 0
+    # Unsummarised rows in created_at order: message_id, author_type, content, created_at.
+    messages: List[Dict[str, Any]] = field(default_factory=list)
+    # Read cursor: newest created_at seen and the ids seen at exactly that timestamp.
+    cursor: Optional[datetime] = None
+    ids_at_cursor: Set[str] = field(default_factory=set)
+    # True while the cursor is the summary boundary, whose rows are all folded.
+    cursor_exclusive: bool = False
+    folding: bool = False
+
+
+class HistoryManager:
+    """
+    Builds the conversation input for Runner.run without re-reading the whole
+    thread on every turn.
+
+    Each thread keeps a cursor, so a turn only reads the Messages rows written
+    since the previous one. The agents see a stored summary of older turns plus
+    the last HISTORY_VERBATIM_MESSAGES messages that fit HISTORY_TOKEN_BUDGET.
+    Messages that fall out of that window are folded into the summary in
+    batches, in the background, and persisted in ThreadSummaries. Until then
+    they are left out of the context. If folding keeps failing, at most
+    HISTORY_MAX_PENDING_MESSAGES unsummarised messages are kept per thread.
+    """
+
+    def __init__(self):
+        self._windows = TTLCache(
+            maxsize=HISTORY_WINDOW_CACHE_SIZE,
+            ttl_seconds=HISTORY_WINDOW_TTL_SECONDS,
+            name="history_windows",
+        )
+        # Per-thread locks live only while some load() holds a reference.
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._background: Set[asyncio.Task] = set()
+        self._client: Optional[AsyncOpenAI] = None
+
+    async def load(self, thread_id: str) -> List[Dict[str, Any]]:
+        """Returns the input items (summary + recent messages) for the next agent run."""
+        lock = self._locks.get(thread_id)
+        if lock is None:
+            lock = self._locks[thread_id] = asyncio.Lock()
+        async with lock:
+            window = self._windows.get(thread_id)
+            if window is None:
+                window = await self._load_window(thread_id)
+                self._windows.set(thread_id, window)
+            else:
+                await self._read_new_rows(thread_id, window)
+
+            self._cap_pending(thread_id, window)
+            items, overflow = self._build_context(window)
+            if overflow:
+                logger.info(
+                    f"Thread {thread_id}: {len(overflow)} message(s) beyond the history window are left out "
+                    f"of this turn until they are summarised."
+                )
+            if len(overflow) >= HISTORY_SUMMARY_BATCH and not window.folding:
+                self._schedule_fold(thread_id, window, overflow)
+            return items
+
+    def forget(self, thread_id: str) -> None:
+        """Drops the in-memory window; the next load starts from ThreadSummaries again."""
+        self._windows.invalidate(thread_id)
+
+    def _cap_pending(self, thread_id: str, window: ThreadWindow) -> None:
+        excess = len(window.messages) - HISTORY_MAX_PENDING_MESSAGES
+        if excess <= 0:
+            return
+        window.messages = window.messages[excess:]
+        logger.warning(
+            f"Thread {thread_id}: dropped the {excess} oldest unsummarised message(s) from the history "
+            f"window; summarising has not kept up."
+        )
+
+    # --- Reading ---
+
+    async def _load_window(self, thread_id: str) -> ThreadWindow:
+        window = ThreadWindow()
+        async for conn in get_db_connection():
+            row = await execute_query(
+                conn,
+                "SELECT summary, summarized_through, message_count FROM ThreadSummaries WHERE thread_id = :thread_id",
+                {"thread_id": thread_id},
+                fetch_one=True
+            )
+        if row:
+            window.summary = row["summary"]
+            window.summarized_through = row["summarized_through"]
+            window.summarized_count = row["message_count"]
+            window.cursor = row["summarized_through"]
+            window.cursor_exclusive = True
+        await self._read_new_rows(thread_id, window)
+        return window
+
+    async def _read_new_rows(self, thread_id: str, window: ThreadWindow) -> None:
+        query = "SELECT message_id, author_type, content, created_at FROM Messages WHERE thread_id = :thread_id"
+        params: Dict[str, Any] = {"thread_id": thread_id}
+        if window.cursor is not None:
+            # created_at is second-granular, so re-read the cursor second and
+            # skip the ids we already have.
+            query += " AND created_at > :cursor" if window.cursor_exclusive else " AND created_at >= :cursor"
+            params["cursor"] = window.cursor
+        # created_at ties (a message and its reply in one second) are broken by
+        # message_id: UUIDv7 ids sort by creation time. Legacy UUID4 ids keep
+        # the arbitrary tie order they always had.
+        query += " ORDER BY created_at ASC, message_id ASC"
+
+        async for conn in get_db_connection():
+            rows = await execute_query(conn, query, params, fetch_one=False)
+
+        for row in rows:
+            if row["created_at"] == window.cursor and row["message_id"] in window.ids_at_cursor:
+                continue
+            window.messages.append(dict(row))
+            if window.cursor is None or row["created_at"] > window.cursor:
+                window.cursor = row["created_at"]
+                window.ids_at_cursor = set()
+                window.cursor_exclusive = False
+            window.ids_at_cursor.add(row["message_id"])
+
+    def _build_context(self, window: ThreadWindow):
+        """Splits the unsummarised tail into the verbatim window and the overflow to fold."""
+        budget = HISTORY_TOKEN_BUDGET
+        items: List[Dict[str, Any]] = []
+        if window.summary:
+            summary_item = {
+                "role": "system",
+                "content": f"Summary of the earlier conversation in this thread:\n{window.summary}",
+            }
+            items.append(summary_item)
+            budget -= estimate_tokens(summary_item["content"])
+
+        verbatim: List[Dict[str, Any]] = []
+        for row in reversed(window.messages):
+            cost = estimate_tokens(row["content"])
+            if len(verbatim) >= HISTORY_VERBATIM_MESSAGES or (verbatim and cost > budget):
+                break
+            verbatim.append(row)
+            budget -= cost
+        verbatim.reverse()
+
+        overflow = window.messages[:len(window.messages) - len(verbatim)]
+        items += [{"role": row["author_type"], "content": row["content"]} for row in verbatim]
+        return items, overflow
+
+    # --- Summarising ---
+
+    def _schedule_fold(self, thread_id: str, window: ThreadWindow, overflow: List[Dict[str, Any]]) -> None:
+        # Never fold part of a second: ThreadSummaries.summarized_through is a
+        # timestamp, and the cold load reads strictly after it.
+        boundary = len(overflow)
+        if boundary < len(window.messages):
+            next_created_at = window.messages[boundary]["created_at"]
+            while boundary and overflow[boundary - 1]["created_at"] == next_created_at:
+                boundary -= 1
+        batch = overflow[:min(boundary, HISTORY_SUMMARY_MAX_FOLD)]
+        if not batch:
+            return
+
+        window.folding = True
+        # Run in a fresh context so the task never inherits the caller's unit of work.
+        task = asyncio.create_task(self._fold(thread_id, window, batch), context=contextvars.Context())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _fold(self, thread_id: str, window: ThreadWindow, batch: List[Dict[str, Any]]) -> None:
+        try:
+            if self._client is None:
+                self._client = AsyncOpenAI()
+            transcript = "\n".join(f"{row['author_type']}: {row['content']}" for row in batch)
+            response = await self._client.chat.completions.create(
+                model=HISTORY_SUMMARY_MODEL,
+                messages=[
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": f"Existing summary:\n{window.summary or '(none)'}\n\nNew messages:\n{transcript}"},
+                ],
+                temperature=0,
+                timeout=HISTORY_SUMMARY_TIMEOUT_SECONDS,
+            )
+            summary = (response.choices[0].message.content or "").strip()
+            if not summary:
+                return
+
+            summarized_through = batch[-1]["created_at"]
+            summarized_count = window.summarized_count + len(batch)
+            async with unit_of_work():
+                async for conn in get_db_connection():
+                    await execute_query(
+                        conn,
+                        """
+                        INSERT INTO ThreadSummaries (thread_id, summary, summarized_through, message_count)
+                        VALUES (:thread_id, :summary, :summarized_through, :message_count)
+                        ON DUPLICATE KEY UPDATE
+                            summary = VALUES(summary),
+                            summarized_through = VALUES(summarized_through),
+                            message_count = VALUES(message_count)
+                        """,
+                        {"thread_id": thread_id, "summary": summary, "summarized_through": summarized_through, "message_count": summarized_count},
+                        fetch_one=False
+                    )
+
+            folded_ids = {row["message_id"] for row in batch}
+            window.messages = [row for row in window.messages if row["message_id"] not in folded_ids]
+            window.summary = summary
+            window.summarized_through = summarized_through
+            window.summarized_count = summarized_count
+            logger.info(f"Folded {len(batch)} messages of thread {thread_id} into its summary.")
+        except Exception as e:
+            logger.error(f"Could not update the summary of thread {thread_id}: {e}")
+        finally:
+            window.folding = False
+
+
+history_manager = HistoryManager()
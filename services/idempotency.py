@@ -0,0 +1,103 @@
+# services/idempotency.py
+
+import os
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+
+from db import get_db_connection
+from utils.cache import TTLCache
+from utils.db_helper import execute_query
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+WEBHOOK_DEDUP_CACHE_SIZE = int(os.getenv("WEBHOOK_DEDUP_CACHE_SIZE", "50000"))
+WEBHOOK_DEDUP_CACHE_TTL_SECONDS = float(os.getenv("WEBHOOK_DEDUP_CACHE_TTL_SECONDS", str(24 * 3600)))
+# Meta keeps retrying an unacknowledged webhook for up to 7 days.
+WEBHOOK_DEDUP_RETENTION_DAYS = int(os.getenv("WEBHOOK_DEDUP_RETENTION_DAYS", "8"))
+WEBHOOK_DEDUP_PRUNE_INTERVAL_SECONDS = float(os.getenv("WEBHOOK_DEDUP_PRUNE_INTERVAL_SECONDS", "3600"))
+
+
+class WebhookIdempotencyStore:
+    """
+    Remembers which WhatsApp message ids have been accepted so redelivered
+    webhooks do not run the agent pipeline again.
+
+    ProcessedWebhookMessages is the source of truth: claim() does an
+    INSERT IGNORE on its primary key, which is atomic across instances and
+    concurrent deliveries. An LRU of recently seen ids sits in front so most
+    retries are answered without a query.
+
+    Call claim() in the same unit_of_work() as the enqueue, and remember()
+    once that unit of work has committed. A rolled-back claim then leaves no
+    trace, and Meta's next retry is accepted.
+    """
+
+    def __init__(self):
+        self._seen = TTLCache(
+            maxsize=WEBHOOK_DEDUP_CACHE_SIZE,
+            ttl_seconds=WEBHOOK_DEDUP_CACHE_TTL_SECONDS,
+            name="webhook_message_ids",
+        )
+        self.metrics = {"claimed": 0, "duplicates_cached": 0, "duplicates_db": 0}
+
+    async def claim(self, message_id: str, from_number: Optional[str] = None) -> bool:
+        """True if this call claimed message_id; False if it was already processed."""
+        if message_id in self._seen:
+            self.metrics["duplicates_cached"] += 1
+            return False
+
+        async for conn in get_db_connection():
+            inserted = await execute_query(
+                conn,
+                "INSERT IGNORE INTO ProcessedWebhookMessages (message_id, from_number) VALUES (:message_id, :from_number)",
+                {"message_id": message_id, "from_number": from_number},
+                fetch_one=False
+            )
+        if not inserted:
+            self.metrics["duplicates_db"] += 1
+            self._seen.set(message_id, True)
+            return False
+        self.metrics["claimed"] += 1
+        return True
+
+    def remember(self, message_id: str) -> None:
+        """Adds a committed claim to the in-memory front."""
+        self._seen.set(message_id, True)
+
+    async def prune(self) -> int:
+        async for conn in get_db_connection():
+            deleted = await execute_query(
+                conn,
+                "DELETE FROM ProcessedWebhookMessages WHERE received_at < NOW(3) - INTERVAL :days DAY",
+                {"days": WEBHOOK_DEDUP_RETENTION_DAYS},
+                fetch_one=False
+            )
+        return deleted or 0
+
+    async def run_prune_loop(self) -> None:
+        """Drops ids older than the retention window; started as a background task on startup."""
+        while True:
+            try:
+                deleted = await self.prune()
+                logger.info(f"Pruned {deleted} processed webhook message ids. Dedup stats: {self.stats()}")
+            except Exception as e:
+                logger.error(f"Webhook dedup pruning failed: {e}")
+            await asyncio.sleep(WEBHOOK_DEDUP_PRUNE_INTERVAL_SECONDS)
+
+    def stats(self) -> Dict[str, Any]:
+        duplicates = self.metrics["duplicates_cached"] + self.metrics["duplicates_db"]
+        seen = duplicates + self.metrics["claimed"]
+        return {
+            **self.metrics,
+            "duplicates_suppressed": duplicates,
+            "duplicate_rate": round(duplicates / seen, 4) if seen else 0.0,
+            "cache": self._seen.stats(),
+        }
+
+
+webhook_idempotency = WebhookIdempotencyStore()
@@ -0,0 +1,663 @@
+# services/job_queue.py
+
+import os
+import json
+import uuid
+import time
+import random
+import socket
+import asyncio
+import logging
+import contextvars
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+from db import get_db_connection, unit_of_work
+from utils.db_helper import execute_query
+from utils.id_generator import new_id
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+# "mysql" (durable, shared by every instance) or "memory" (local development only).
+JOB_QUEUE_BACKEND = os.getenv("JOB_QUEUE_BACKEND", "mysql")
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "4"))
+# Outbound WhatsApp sends run on their own workers: an agent turn takes
+# seconds, a send milliseconds, and neither kind may hold up the other.
+SEND_JOB_KINDS: Tuple[str, ...] = ("whatsapp_send",)
+JOB_SEND_WORKER_CONCURRENCY = int(os.getenv("JOB_SEND_WORKER_CONCURRENCY", "4"))
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "1.0"))
+# A claimed job is invisible to other workers for this long; running jobs
+# renew the lease, so it only expires when the worker died.
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "5"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "600"))
+JOB_SHUTDOWN_GRACE_SECONDS = float(os.getenv("JOB_SHUTDOWN_GRACE_SECONDS", "20"))
+
+JobHandler = Callable[[Any], Awaitable[None]]
+_handlers: Dict[str, JobHandler] = {}
+_batch_sizes: Dict[str, int] = {}
+
+
+class JobDeferred(Exception):
+    """
+    Raised by a handler that cannot run yet (e.g. a rate limit is exhausted).
+    The job goes back to the queue for `delay_seconds` without counting as a
+    failed attempt, and keeps its place in its lane.
+    """
+
+    def __init__(self, delay_seconds: float, reason: str = ""):
+        super().__init__(reason or f"deferred for {delay_seconds:.2f}s")
+        self.delay_seconds = delay_seconds
+
+
+def job_handler(kind: str, batch_size: int = 1):
+    """
+    Registers the coroutine that processes jobs of the given kind.
+
+    With batch_size > 1 the handler receives a list of payloads: the claimed
+    job plus up to batch_size - 1 fresh jobs queued right behind it in the
+    same lane, which are claimed together and processed as one.
+    """
+    def register(func: JobHandler) -> JobHandler:
+        _handlers[kind] = func
+        _batch_sizes[kind] = batch_size
+        return func
+    return register
+
+
+@dataclass
+class Job:
+    job_id: str
+    kind: str
+    payload: Dict[str, Any]
+    # Attempts so far, including the one in progress.
+    attempts: int
+    max_attempts: int
+    # Jobs with the same lane_key run one at a time, in enqueue order.
+    lane_key: Optional[str] = None
+    seq: Optional[int] = None
+    created_at: Optional[datetime] = None
+
+
+def retry_delay(attempts: int) -> float:
+    """Exponential backoff with jitter: roughly base * 2^(attempts-1), capped."""
+    ceiling = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+def _micros(seconds: float) -> int:
+    return int(seconds * 1_000_000)
+
+
+def _kind_filter(kinds: Optional[Sequence[str]], exclude_kinds: Sequence[str]) -> Tuple[str, Dict[str, Any]]:
+    """SQL condition (on alias j) and params restricting a claim to some job kinds."""
+    clauses, params = [], {}
+    for op, names, prefix in (("IN", kinds, "kind"), ("NOT IN", exclude_kinds, "excluded_kind")):
+        if names:
+            params.update({f"{prefix}_{i}": name for i, name in enumerate(names)})
+            clauses.append(f"AND j.kind {op} ({', '.join(f':{prefix}_{i}' for i in range(len(names)))})")
+    return " ".join(clauses), params
+
+
+def _kind_allowed(kind: str, kinds: Optional[Sequence[str]], exclude_kinds: Sequence[str]) -> bool:
+    return (kinds is None or kind in kinds) and kind not in exclude_kinds
+
+
+def _row_to_job(row: Dict[str, Any]) -> Job:
+    return Job(
+        job_id=row["job_id"],
+        kind=row["kind"],
+        payload=json.loads(row["payload"]) if isinstance(row["payload"], (str, bytes)) else row["payload"],
+        attempts=row["attempts"] + 1,
+        max_attempts=row["max_attempts"],
+        lane_key=row["lane_key"],
+        seq=row["seq"],
+        created_at=row["created_at"],
+    )
+
+
+class MySQLJobBackend:
+    """
+    Jobs in the WebhookJobs table (migrations/003_webhook_jobs.sql).
+
+    Workers claim with SELECT ... FOR UPDATE SKIP LOCKED, so any number of
+    instances can poll the table without blocking each other. Claiming moves
+    available_at to the end of the lease; if the worker dies the job simply
+    becomes claimable again (at-least-once delivery). All times come from the
+    database clock so instances with skewed clocks agree.
+
+    Only the oldest job (lowest seq) of each lane_key is claimable, so a
+    lane's jobs run strictly one after another, including across retries,
+    while different lanes run in parallel.
+    """
+
+    async def enqueue(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        delay_seconds: float = 0.0,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+        lane_key: Optional[str] = None,
+    ) -> str:
+        job_id = new_id()
+        async for conn in get_db_connection():
+            await execute_query(
+                conn,
+                """
+                INSERT INTO WebhookJobs (job_id, kind, payload, max_attempts, lane_key, available_at)
+                VALUES (:job_id, :kind, :payload, :max_attempts, :lane_key, NOW(3) + INTERVAL :delay_us MICROSECOND)
+                """,
+                {
+                    "job_id": job_id, "kind": kind, "payload": json.dumps(payload), "max_attempts": max_attempts,
+                    "lane_key": lane_key, "delay_us": _micros(delay_seconds),
+                },
+                fetch_one=False
+            )
+        return job_id
+
+    async def claim(
+        self,
+        worker_id: str,
+        limit: int = 1,
+        kinds: Optional[Sequence[str]] = None,
+        exclude_kinds: Sequence[str] = (),
+    ) -> List[Job]:
+        kind_filter, kind_params = _kind_filter(kinds, exclude_kinds)
+        async with unit_of_work():
+            async for conn in get_db_connection():
+                rows = await execute_query(
+                    conn,
+                    f"""
+                    SELECT j.job_id, j.kind, j.payload, j.attempts, j.max_attempts, j.lane_key, j.seq, j.created_at
+                    FROM WebhookJobs j
+                    WHERE j.available_at <= NOW(3)
+                      {kind_filter}
+                      AND NOT EXISTS (
+                          SELECT 1 FROM WebhookJobs earlier
+                          WHERE earlier.lane_key = j.lane_key AND earlier.seq < j.seq
+                      )
+                    ORDER BY j.available_at
+                    LIMIT :limit
+                    FOR UPDATE OF j SKIP LOCKED
+                    """,
+                    {"limit": limit, **kind_params},
+                    fetch_one=False
+                )
+                if not rows:
+                    return []
+                await self._lease(conn, worker_id, rows)
+        return [_row_to_job(row) for row in rows]
+
+    async def claim_followers(self, job: Job, worker_id: str, limit: int) -> List[Job]:
+        """
+        Claims up to `limit` jobs queued directly behind `job` in its lane that
+        have the same kind and have never been attempted, so they can be
+        processed together with it.
+        """
+        if not job.lane_key or limit <= 0:
+            return []
+        async with unit_of_work():
+            async for conn in get_db_connection():
+                rows = await execute_query(
+                    conn,
+                    """
+                    SELECT job_id, kind, payload, attempts, max_attempts, lane_key, seq, created_at, locked_by
+                    FROM WebhookJobs
+                    WHERE lane_key = :lane_key AND seq > :seq
+                    ORDER BY seq
+                    LIMIT :limit
+                    FOR UPDATE SKIP LOCKED
+                    """,
+                    {"lane_key": job.lane_key, "seq": job.seq, "limit": limit},
+                    fetch_one=False
+                )
+                # Only a contiguous run keeps the lane's order intact.
+                followers = []
+                for row in rows:
+                    if row["kind"] != job.kind or row["attempts"] or row["locked_by"]:
+                        break
+                    followers.append(row)
+                if not followers:
+                    return []
+                await self._lease(conn, worker_id, followers)
+        return [_row_to_job(row) for row in followers]
+
+    async def _lease(self, conn, worker_id: str, rows: List[Dict[str, Any]]) -> None:
+        params: Dict[str, Any] = {"worker_id": worker_id, "lease_us": _micros(JOB_LEASE_SECONDS)}
+        params.update({f"id_{i}": row["job_id"] for i, row in enumerate(rows)})
+        placeholders = ", ".join(f":id_{i}" for i in range(len(rows)))
+        await execute_query(
+            conn,
+            f"""
+            UPDATE WebhookJobs
+            SET status = 'running', attempts = attempts + 1, locked_by = :worker_id,
+                available_at = NOW(3) + INTERVAL :lease_us MICROSECOND
+            WHERE job_id IN ({placeholders})
+            """,
+            params,
+            fetch_one=False
+        )
+
+    async def defer_lane(self, kind: str, lane_key: str, delay_seconds: float, max_delay_seconds: float) -> None:
+        """
+        Debounce: pushes back lane jobs of `kind` that are still waiting out
+        their initial delay to `delay_seconds` from now, but never beyond
+        `max_delay_seconds` after they were enqueued.
+        """
+        async for conn in get_db_connection():
+            await execute_query(
+                conn,
+                """
+                UPDATE WebhookJobs
+                SET available_at = GREATEST(
+                    available_at,
+                    LEAST(NOW(3) + INTERVAL :delay_us MICROSECOND, created_at + INTERVAL :max_delay_us MICROSECOND)
+                )
+                WHERE lane_key = :lane_key AND kind = :kind AND attempts = 0 AND locked_by IS NULL
+                  AND available_at > NOW(3)
+                """,
+                {"lane_key": lane_key, "kind": kind, "delay_us": _micros(delay_seconds), "max_delay_us": _micros(max_delay_seconds)},
+                fetch_one=False
+            )
+
+    async def extend(self, job: Job, worker_id: str) -> bool:
+        async for conn in get_db_connection():
+            updated = await execute_query(
+                conn,
+                """
+                UPDATE WebhookJobs SET available_at = NOW(3) + INTERVAL :lease_us MICROSECOND
+                WHERE job_id = :job_id AND locked_by = :worker_id
+                """,
+                {"job_id": job.job_id, "worker_id": worker_id, "lease_us": _micros(JOB_LEASE_SECONDS)},
+                fetch_one=False
+            )
+        return bool(updated)
+
+    async def complete(self, job: Job, worker_id: str) -> bool:
+        async for conn in get_db_connection():
+            deleted = await execute_query(
+                conn,
+                "DELETE FROM WebhookJobs WHERE job_id = :job_id AND locked_by = :worker_id",
+                {"job_id": job.job_id, "worker_id": worker_id},
+                fetch_one=False
+            )
+        return bool(deleted)
+
+    async def fail(self, job: Job, worker_id: str, error: str) -> bool:
+        """Schedules a retry, or moves the job to the dead-letter table. Returns True if dead-lettered."""
+        params = {"job_id": job.job_id, "worker_id": worker_id, "error": error[:4000]}
+        if job.attempts >= job.max_attempts:
+            async with unit_of_work():
+                async for conn in get_db_connection():
+                    await execute_query(
+                        conn,
+                        """
+                        INSERT INTO WebhookJobsDeadLetter (job_id, kind, payload, attempts, last_error, created_at)
+                        SELECT job_id, kind, payload, attempts, :error, created_at
+                        FROM WebhookJobs WHERE job_id = :job_id AND locked_by = :worker_id
+                        """,
+                        params,
+                        fetch_one=False
+                    )
+                    await execute_query(
+                        conn,
+                        "DELETE FROM WebhookJobs WHERE job_id = :job_id AND locked_by = :worker_id",
+                        params,
+                        fetch_one=False
+                    )
+            return True
+
+        async for conn in get_db_connection():
+            await execute_query(
+                conn,
+                """
+                UPDATE WebhookJobs
+                SET status = 'pending', locked_by = NULL, last_error = :error,
+                    available_at = NOW(3) + INTERVAL :delay_us MICROSECOND
+                WHERE job_id = :job_id AND locked_by = :worker_id
+                """,
+                {**params, "delay_us": _micros(retry_delay(job.attempts))},
+                fetch_one=False
+            )
+        return False
+
+    async def release(self, job: Job, worker_id: str, delay_seconds: float = 0.0) -> None:
+        """
+        Hands an unfinished job back without counting the attempt (on shutdown,
+        or `delay_seconds` later for a deferred job).
+        """
+        async for conn in get_db_connection():
+            await execute_query(
+                conn,
+                """
+                UPDATE WebhookJobs
+                SET status = 'pending', locked_by = NULL, attempts = GREATEST(attempts - 1, 0),
+                    available_at = NOW(3) + INTERVAL :delay_us MICROSECOND
+                WHERE job_id = :job_id AND locked_by = :worker_id
+                """,
+                {"job_id": job.job_id, "worker_id": worker_id, "delay_us": _micros(delay_seconds)},
+                fetch_one=False
+            )
+
+
+class InMemoryJobBackend:
+    """
+    Same contract as MySQLJobBackend, kept in process memory. Jobs are lost on
+    restart, so this is only meant for local development.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._seq = 0
+        self.dead_letters: List[Dict[str, Any]] = []
+
+    async def enqueue(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        delay_seconds: float = 0.0,
+        max_attempts: int = JOB_MAX_ATTEMPTS,
+        lane_key: Optional[str] = None,
+    ) -> str:
+        job_id = new_id()
+        self._seq += 1
+        now = time.monotonic()
+        self._jobs[job_id] = {
+            "job": Job(job_id=job_id, kind=kind, payload=payload, attempts=0, max_attempts=max_attempts, lane_key=lane_key, seq=self._seq, created_at=datetime.now()),
+            "seq": self._seq,
+            "enqueued_at": now,
+            "available_at": now + delay_seconds,
+            "locked_by": None,
+        }
+        return job_id
+
+    async def claim_followers(self, job: Job, worker_id: str, limit: int) -> List[Job]:
+        if not job.lane_key or limit <= 0:
+            return []
+        behind = sorted(
+            (r for r in self._jobs.values() if r["job"].lane_key == job.lane_key and r["seq"] > job.seq),
+            key=lambda r: r["seq"],
+        )[:limit]
+        followers = []
+        for record in behind:
+            if record["job"].kind != job.kind or record["job"].attempts or record["locked_by"]:
+                break
+            record["job"].attempts += 1
+            record["locked_by"] = worker_id
+            record["available_at"] = time.monotonic() + JOB_LEASE_SECONDS
+            followers.append(record["job"])
+        return followers
+
+    async def defer_lane(self, kind: str, lane_key: str, delay_seconds: float, max_delay_seconds: float) -> None:
+        now = time.monotonic()
+        for record in self._jobs.values():
+            job = record["job"]
+            if (job.lane_key == lane_key and job.kind == kind and not job.attempts
+                    and record["locked_by"] is None and record["available_at"] > now):
+                deferred = min(now + delay_seconds, record["enqueued_at"] + max_delay_seconds)
+                record["available_at"] = max(record["available_at"], deferred)
+
+    async def claim(
+        self,
+        worker_id: str,
+        limit: int = 1,
+        kinds: Optional[Sequence[str]] = None,
+        exclude_kinds: Sequence[str] = (),
+    ) -> List[Job]:
+        now = time.monotonic()
+        lane_heads: Dict[str, int] = {}
+        for record in self._jobs.values():
+            lane = record["job"].lane_key
+            if lane is not None and record["seq"] < lane_heads.get(lane, record["seq"] + 1):
+                lane_heads[lane] = record["seq"]
+        ready = sorted(
+            (
+                r for r in self._jobs.values()
+                if r["available_at"] <= now and _kind_allowed(r["job"].kind, kinds, exclude_kinds)
+                and (r["job"].lane_key is None or lane_heads[r["job"].lane_key] == r["seq"])
+            ),
+            key=lambda r: r["available_at"],
+        )[:limit]
+        for record in ready:
+            record["job"].attempts += 1
+            record["locked_by"] = worker_id
+            record["available_at"] = now + JOB_LEASE_SECONDS
+        return [record["job"] for record in ready]
+
+    def _owned(self, job: Job, worker_id: str) -> Optional[Dict[str, Any]]:
+        record = self._jobs.get(job.job_id)
+        return record if record and record["locked_by"] == worker_id else None
+
+    async def extend(self, job: Job, worker_id: str) -> bool:
+        record = self._owned(job, worker_id)
+        if record:
+            record["available_at"] = time.monotonic() + JOB_LEASE_SECONDS
+        return record is not None
+
+    async def complete(self, job: Job, worker_id: str) -> bool:
+        return self._owned(job, worker_id) is not None and self._jobs.pop(job.job_id, None) is not None
+
+    async def fail(self, job: Job, worker_id: str, error: str) -> bool:
+        record = self._owned(job, worker_id)
+        if record is None:
+            return False
+        if job.attempts >= job.max_attempts:
+            del self._jobs[job.job_id]
+            self.dead_letters.append({"job": job, "last_error": error, "failed_at": datetime.now()})
+            return True
+        record["locked_by"] = None
+        record["available_at"] = time.monotonic() + retry_delay(job.attempts)
+        return False
+
+    async def release(self, job: Job, worker_id: str, delay_seconds: float = 0.0) -> None:
+        record = self._owned(job, worker_id)
+        if record:
+            job.attempts = max(job.attempts - 1, 0)
+            record["locked_by"] = None
+            record["available_at"] = time.monotonic() + delay_seconds
+
+
+class JobWorkerPool:
+    """
+    A fixed number of worker coroutines that claim jobs from the backend and
+    run the registered handler for each. Started and stopped from the
+    application lifecycle hooks in main.py.
+
+    A pool only claims the job kinds in `kinds` (all kinds when None) minus
+    `exclude_kinds`, so slow kinds cannot occupy the workers of fast ones.
+
+    A failing handler is retried with backoff until max_attempts, then the
+    job is dead-lettered. A handler raising JobDeferred hands its job back
+    for later without counting the attempt. On shutdown in-flight jobs get a
+    grace period and are otherwise handed back to the queue.
+    """
+
+    def __init__(
+        self,
+        backend,
+        concurrency: int = JOB_WORKER_CONCURRENCY,
+        kinds: Optional[Sequence[str]] = None,
+        exclude_kinds: Sequence[str] = (),
+        name: str = "jobs",
+    ):
+        self.backend = backend
+        self.concurrency = concurrency
+        self.kinds = tuple(kinds) if kinds is not None else None
+        self.exclude_kinds = tuple(exclude_kinds)
+        self.name = name
+        self.worker_id = f"{socket.gethostname()[:40]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self.metrics = {"completed": 0, "retried": 0, "deferred": 0, "dead_lettered": 0, "lease_lost": 0, "batches": 0, "merged": 0}
+
+    def handles(self, kind: str) -> bool:
+        return _kind_allowed(kind, self.kinds, self.exclude_kinds)
+
+    def start(self) -> None:
+        self._stopping = False
+        for n in range(self.concurrency):
+            # Fresh context per worker so jobs never inherit a caller's unit of work.
+            task = asyncio.create_task(self._worker_loop(n), context=contextvars.Context())
+            self._tasks.append(task)
+        logger.info(f"Job worker pool '{self.name}' {self.worker_id} started with {self.concurrency} workers.")
+
+    def notify(self) -> None:
+        """Wakes idle workers, e.g. right after a job was enqueued by this process."""
+        self._wakeup.set()
+
+    async def stop(self) -> None:
+        self._stopping = True
+        self._wakeup.set()
+        if self._tasks:
+            _, pending = await asyncio.wait(self._tasks, timeout=JOB_SHUTDOWN_GRACE_SECONDS)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        self._tasks.clear()
+        logger.info(f"Job worker pool '{self.name}' {self.worker_id} stopped. Metrics: {self.metrics}")
+
+    async def _worker_loop(self, n: int) -> None:
+        while not self._stopping:
+            try:
+                jobs = await self.backend.claim(self.worker_id, 1, self.kinds, self.exclude_kinds)
+            except Exception as e:
+                logger.error(f"Job worker {n} could not claim jobs: {e}")
+                jobs = []
+            if not jobs:
+                await self._idle()
+                continue
+            await self._run(jobs[0])
+
+    async def _idle(self) -> None:
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=JOB_POLL_INTERVAL_SECONDS * random.uniform(0.8, 1.2))
+        except asyncio.TimeoutError:
+            pass
+        if not self._stopping:
+            self._wakeup.clear()
+
+    async def _heartbeat(self, jobs: List[Job]) -> None:
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            for job in list(jobs):
+                try:
+                    if not await self.backend.extend(job, self.worker_id):
+                        logger.warning(f"Lost the lease on job {job.job_id}; another worker may run it again.")
+                        self.metrics["lease_lost"] += 1
+                        jobs.remove(job)
+                except Exception as e:
+                    logger.error(f"Could not extend the lease on job {job.job_id}: {e}")
+
+    async def _release(self, jobs: List[Job]) -> None:
+        for job in jobs:
+            try:
+                await self.backend.release(job, self.worker_id)
+            except Exception as e:
+                logger.error(f"Could not release job {job.job_id}: {e}")
+
+    async def _run(self, job: Job) -> None:
+        handler = _handlers.get(job.kind)
+        batch_size = _batch_sizes.get(job.kind, 1)
+        followers: List[Job] = []
+        if handler is not None and batch_size > 1:
+            try:
+                followers = await self.backend.claim_followers(job, self.worker_id, batch_size - 1)
+            except Exception as e:
+                logger.error(f"Could not claim jobs queued behind {job.job_id}: {e}")
+        leased = [job, *followers]
+        heartbeat = asyncio.create_task(self._heartbeat(list(leased)))
+        started = time.perf_counter()
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for job kind '{job.kind}'")
+            if batch_size > 1:
+                await handler([j.payload for j in leased])
+            else:
+                await handler(job.payload)
+        except asyncio.CancelledError:
+            # Shutting down mid-job: put it back for the next instance.
+            await asyncio.shield(self._release(leased))
+            raise
+        except JobDeferred as e:
+            self.metrics["deferred"] += 1
+            await self._release(followers)
+            try:
+                await self.backend.release(job, self.worker_id, e.delay_seconds)
+            except Exception as db_error:
+                logger.error(f"Could not defer job {job.job_id}: {db_error}")
+        except Exception as e:
+            logger.error(f"Job {job.job_id} ({job.kind}) failed on attempt {job.attempts}/{job.max_attempts}: {e}")
+            # Followers go back untouched; the retry of the head claims them again.
+            await self._release(followers)
+            try:
+                if await self.backend.fail(job, self.worker_id, f"{type(e).__name__}: {e}"):
+                    self.metrics["dead_lettered"] += 1
+                    logger.error(f"Job {job.job_id} ({job.kind}) moved to the dead-letter table.")
+                else:
+                    self.metrics["retried"] += 1
+            except Exception as db_error:
+                logger.error(f"Could not record the failure of job {job.job_id}: {db_error}")
+        else:
+            for done in leased:
+                try:
+                    if not await self.backend.complete(done, self.worker_id):
+                        self.metrics["lease_lost"] += 1
+                except Exception as e:
+                    logger.error(f"Could not mark job {done.job_id} as done; it will run again: {e}")
+            self.metrics["completed"] += len(leased)
+            if followers:
+                self.metrics["batches"] += 1
+                self.metrics["merged"] += len(followers)
+            logger.info(
+                f"Job {job.job_id} ({job.kind}) done in {(time.perf_counter() - started) * 1000:.0f} ms"
+                + (f" together with {len(followers)} queued job(s)" if followers else "")
+            )
+        finally:
+            heartbeat.cancel()
+
+
+def _make_backend():
+    if JOB_QUEUE_BACKEND == "memory":
+        logger.warning("Using the in-memory job queue; queued jobs are lost on restart.")
+        return InMemoryJobBackend()
+    return MySQLJobBackend()
+
+
+job_backend = _make_backend()
+# Agent turns and every other kind; sends are served by send_pool.
+job_pool = JobWorkerPool(job_backend, exclude_kinds=SEND_JOB_KINDS, name="jobs")
+send_pool = JobWorkerPool(job_backend, JOB_SEND_WORKER_CONCURRENCY, kinds=SEND_JOB_KINDS, name="sends")
+job_pools = (job_pool, send_pool)
+
+
+async def enqueue_job(
+    kind: str,
+    payload: Dict[str, Any],
+    delay_seconds: float = 0.0,
+    lane_key: Optional[str] = None,
+    debounce_max_seconds: Optional[float] = None,
+) -> str:
+    """
+    Persists a job and returns its id. Inside a unit_of_work() the insert
+    commits together with the caller's other writes. Jobs sharing a lane_key
+    are processed in the order they were enqueued.
+
+    With debounce_max_seconds, delay_seconds acts as a debounce window for
+    the lane: jobs of the same kind still waiting in it are pushed back by
+    delay_seconds (up to debounce_max_seconds after they were enqueued), so
+    a burst is claimed together by a batch handler.
+    """
+    if lane_key and debounce_max_seconds is not None and delay_seconds > 0:
+        await job_backend.defer_lane(kind, lane_key, delay_seconds, debounce_max_seconds)
+    job_id = await job_backend.enqueue(kind, payload, delay_seconds, lane_key=lane_key)
+    for pool in job_pools:
+        if pool.handles(kind):
+            pool.notify()
+    return job_id
@@ -0,0 +1,239 @@
+# services/notion_gateway.py
+
+import os
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+from notion_client import AsyncClient
+
+from utils.cache import TTLCache
+from utils.notion_projection import get_projection_stats
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+NOTION_API_KEY = os.getenv("NOTION_API_KEY")
+if not NOTION_API_KEY:
+    raise ValueError("FATAL: NOTION_API_KEY not found. Ensure it is set in your .env file.")
+
+NOTION_TIMEOUT_MS = int(os.getenv("NOTION_TIMEOUT_MS", "30000"))
+NOTION_MAX_CONNECTIONS = int(os.getenv("NOTION_MAX_CONNECTIONS", "50"))
+NOTION_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("NOTION_MAX_KEEPALIVE_CONNECTIONS", "20"))
+NOTION_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("NOTION_KEEPALIVE_EXPIRY_SECONDS", "60"))
+NOTION_PAGE_CACHE_SIZE = int(os.getenv("NOTION_PAGE_CACHE_SIZE", "2048"))
+NOTION_PAGE_CACHE_TTL_SECONDS = float(os.getenv("NOTION_PAGE_CACHE_TTL_SECONDS", "120"))
+
+# One pooled transport for the whole process. Every agent tool goes through
+# this client so Notion calls never block the event loop and TLS connections
+# to api.notion.com are reused between tool calls and conversations.
+_http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=NOTION_MAX_CONNECTIONS,
+        max_keepalive_connections=NOTION_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=NOTION_KEEPALIVE_EXPIRY_SECONDS,
+    ),
+)
+
+notion = AsyncClient(
+    auth=NOTION_API_KEY,
+    client=_http_client,
+    timeout_ms=NOTION_TIMEOUT_MS,
+)
+
+# Read-through cache of page objects keyed by normalised page id. Our own
+# writes (create/update/archive) refresh or drop the entry; edits made in the
+# Notion UI become visible once the TTL expires.
+page_cache = TTLCache(
+    maxsize=NOTION_PAGE_CACHE_SIZE,
+    ttl_seconds=NOTION_PAGE_CACHE_TTL_SECONDS,
+    name="notion_pages",
+)
+_inflight_page_fetches: Dict[str, "asyncio.Future"] = {}
+# Writes are numbered. A write to a page with a fetch in flight records its
+# number here, and a fetch started before that number does not store its
+# (possibly pre-write) result in the cache.
+_write_seq = 0
+_page_writes: Dict[str, int] = {}
+
+
+def _page_key(page_id: str) -> str:
+    """Notion accepts ids with or without dashes; cache them under one key."""
+    return page_id.replace("-", "").lower()
+
+
+def _record_write(key: str) -> None:
+    """Detaches an in-flight fetch of the page so its result is neither cached nor shared with new readers."""
+    global _write_seq
+    _write_seq += 1
+    if _inflight_page_fetches.pop(key, None) is not None:
+        _page_writes[key] = _write_seq
+
+
+async def retrieve_page(page_id: str) -> Dict[str, Any]:
+    """
+    Returns the page object for page_id, served from the page cache when possible.
+    Concurrent lookups of the same uncached page share a single Notion request.
+    The returned dict is shared with the cache and must not be mutated.
+    """
+    key = _page_key(page_id)
+    cached = page_cache.get(key)
+    if cached is not None:
+        return cached
+
+    pending = _inflight_page_fetches.get(key)
+    if pending is not None:
+        try:
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+            return await retrieve_page(page_id)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight_page_fetches[key] = future
+    started = _write_seq
+    try:
+        page = await notion.pages.retrieve(page_id=page_id)
+        if _page_writes.get(key, 0) <= started:
+            page_cache.set(key, page)
+        future.set_result(page)
+        return page
+    except Exception as e:
+        future.set_exception(e)
+        # Mark the exception as retrieved so failures without waiters are not logged as unhandled.
+        future.exception()
+        raise
+    finally:
+        if not future.done():
+            # The fetching call was cancelled; let any waiters retry on their own.
+            future.cancel()
+        if _inflight_page_fetches.get(key) is future:
+            del _inflight_page_fetches[key]
+        if key not in _inflight_page_fetches:
+            _page_writes.pop(key, None)
+
+
+async def create_page(**kwargs) -> Dict[str, Any]:
+    """Creates a page and seeds the page cache with the returned object."""
+    page = await notion.pages.create(**kwargs)
+    if page.get("id"):
+        page_cache.set(_page_key(page["id"]), page)
+    return page
+
+
+async def update_page(page_id: str, **kwargs) -> Dict[str, Any]:
+    """
+    Updates a page and refreshes its cache entry from the response.
+    Archived pages are dropped from the cache instead. A retrieve_page() that
+    was in flight during the update does not overwrite the fresh entry.
+    """
+    key = _page_key(page_id)
+    page_cache.invalidate(key)
+    _record_write(key)
+    try:
+        page = await notion.pages.update(page_id=page_id, **kwargs)
+    finally:
+        # Fetches started while the update ran may have read the old page.
+        _record_write(key)
+    if page.get("archived") or page.get("in_trash"):
+        page_cache.invalidate(key)
+    else:
+        page_cache.set(key, page)
+    return page
+
+
+async def archive_page(page_id: str) -> Dict[str, Any]:
+    """Soft-deletes (archives) a page and evicts it from the cache."""
+    return await update_page(page_id, archived=True)
+
+
+async def iter_database_query(
+    database_id: str,
+    filter: Optional[Dict[str, Any]] = None,
+    sorts: Optional[List[Dict[str, Any]]] = None,
+    page_size: int = 100,
+    max_rows: Optional[int] = None,
+    project: Optional[Callable[[Dict[str, Any]], Any]] = None,
+) -> AsyncIterator[Any]:
+    """
+    Yields every row of a database query, following next_cursor until the
+    result set is exhausted or max_rows rows have been yielded.
+
+    The request for the next page is started before the current page is
+    handed out, so Notion round-trips overlap with the caller's processing
+    (and with the optional per-row `project` function).
+    """
+    query: Dict[str, Any] = {"database_id": database_id, "page_size": page_size}
+    if filter:
+        query["filter"] = filter
+    if sorts:
+        query["sorts"] = sorts
+
+    yielded = 0
+    next_fetch: Optional[asyncio.Task] = asyncio.create_task(notion.databases.query(**query))
+    try:
+        while next_fetch is not None:
+            response = await next_fetch
+            next_fetch = None
+            results = response.get("results", [])
+            wants_more = max_rows is None or yielded + len(results) < max_rows
+            if response.get("has_more") and response.get("next_cursor") and wants_more:
+                next_fetch = asyncio.create_task(
+                    notion.databases.query(**query, start_cursor=response["next_cursor"])
+                )
+            for page in results:
+                if max_rows is not None and yielded >= max_rows:
+                    return
+                yield project(page) if project else page
+                yielded += 1
+    finally:
+        if next_fetch is not None:
+            # The consumer stopped early; don't leave a request running in the background.
+            next_fetch.cancel()
+            if next_fetch.done() and not next_fetch.cancelled():
+                next_fetch.exception()
+
+
+async def query_database_rows(
+    database_id: str,
+    filter: Optional[Dict[str, Any]] = None,
+    sorts: Optional[List[Dict[str, Any]]] = None,
+    max_rows: Optional[int] = None,
+    project: Optional[Callable[[Dict[str, Any]], Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Collects up to max_rows rows of a database query.
+    Returns {"results": [...], "count": n, "truncated": bool}.
+    """
+    limit = None if max_rows is None else max_rows + 1  # one extra row tells us whether we truncated
+    rows = [row async for row in iter_database_query(database_id, filter=filter, sorts=sorts, max_rows=limit, project=project)]
+    truncated = max_rows is not None and len(rows) > max_rows
+    if truncated:
+        rows = rows[:max_rows]
+    return {"results": rows, "count": len(rows), "truncated": truncated}
+
+
+def invalidate_page(page_id: str) -> None:
+    """Drops a page from the cache, e.g. after an out-of-band change."""
+    key = _page_key(page_id)
+    page_cache.invalidate(key)
+    _record_write(key)
+
+
+def get_page_cache_stats() -> Dict[str, Any]:
+    """Hit/miss metrics for the page cache."""
+    return page_cache.stats()
+
+
+async def close_notion_client():
+    """
+    Closes the shared Notion client and its connection pool.
+    Called from the application shutdown hook.
+    """
+    await notion.aclose()
+    logger.info(f"Notion client closed. Page cache stats: {get_page_cache_stats()}")
+    logger.info(f"Tool output projection stats: {get_projection_stats()}")
@@ -0,0 +1,199 @@
+# services/outbound_dispatcher.py
+
+import os
+import logging
+from typing import Any, Dict, List, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+from db import get_db_connection
+from services.job_queue import JobDeferred, enqueue_job, job_handler
+from utils.cache import TTLCache
+from utils.db_helper import execute_query
+from utils.id_generator import new_id
+from utils.rate_limit import TokenBucket
+from utils.whatsapp_utils import send_whatsapp_text, split_message
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+# Throughput of the Business phone number (Meta's tier limit, with headroom).
+# The buckets live in each process, so these limits are per instance and the
+# Business-number limit is NOT enforced across instances: with N instances
+# running send workers, set the rate to the tier limit divided by N.
+WHATSAPP_SEND_RATE_PER_SECOND = float(os.getenv("WHATSAPP_SEND_RATE_PER_SECOND", "20"))
+WHATSAPP_SEND_BURST = float(os.getenv("WHATSAPP_SEND_BURST", "40"))
+# Meta also limits messages to one user in a short window.
+WHATSAPP_RECIPIENT_RATE_PER_SECOND = float(os.getenv("WHATSAPP_RECIPIENT_RATE_PER_SECOND", "1"))
+WHATSAPP_RECIPIENT_BURST = float(os.getenv("WHATSAPP_RECIPIENT_BURST", "3"))
+
+# Delivery statuses only move forward; a late "delivered" never overwrites "read".
+STATUS_RANKS = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+
+
+class OutboundDispatcher:
+    """
+    Queued, rate-limited delivery of outbound WhatsApp messages.
+
+    dispatch() splits a message on paragraph/line boundaries and enqueues
+    one "whatsapp_send" job per part, so the caller (an agent tool, the
+    webhook reply) returns as soon as the jobs are stored. The job workers
+    deliver them concurrently. Parts for one recipient share a job lane and
+    go out in order, one at a time. The sends run on their own worker pool
+    (services/job_queue.send_pool), separate from the agent turns. Each send
+    needs a token from the Business number's bucket and from the recipient's
+    bucket; when either is empty the job is deferred until it refills rather
+    than holding a worker. Buckets are per process, so with several
+    instances the rates are per instance.
+
+    Every sent part is recorded in OutboundMessages under its WhatsApp
+    message id. record_status() applies the webhook's `statuses` events
+    to it, so failures after acceptance are visible and logged. A job that
+    runs again for a part already recorded there (e.g. a worker died before
+    acking it) does not send it a second time.
+    """
+
+    def __init__(self):
+        self._business = TokenBucket(WHATSAPP_SEND_RATE_PER_SECOND, WHATSAPP_SEND_BURST, name="whatsapp_business_number")
+        self._recipients = TTLCache(maxsize=10000, ttl_seconds=600, name="whatsapp_recipient_buckets")
+        self.metrics = {
+            "dispatched": 0, "parts": 0, "deferred": 0, "sent": 0, "rejected": 0, "duplicates_skipped": 0, "record_failures": 0,
+            **{f"status_{s}": 0 for s in STATUS_RANKS},
+        }
+
+    def _recipient_bucket(self, to_number: str) -> TokenBucket:
+        bucket = self._recipients.get(to_number)
+        if bucket is None:
+            bucket = TokenBucket(WHATSAPP_RECIPIENT_RATE_PER_SECOND, WHATSAPP_RECIPIENT_BURST, name=f"recipient:{to_number}")
+            self._recipients.set(to_number, bucket)
+        return bucket
+
+    async def dispatch(self, to_number: str, message: str, kind: str = "notification") -> Optional[str]:
+        """
+        Queues a message for delivery and returns its outbound id (shared by
+        all its parts). Inside a unit_of_work() the jobs commit with the
+        caller's writes, so nothing is sent for a rolled-back change.
+        """
+        if not to_number or not message:
+            return None
+        outbound_id = new_id()
+        parts = split_message(message)
+        for part_number, body in enumerate(parts, start=1):
+            await enqueue_job(
+                "whatsapp_send",
+                {
+                    "outbound_id": outbound_id,
+                    "to": to_number,
+                    "body": body,
+                    "part": part_number,
+                    "parts": len(parts),
+                    "kind": kind,
+                },
+                lane_key=f"outbound:{to_number}",
+            )
+        self.metrics["dispatched"] += 1
+        self.metrics["parts"] += len(parts)
+        return outbound_id
+
+    async def _already_sent(self, payload: Dict[str, Any]) -> bool:
+        async for conn in get_db_connection():
+            row = await execute_query(
+                conn,
+                "SELECT message_id FROM OutboundMessages WHERE outbound_id = :outbound_id AND part = :part LIMIT 1",
+                {"outbound_id": payload["outbound_id"], "part": payload["part"]},
+                fetch_one=True
+            )
+        return row is not None
+
+    async def deliver(self, payload: Dict[str, Any]) -> None:
+        to_number = payload["to"]
+        if await self._already_sent(payload):
+            self.metrics["duplicates_skipped"] += 1
+            logger.info(f"Skipping {payload['kind']} {payload['outbound_id']} part {payload['part']}: already sent.")
+            return
+        recipient = self._recipient_bucket(to_number)
+        delay = max(self._business.wait_time(), recipient.wait_time())
+        if delay > 0:
+            self.metrics["deferred"] += 1
+            raise JobDeferred(delay, "WhatsApp send rate limit")
+        self._business.try_acquire()
+        recipient.try_acquire()
+        try:
+            message_id = await send_whatsapp_text(to_number, payload["body"])
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 429 or e.response.status_code >= 500:
+                raise  # the job queue retries with a longer backoff
+            # Bad number, expired window, etc.: retrying won't help.
+            self.metrics["rejected"] += 1
+            logger.error(
+                f"WhatsApp rejected {payload['kind']} {payload['outbound_id']} part {payload['part']}/{payload['parts']} "
+                f"to {to_number}: {e.response.text}"
+            )
+            return
+        self.metrics["sent"] += 1
+        if not message_id:
+            return
+        try:
+            async for conn in get_db_connection():
+                await execute_query(
+                    conn,
+                    """
+                    INSERT IGNORE INTO OutboundMessages (message_id, outbound_id, recipient, kind, part, parts, status, status_rank)
+                    VALUES (:message_id, :outbound_id, :recipient, :kind, :part, :parts, 'sent', :rank)
+                    """,
+                    {
+                        "message_id": message_id,
+                        "outbound_id": payload["outbound_id"],
+                        "recipient": to_number,
+                        "kind": payload["kind"],
+                        "part": payload["part"],
+                        "parts": payload["parts"],
+                        "rank": STATUS_RANKS["sent"],
+                    },
+                    fetch_one=False
+                )
+        except Exception as e:
+            # The message is out; failing the job now would only send it again.
+            self.metrics["record_failures"] += 1
+            logger.error(f"Sent WhatsApp message {message_id} but could not record it: {e}")
+
+    async def record_status(self, status_data: Dict[str, Any]) -> None:
+        """Applies one `statuses` entry from the webhook to its OutboundMessages row."""
+        message_id = status_data.get("id")
+        status = status_data.get("status")
+        rank = STATUS_RANKS.get(status)
+        if not message_id or rank is None:
+            return
+        self.metrics[f"status_{status}"] += 1
+        errors: List[Dict[str, Any]] = status_data.get("errors") or []
+        error = "; ".join(f"{e.get('code')}: {e.get('title') or e.get('message')}" for e in errors) or None
+        if status == "failed":
+            logger.error(f"WhatsApp message {message_id} to {status_data.get('recipient_id')} failed: {error}")
+        async for conn in get_db_connection():
+            await execute_query(
+                conn,
+                """
+                UPDATE OutboundMessages SET status = :status, status_rank = :rank, error = COALESCE(:error, error)
+                WHERE message_id = :message_id AND status_rank < :rank
+                """,
+                {"message_id": message_id, "status": status, "rank": rank, "error": error},
+                fetch_one=False
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.metrics, "business_bucket": self._business.stats()}
+
+
+outbound_dispatcher = OutboundDispatcher()
+
+
+@job_handler("whatsapp_send")
+async def deliver_whatsapp_message(payload: Dict[str, Any]):
+    """Job handler: sends one queued message part."""
+    await outbound_dispatcher.deliver(payload)
+
+
+async def dispatch_whatsapp_message(to_number: str, message: str, kind: str = "notification") -> Optional[str]:
+    return await outbound_dispatcher.dispatch(to_number, message, kind)
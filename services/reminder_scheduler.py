@@ -0,0 +1,285 @@
+# services/reminder_scheduler.py
+
+import os
+import time
+import heapq
+import uuid
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from dotenv import load_dotenv
+
+from db import get_db_connection, unit_of_work
+from services.outbound_dispatcher import dispatch_whatsapp_message
+from services.user_directory import get_user_by_id
+from utils.db_helper import execute_query
+from utils.id_generator import new_id
+from utils.recurrence import RecurrenceError, next_run_utc
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+# Reminders due within this window are loaded into the in-memory heap.
+REMINDER_HORIZON_SECONDS = float(os.getenv("REMINDER_HORIZON_SECONDS", "600"))
+# How often the heap is refilled from the database (and expired leases picked up).
+REMINDER_REFILL_SECONDS = float(os.getenv("REMINDER_REFILL_SECONDS", "60"))
+REMINDER_REFILL_LIMIT = int(os.getenv("REMINDER_REFILL_LIMIT", "5000"))
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "100"))
+# A claimed reminder is invisible to other instances for this long.
+REMINDER_LEASE_SECONDS = float(os.getenv("REMINDER_LEASE_SECONDS", "60"))
+
+
+def _utc_now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _utc_naive(value: datetime) -> datetime:
+    """Notifications.created_at holds naive UTC; accept aware datetimes too."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _micros(seconds: float) -> int:
+    return int(seconds * 1_000_000)
+
+
+class ReminderScheduler:
+    """
+    Delivers due reminder notifications over WhatsApp.
+
+    Reminders due within REMINDER_HORIZON_SECONDS are kept in a min-heap
+    ordered by due time. The heap is refilled every REMINDER_REFILL_SECONDS
+    by a range scan on (type, sent_at, created_at), and the reminder tool
+    pushes new near-term reminders straight in with notify(). Pending
+    reminders further out are never read, however many there are.
+
+    When reminders fall due they are claimed with a lease (SELECT ... FOR
+    UPDATE SKIP LOCKED), so several instances can run the scheduler without
+    sending twice. Each reminder is then marked sent, on the condition that
+    this instance still holds the lease. Its WhatsApp message is enqueued in
+    the same transaction, so a crash either leaves it unsent and claimable
+    again once the lease expires, or sent with its delivery job queued.
+    A recurring reminder's next occurrence is inserted as a new row in that
+    same transaction.
+    """
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()[:40]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._heap: List[Tuple[datetime, str]] = []
+        self._queued: Set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self.metrics = {
+            "loaded": 0, "claimed": 0, "sent": 0, "no_phone": 0, "lease_lost": 0, "recurred": 0,
+            "lag_ms_total": 0.0, "lag_ms_max": 0.0,
+        }
+
+    def _event(self) -> asyncio.Event:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def _push(self, notification_id: str, due_at: datetime) -> bool:
+        if notification_id in self._queued:
+            return False
+        self._queued.add(notification_id)
+        heapq.heappush(self._heap, (due_at, notification_id))
+        return True
+
+    def notify(self, notification_id: str, due_at: datetime) -> None:
+        """
+        Called after a reminder row commits. Near-term reminders go straight
+        into the heap; later ones are picked up by a refill.
+        """
+        due_at = _utc_naive(due_at)
+        if due_at <= _utc_now() + timedelta(seconds=REMINDER_HORIZON_SECONDS):
+            if self._push(notification_id, due_at):
+                self._event().set()
+
+    async def refill(self) -> int:
+        """Loads unsent, unleased reminders due within the horizon. Returns how many were new."""
+        async for conn in get_db_connection():
+            rows = await execute_query(
+                conn,
+                """
+                SELECT notification_id, created_at FROM Notifications
+                WHERE type = 'reminder' AND sent_at IS NULL
+                  AND created_at <= UTC_TIMESTAMP(3) + INTERVAL :horizon_us MICROSECOND
+                  AND (lease_expires_at IS NULL OR lease_expires_at < UTC_TIMESTAMP(3))
+                ORDER BY created_at
+                LIMIT :limit
+                """,
+                {"horizon_us": _micros(REMINDER_HORIZON_SECONDS), "limit": REMINDER_REFILL_LIMIT},
+                fetch_one=False
+            )
+        added = sum(self._push(row["notification_id"], _utc_naive(row["created_at"])) for row in rows or [])
+        self.metrics["loaded"] += added
+        return added
+
+    def _pop_due(self) -> List[str]:
+        now = _utc_now()
+        due: List[str] = []
+        while self._heap and self._heap[0][0] <= now and len(due) < REMINDER_BATCH_SIZE:
+            _, notification_id = heapq.heappop(self._heap)
+            self._queued.discard(notification_id)
+            due.append(notification_id)
+        return due
+
+    async def _claim(self, notification_ids: List[str]) -> List[Dict[str, Any]]:
+        params: Dict[str, Any] = {"owner": self.owner, "lease_us": _micros(REMINDER_LEASE_SECONDS)}
+        params.update({f"id_{i}": notification_id for i, notification_id in enumerate(notification_ids)})
+        placeholders = ", ".join(f":id_{i}" for i in range(len(notification_ids)))
+        async with unit_of_work():
+            async for conn in get_db_connection():
+                rows = await execute_query(
+                    conn,
+                    f"""
+                    SELECT notification_id, receiver_id, sender_id, title, thread_id, created_at, recurrence_rule, timezone
+                    FROM Notifications
+                    WHERE notification_id IN ({placeholders})
+                      AND type = 'reminder' AND sent_at IS NULL
+                      AND created_at <= UTC_TIMESTAMP(3)
+                      AND (lease_expires_at IS NULL OR lease_expires_at < UTC_TIMESTAMP(3))
+                    FOR UPDATE SKIP LOCKED
+                    """,
+                    params,
+                    fetch_one=False
+                )
+                if not rows:
+                    return []
+                claimed = {f"claimed_{i}": row["notification_id"] for i, row in enumerate(rows)}
+                await execute_query(
+                    conn,
+                    f"""
+                    UPDATE Notifications
+                    SET lease_owner = :owner, lease_expires_at = UTC_TIMESTAMP(3) + INTERVAL :lease_us MICROSECOND
+                    WHERE notification_id IN ({", ".join(f":{key}" for key in claimed)})
+                    """,
+                    {"owner": self.owner, "lease_us": params["lease_us"], **claimed},
+                    fetch_one=False
+                )
+        self.metrics["claimed"] += len(rows)
+        return rows
+
+    async def _insert_next(self, row: Dict[str, Any]) -> Optional[Tuple[str, datetime]]:
+        """Inserts a recurring reminder's next occurrence; must run inside the delivery's unit_of_work()."""
+        try:
+            due_at = next_run_utc(row["recurrence_rule"], _utc_naive(row["created_at"]), row.get("timezone"))
+        except RecurrenceError as e:
+            logger.error(f"Reminder {row['notification_id']} has an invalid recurrence rule, not repeating: {e}")
+            return None
+        if due_at is None:
+            return None  # UNTIL has passed
+        notification_id = new_id()
+        async for conn in get_db_connection():
+            await execute_query(
+                conn,
+                """
+                INSERT INTO Notifications (notification_id, receiver_id, sender_id, title, thread_id, created_at, type, recurrence_rule, timezone)
+                VALUES (:notification_id, :receiver_id, :sender_id, :title, :thread_id, :created_at, 'reminder', :recurrence_rule, :timezone)
+                """,
+                {
+                    "notification_id": notification_id,
+                    "receiver_id": row["receiver_id"],
+                    "sender_id": row.get("sender_id"),
+                    "title": row["title"],
+                    "thread_id": row.get("thread_id"),
+                    "created_at": due_at,
+                    "recurrence_rule": row["recurrence_rule"],
+                    "timezone": row.get("timezone"),
+                },
+                fetch_one=False
+            )
+        return notification_id, due_at
+
+    async def _deliver(self, row: Dict[str, Any]) -> None:
+        receiver = await get_user_by_id(row["receiver_id"])
+        phone_number = receiver.get("phone_number") if receiver else None
+        following = None
+        async with unit_of_work():
+            async for conn in get_db_connection():
+                marked = await execute_query(
+                    conn,
+                    """
+                    UPDATE Notifications SET sent_at = UTC_TIMESTAMP(3), lease_owner = NULL, lease_expires_at = NULL
+                    WHERE notification_id = :notification_id AND lease_owner = :owner AND sent_at IS NULL
+                    """,
+                    {"notification_id": row["notification_id"], "owner": self.owner},
+                    fetch_one=False
+                )
+            if not marked:
+                # The lease expired and another instance took the reminder over.
+                self.metrics["lease_lost"] += 1
+                return
+            if phone_number:
+                await dispatch_whatsapp_message(phone_number, row["title"], kind="reminder")
+            if row.get("recurrence_rule"):
+                following = await self._insert_next(row)
+        if following:
+            self.metrics["recurred"] += 1
+            self.notify(*following)
+        if not phone_number:
+            self.metrics["no_phone"] += 1
+            logger.warning(f"Reminder {row['notification_id']} has no WhatsApp number for {row['receiver_id']}; shown in-app only.")
+            return
+        self.metrics["sent"] += 1
+        lag_ms = max(0.0, (_utc_now() - _utc_naive(row["created_at"])).total_seconds() * 1000)
+        self.metrics["lag_ms_total"] += lag_ms
+        self.metrics["lag_ms_max"] = max(self.metrics["lag_ms_max"], lag_ms)
+
+    async def deliver_due(self) -> int:
+        """Claims and delivers every reminder in the heap that is due now."""
+        delivered = 0
+        while True:
+            due = self._pop_due()
+            if not due:
+                return delivered
+            for row in await self._claim(due):
+                try:
+                    await self._deliver(row)
+                    delivered += 1
+                except Exception as e:
+                    # Still leased; it is retried after the lease expires.
+                    logger.error(f"Could not deliver reminder {row['notification_id']}: {e}")
+
+    def _seconds_until_next(self, next_refill: float) -> float:
+        timeout = next_refill - time.monotonic()
+        if self._heap:
+            timeout = min(timeout, (self._heap[0][0] - _utc_now()).total_seconds())
+        return max(0.0, timeout)
+
+    async def run(self) -> None:
+        """Scheduler loop; started as a background task on startup."""
+        logger.info(f"Reminder scheduler {self.owner} started.")
+        wakeup = self._event()
+        next_refill = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_refill:
+                    await self.refill()
+                    next_refill = time.monotonic() + REMINDER_REFILL_SECONDS
+                await self.deliver_due()
+            except Exception as e:
+                logger.error(f"Reminder scheduler pass failed: {e}")
+                next_refill = min(next_refill, time.monotonic() + 5)
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=self._seconds_until_next(next_refill))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        sent = self.metrics["sent"]
+        return {
+            "pending_in_heap": len(self._heap),
+            **{k: v for k, v in self.metrics.items() if not k.startswith("lag_ms")},
+            "lag_ms_avg": round(self.metrics["lag_ms_total"] / sent, 1) if sent else 0.0,
+            "lag_ms_max": round(self.metrics["lag_ms_max"], 1),
+        }
+
+
+reminder_scheduler = ReminderScheduler()
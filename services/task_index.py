@@ -0,0 +1,345 @@
+# services/task_index.py
+
+import os
+import time
+import asyncio
+import difflib
+import logging
+import sqlite3
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from db import get_db_connection
+from services.notion_gateway import iter_database_query
+from utils.db_helper import execute_query
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+DEFAULT_TASKS_DATABASE_ID = os.getenv("NOTION_TASKS_DATABASE_ID")
+TASK_INDEX_PATH = os.getenv("TASK_INDEX_PATH", ":memory:")
+# How often the background loop syncs each known database incrementally.
+TASK_INDEX_SYNC_INTERVAL_SECONDS = float(os.getenv("TASK_INDEX_SYNC_INTERVAL_SECONDS", "30"))
+# Pages archived in the Notion UI never show up in incremental queries, so the
+# index is periodically rebuilt from a full scan to drop them.
+TASK_INDEX_FULL_SYNC_INTERVAL_SECONDS = float(os.getenv("TASK_INDEX_FULL_SYNC_INTERVAL_SECONDS", "3600"))
+TASK_INDEX_FUZZY_CUTOFF = float(os.getenv("TASK_INDEX_FUZZY_CUTOFF", "0.6"))
+
+
+def normalize_title(title: str) -> str:
+    return " ".join((title or "").split()).casefold()
+
+
+def normalize_database_id(database_id: Optional[str]) -> Optional[str]:
+    """
+    Notion returns database ids dashed (in page parents) while configured and
+    department ids are usually undashed; the index keys on one form.
+    """
+    return database_id.replace("-", "").lower() if database_id else database_id
+
+
+def extract_title(page: Dict[str, Any]) -> str:
+    """Returns the plain text of a page's title property, whatever it is named."""
+    for prop in (page.get("properties") or {}).values():
+        if isinstance(prop, dict) and prop.get("type") == "title":
+            return "".join(part.get("plain_text", "") for part in prop.get("title") or [])
+    return ""
+
+
+class TaskIndex:
+    """
+    A local SQLite mirror of the tasks databases, holding just enough of each
+    page (id, title, url, last_edited_time) to resolve task names without a
+    workspace-wide notion.search.
+
+    Each database is synced incrementally using a last_edited_time cursor,
+    with a periodic full scan, by run_task_index_sync_loop() in the
+    background. Lookups read whatever the index holds and never wait for
+    Notion, except for the very first sync of a database nobody has looked
+    up before. Database ids are stored in normalize_database_id() form.
+    """
+
+    def __init__(self, path: str = TASK_INDEX_PATH):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        columns = [row["name"] for row in self._db.execute("PRAGMA table_info(tasks)")]
+        if columns and "synced_at" not in columns:
+            # An index file from before synced_at and id normalisation; it is
+            # only a cache, so rebuild it from Notion.
+            self._db.executescript("DROP TABLE tasks; DROP TABLE IF EXISTS sync_state;")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tasks (
+                page_id TEXT PRIMARY KEY,
+                database_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                title_norm TEXT NOT NULL,
+                url TEXT,
+                last_edited_time TEXT,
+                synced_at REAL NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_tasks_db_title ON tasks (database_id, title_norm);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                database_id TEXT PRIMARY KEY,
+                cursor TEXT,
+                last_synced_at REAL NOT NULL DEFAULT 0,
+                last_full_sync_at REAL NOT NULL DEFAULT 0
+            );
+            """
+        )
+        self._db.commit()
+        self._sync_locks: Dict[str, asyncio.Lock] = {}
+        # Databases the background loop keeps synced, keyed by normalised id.
+        self._tracked: Dict[str, str] = {}
+
+    # --- Sync ---
+
+    def _sync_state(self, database_id: str) -> Optional[sqlite3.Row]:
+        return self._db.execute(
+            "SELECT cursor, last_synced_at, last_full_sync_at FROM sync_state WHERE database_id = ?",
+            (normalize_database_id(database_id),),
+        ).fetchone()
+
+    def _sync_lock(self, database_id: str) -> asyncio.Lock:
+        return self._sync_locks.setdefault(normalize_database_id(database_id), asyncio.Lock())
+
+    def track(self, database_id: str) -> None:
+        """Adds a database to the ones the background loop keeps synced."""
+        self._tracked.setdefault(normalize_database_id(database_id), database_id)
+
+    async def ensure_synced(self, database_id: str) -> None:
+        """
+        Tracks the database and, if it has never been synced, waits for its
+        first (full) sync, since there is nothing to read yet. Later syncs are
+        left to the background loop.
+        """
+        self.track(database_id)
+        if self._sync_state(database_id) is not None:
+            return
+        async with self._sync_lock(database_id):
+            # Another coroutine may have finished the first sync while we waited.
+            if self._sync_state(database_id) is None:
+                await self.sync(database_id, full=True)
+
+    async def refresh(self, database_id: str) -> None:
+        """An incremental sync, or a full one when it is due."""
+        async with self._sync_lock(database_id):
+            state = self._sync_state(database_id)
+            full = not state or time.time() - state["last_full_sync_at"] >= TASK_INDEX_FULL_SYNC_INTERVAL_SECONDS
+            await self.sync(database_id, full=full)
+
+    async def refresh_tracked(self) -> None:
+        """Refreshes every tracked database, one after another."""
+        for database_id in list(self._tracked.values()):
+            try:
+                await self.refresh(database_id)
+            except Exception as e:
+                logger.error(f"Task index sync failed for {database_id}: {e}")
+
+    async def sync(self, database_id: str, full: bool = False) -> int:
+        """
+        Pulls pages edited since the stored cursor (or every page when full=True)
+        and upserts them. Returns the number of pages received.
+        """
+        started = time.perf_counter()
+        scan_started = time.time()
+        key = normalize_database_id(database_id)
+        state = self._sync_state(database_id)
+        cursor = None if full or not state else state["cursor"]
+
+        sorts = [{"timestamp": "last_edited_time", "direction": "ascending"}]
+        filter = None
+        if cursor:
+            # last_edited_time is minute-granular, so re-read the cursor minute
+            # itself; upserts make the overlap harmless.
+            filter = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": cursor}}
+
+        seen = 0
+        newest = cursor
+        async for page in iter_database_query(database_id, filter=filter, sorts=sorts):
+            self._upsert(page, key)
+            seen += 1
+            edited = page.get("last_edited_time")
+            if edited and (newest is None or edited > newest):
+                newest = edited
+
+        now = time.time()
+        if full:
+            # Anything not returned by a full scan was archived or deleted. Rows
+            # the scan or record_page() wrote since it started are newer than that.
+            self._db.execute("DELETE FROM tasks WHERE database_id = ? AND synced_at < ?", (key, scan_started))
+        self._db.execute(
+            """
+            INSERT INTO sync_state (database_id, cursor, last_synced_at, last_full_sync_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(database_id) DO UPDATE SET
+                cursor = excluded.cursor,
+                last_synced_at = excluded.last_synced_at,
+                last_full_sync_at = CASE WHEN ? THEN excluded.last_full_sync_at ELSE sync_state.last_full_sync_at END
+            """,
+            (key, newest, now, now if full else 0, full),
+        )
+        self._db.commit()
+        logger.info(
+            f"Task index {'full' if full else 'incremental'} sync of {database_id}: "
+            f"{seen} pages in {(time.perf_counter() - started) * 1000:.0f} ms"
+        )
+        return seen
+
+    # --- Write-through hooks for our own Notion writes ---
+
+    def _upsert(self, page: Dict[str, Any], database_id: str) -> None:
+        title = extract_title(page)
+        self._db.execute(
+            """
+            INSERT INTO tasks (page_id, database_id, title, title_norm, url, last_edited_time, synced_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(page_id) DO UPDATE SET
+                database_id = excluded.database_id,
+                title = excluded.title,
+                title_norm = excluded.title_norm,
+                url = excluded.url,
+                last_edited_time = excluded.last_edited_time,
+                synced_at = excluded.synced_at
+            """,
+            (
+                page["id"], normalize_database_id(database_id), title, normalize_title(title),
+                page.get("url"), page.get("last_edited_time"), time.time(),
+            ),
+        )
+
+    def record_page(self, page: Dict[str, Any]) -> None:
+        """Reflects a page we just created or updated; archived pages are removed."""
+        if not page or not page.get("id"):
+            return
+        if page.get("archived") or page.get("in_trash"):
+            self.remove_page(page["id"])
+            return
+        database_id = (page.get("parent") or {}).get("database_id")
+        if not database_id:
+            return
+        self._upsert(page, database_id)
+        self._db.commit()
+
+    def remove_page(self, page_id: str) -> None:
+        self._db.execute("DELETE FROM tasks WHERE page_id = ?", (page_id,))
+        self._db.commit()
+
+    # --- Lookups ---
+
+    async def lookup(self, task_name: str, database_id: Optional[str] = None, limit: int = 10) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Resolves a task name against the index.
+
+        Returns a dict with three lists of {"task_id", "task_name", "url"}:
+            exact:  titles equal to task_name (case/whitespace-insensitive)
+            prefix: titles starting with, or otherwise containing, task_name
+            fuzzy:  close spellings, used as suggestions when nothing else matched
+        """
+        result: Dict[str, List[Dict[str, Any]]] = {"exact": [], "prefix": [], "fuzzy": []}
+        database_id = database_id or DEFAULT_TASKS_DATABASE_ID
+        if not database_id:
+            logger.warning("Task lookup without a tasks database (no department and NOTION_TASKS_DATABASE_ID unset).")
+            return result
+        await self.ensure_synced(database_id)
+        database_id = normalize_database_id(database_id)
+        needle = normalize_title(task_name)
+        if not needle:
+            return result
+
+        rows = self._db.execute(
+            "SELECT page_id, title, url FROM tasks WHERE database_id = ? AND title_norm = ? LIMIT ?",
+            (database_id, needle, limit),
+        ).fetchall()
+        result["exact"] = [self._row_to_match(row) for row in rows]
+
+        # Range scan on the (database_id, title_norm) index for prefixes,
+        # then a substring pass for titles that merely contain the name.
+        rows = self._db.execute(
+            """
+            SELECT page_id, title, url FROM tasks
+            WHERE database_id = ? AND title_norm > ? AND title_norm < ?
+            ORDER BY title_norm LIMIT ?
+            """,
+            (database_id, needle, needle + "\uffff", limit),
+        ).fetchall()
+        if len(rows) < limit:
+            rows += self._db.execute(
+                """
+                SELECT page_id, title, url FROM tasks
+                WHERE database_id = ? AND instr(title_norm, ?) > 1
+                LIMIT ?
+                """,
+                (database_id, needle, limit - len(rows)),
+            ).fetchall()
+        result["prefix"] = [self._row_to_match(row) for row in rows]
+
+        if not result["exact"] and not result["prefix"]:
+            titles = {
+                row["title_norm"]: row
+                for row in self._db.execute(
+                    "SELECT page_id, title, url, title_norm FROM tasks WHERE database_id = ?",
+                    (database_id,),
+                )
+            }
+            close = difflib.get_close_matches(needle, list(titles), n=min(limit, 5), cutoff=TASK_INDEX_FUZZY_CUTOFF)
+            result["fuzzy"] = [self._row_to_match(titles[title]) for title in close]
+        return result
+
+    async def find_unique(self, task_name: str, database_id: Optional[str] = None, allow_partial: bool = False) -> Dict[str, Any]:
+        """
+        Convenience wrapper for tools that need exactly one task.
+
+        Returns {"status": "found", "task": {...}} when there is a single exact
+        match (or, with allow_partial, a single partial match),
+        {"status": "ambiguous", "options": [...]} when several tasks qualify, and
+        {"status": "not_found", "suggestions": [...]} otherwise.
+        """
+        matches = await self.lookup(task_name, database_id)
+        if len(matches["exact"]) == 1:
+            return {"status": "found", "task": matches["exact"][0]}
+        if len(matches["exact"]) > 1:
+            return {"status": "ambiguous", "options": [m["task_name"] for m in matches["exact"]]}
+        if allow_partial and len(matches["prefix"]) == 1:
+            return {"status": "found", "task": matches["prefix"][0]}
+        if matches["prefix"]:
+            return {"status": "ambiguous", "options": [m["task_name"] for m in matches["prefix"]]}
+        return {"status": "not_found", "suggestions": [m["task_name"] for m in matches["fuzzy"]]}
+
+    @staticmethod
+    def _row_to_match(row: sqlite3.Row) -> Dict[str, Any]:
+        return {"task_id": row["page_id"], "task_name": row["title"], "url": row["url"]}
+
+
+task_index = TaskIndex()
+
+
+async def _department_database_ids() -> List[str]:
+    database_ids = [DEFAULT_TASKS_DATABASE_ID] if DEFAULT_TASKS_DATABASE_ID else []
+    try:
+        async for conn in get_db_connection():
+            rows = await execute_query(
+                conn,
+                "SELECT DISTINCT database_id FROM Departments WHERE database_id IS NOT NULL",
+                None,
+                fetch_one=False
+            )
+        database_ids += [row["database_id"] for row in rows if row["database_id"] not in database_ids]
+    except Exception as e:
+        logger.error(f"Could not load department databases for the task index: {e}")
+    return database_ids
+
+
+async def run_task_index_sync_loop() -> None:
+    """
+    Keeps the default tasks database, every department database and any
+    other database a lookup has used synced in the background, so title
+    lookups never wait for Notion. Started as a background task on startup.
+    """
+    while True:
+        for database_id in await _department_database_ids():
+            task_index.track(database_id)
+        await task_index.refresh_tracked()
+        await asyncio.sleep(TASK_INDEX_SYNC_INTERVAL_SECONDS)
@@ -0,0 +1,298 @@
+# services/thread_cache.py
+
+import os
+import json
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from db import get_db_connection
+from utils.cache import TTLCache
+from utils.db_helper import execute_query
+
+try:
+    import redis.asyncio as redis_asyncio
+    from redis.exceptions import WatchError
+except ImportError:  # optional shared backend
+    redis_asyncio = None
+    WatchError = None
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+THREAD_CACHE_SIZE = int(os.getenv("THREAD_CACHE_SIZE", "512"))
+THREAD_CACHE_TTL_SECONDS = float(os.getenv("THREAD_CACHE_TTL_SECONDS", "3600"))
+# When set (and the redis package is installed) threads are cached in Redis so
+# every worker process sees the same copy; otherwise the cache is per process.
+THREAD_CACHE_REDIS_URL = os.getenv("THREAD_CACHE_REDIS_URL")
+
+MESSAGE_FIELDS = ("message_id", "author_type", "content")
+
+
+def _message_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: row[name] for name in MESSAGE_FIELDS}
+
+
+async def _read_thread(thread_id: str) -> List[Dict[str, Any]]:
+    async for conn in get_db_connection():
+        rows = await execute_query(
+            conn,
+            # message_id breaks created_at ties; UUIDv7 ids sort by creation time.
+            "SELECT message_id, author_type, content FROM Messages WHERE thread_id = :thread_id ORDER BY created_at ASC, message_id ASC",
+            {"thread_id": thread_id},
+            fetch_one=False
+        )
+    return [_message_row(row) for row in rows]
+
+
+async def _newest_message_id(thread_id: str) -> Optional[str]:
+    async for conn in get_db_connection():
+        row = await execute_query(
+            conn,
+            # Served from idx_messages_thread_created (the primary key rides along).
+            "SELECT message_id FROM Messages WHERE thread_id = :thread_id ORDER BY created_at DESC, message_id DESC LIMIT 1",
+            {"thread_id": thread_id},
+            fetch_one=True
+        )
+    return row["message_id"] if row else None
+
+
+class _LocalBackend:
+    """
+    Process-local LRU of thread_id -> message rows. Other instances write to
+    the same threads without telling this one, so ThreadCache checks a hit
+    against the newest message in the database before serving it.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._threads = TTLCache(maxsize=THREAD_CACHE_SIZE, ttl_seconds=THREAD_CACHE_TTL_SECONDS, name="thread_messages")
+
+    async def get(self, thread_id: str) -> Optional[List[Dict[str, Any]]]:
+        return self._threads.get(thread_id)
+
+    async def append(self, thread_id: str, row: Dict[str, Any]) -> None:
+        messages = self._threads.get(thread_id)
+        if messages is not None and not any(m["message_id"] == row["message_id"] for m in messages):
+            messages.append(row)
+
+    async def fill(self, thread_id: str, messages: List[Dict[str, Any]]) -> None:
+        self._threads.set(thread_id, messages)
+
+    async def invalidate(self, thread_id: str) -> None:
+        self._threads.invalidate(thread_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._threads.stats()
+
+    async def close(self) -> None:
+        pass
+
+
+class _RedisBackend:
+    """
+    Threads stored as Redis lists of JSON rows. A per-thread generation counter
+    is bumped by every append so a fill racing with an append is dropped
+    instead of overwriting the list with rows that miss the new message.
+    """
+
+    shared = True
+
+    def __init__(self, url: str):
+        self._redis = redis_asyncio.from_url(url)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _keys(thread_id: str):
+        return f"thread_messages:{thread_id}", f"thread_messages_gen:{thread_id}"
+
+    async def get(self, thread_id: str) -> Optional[List[Dict[str, Any]]]:
+        key, _ = self._keys(thread_id)
+        raw = await self._redis.lrange(key, 0, -1)
+        if not raw:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [json.loads(item) for item in raw]
+
+    async def generation(self, thread_id: str) -> Optional[bytes]:
+        _, gen_key = self._keys(thread_id)
+        return await self._redis.get(gen_key)
+
+    async def append(self, thread_id: str, row: Dict[str, Any]) -> None:
+        key, gen_key = self._keys(thread_id)
+        ttl = int(THREAD_CACHE_TTL_SECONDS)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.incr(gen_key)
+            pipe.expire(gen_key, ttl)
+            pipe.rpushx(key, json.dumps(row))
+            pipe.expire(key, ttl)
+            await pipe.execute()
+
+    async def fill(self, thread_id: str, messages: List[Dict[str, Any]], generation: Optional[bytes] = None) -> None:
+        if not messages:
+            return
+        key, gen_key = self._keys(thread_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(gen_key)
+                if await pipe.get(gen_key) != generation:
+                    return
+                pipe.multi()
+                pipe.delete(key)
+                pipe.rpush(key, *(json.dumps(row) for row in messages))
+                pipe.expire(key, int(THREAD_CACHE_TTL_SECONDS))
+                await pipe.execute()
+            except WatchError:
+                pass
+
+    async def invalidate(self, thread_id: str) -> None:
+        key, gen_key = self._keys(thread_id)
+        async with self._redis.pipeline(transaction=True) as pipe:
+            pipe.incr(gen_key)
+            pipe.delete(key)
+            await pipe.execute()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": "thread_messages(redis)",
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+class ThreadCache:
+    """
+    Write-through cache of each thread's messages, in created_at order, as
+    {"message_id", "author_type", "content"} rows.
+
+    handle_chat appends every message after the insert commits, so building
+    the ChatHistoryResponse and serving GET /chat/{thread_id} no longer
+    re-read the whole thread from Messages. Appends to a thread that is not
+    cached are ignored; the next read loads it from the database.
+
+    With Redis every instance appends to the same copy. The local backend
+    only sees this process's appends, so a local hit is served only if its
+    last message is still the thread's newest in Messages (one indexed
+    single-row read); otherwise the thread is reloaded.
+    """
+
+    def __init__(self):
+        self._backend = self._make_backend()
+        # Local loads in progress; an append while one runs marks it stale.
+        self._loading: Dict[str, Dict[str, Any]] = {}
+        self.stale_local_hits = 0
+
+    @staticmethod
+    def _make_backend():
+        if THREAD_CACHE_REDIS_URL:
+            if redis_asyncio is not None:
+                logger.info("Thread cache using Redis.")
+                return _RedisBackend(THREAD_CACHE_REDIS_URL)
+            logger.warning("THREAD_CACHE_REDIS_URL is set but the redis package is not installed; using a local cache.")
+        return _LocalBackend()
+
+    async def get_messages(self, thread_id: str) -> List[Dict[str, Any]]:
+        """Returns the thread's messages, loading and caching them on a miss."""
+        try:
+            messages = await self._backend.get(thread_id)
+        except Exception as e:
+            logger.error(f"Thread cache read failed for {thread_id}: {e}")
+            return await _read_thread(thread_id)
+        if messages is not None:
+            if self._backend.shared or await self._is_current(thread_id, messages):
+                return list(messages)
+            self.stale_local_hits += 1
+            await self._backend.invalidate(thread_id)
+
+        if self._backend.shared:
+            return await self._load_shared(thread_id)
+        return await self._load_local(thread_id)
+
+    async def _is_current(self, thread_id: str, messages: List[Dict[str, Any]]) -> bool:
+        """False when another instance has written to the thread since it was cached."""
+        try:
+            newest = await _newest_message_id(thread_id)
+        except Exception as e:
+            logger.error(f"Thread cache freshness check failed for {thread_id}: {e}")
+            return True
+        return newest == (messages[-1]["message_id"] if messages else None)
+
+    async def _load_local(self, thread_id: str) -> List[Dict[str, Any]]:
+        pending = self._loading.get(thread_id)
+        if pending is not None:
+            try:
+                return list(await asyncio.shield(pending["future"]))
+            except asyncio.CancelledError:
+                if not pending["future"].cancelled():
+                    raise
+                return await _read_thread(thread_id)
+
+        state = {"future": asyncio.get_running_loop().create_future(), "stale": False}
+        self._loading[thread_id] = state
+        try:
+            messages = await _read_thread(thread_id)
+            if not state["stale"]:
+                await self._backend.fill(thread_id, messages)
+            state["future"].set_result(messages)
+            return list(messages)
+        except Exception as e:
+            state["future"].set_exception(e)
+            state["future"].exception()
+            raise
+        finally:
+            if not state["future"].done():
+                # The loading call was cancelled; waiters read the thread themselves.
+                state["future"].cancel()
+            self._loading.pop(thread_id, None)
+
+    async def _load_shared(self, thread_id: str) -> List[Dict[str, Any]]:
+        try:
+            generation = await self._backend.generation(thread_id)
+        except Exception as e:
+            logger.error(f"Thread cache read failed for {thread_id}: {e}")
+            return await _read_thread(thread_id)
+        messages = await _read_thread(thread_id)
+        try:
+            await self._backend.fill(thread_id, messages, generation)
+        except Exception as e:
+            logger.error(f"Thread cache fill failed for {thread_id}: {e}")
+        return messages
+
+    async def append(self, thread_id: str, message_id: str, author_type: str, content: str) -> None:
+        """Records a message that has been committed to Messages."""
+        state = self._loading.get(thread_id)
+        if state is not None:
+            state["stale"] = True
+        row = {"message_id": message_id, "author_type": author_type, "content": content}
+        try:
+            await self._backend.append(thread_id, row)
+        except Exception as e:
+            logger.error(f"Thread cache append failed for {thread_id}: {e}")
+            await self.invalidate(thread_id)
+
+    async def invalidate(self, thread_id: str) -> None:
+        try:
+            await self._backend.invalidate(thread_id)
+        except Exception as e:
+            logger.error(f"Thread cache invalidation failed for {thread_id}: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._backend.stats(), "stale_local_hits": self.stale_local_hits}
+
+    async def close(self) -> None:
+        logger.info(f"Thread cache stats: {self.stats()}")
+        await self._backend.close()
+
+
+thread_cache = ThreadCache()
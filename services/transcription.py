@@ -0,0 +1,474 @@
+# services/transcription.py
+
+import os
+import io
+import time
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+from utils.audio import (
+    PASSTHROUGH_FORMATS, PCM_BYTES_PER_MS, STREAMABLE_FORMATS, TARGET_FORMAT, TARGET_SAMPLE_RATE,
+    convert_to_flac, cut_pcm_segment, extract_segment, sniff_format,
+)
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+TRANSCRIPTION_MODEL = os.getenv("TRANSCRIPTION_MODEL", "gpt-4o-mini-transcribe")
+# ffmpeg decodes run in this many worker processes, off the event loop.
+TRANSCRIPTION_DECODE_WORKERS = int(os.getenv("TRANSCRIPTION_DECODE_WORKERS", str(min(2, os.cpu_count() or 1))))
+# Concurrent uploads to the transcription API per process.
+TRANSCRIPTION_MAX_CONCURRENCY = int(os.getenv("TRANSCRIPTION_MAX_CONCURRENCY", "8"))
+TRANSCRIPTION_TIMEOUT_SECONDS = float(os.getenv("TRANSCRIPTION_TIMEOUT_SECONDS", "60"))
+# Streaming (/ws/voice_chat?stream=true): how often the growing recording is
+# checked for a new segment, and how segments are cut (see extract_segment).
+TRANSCRIPTION_STREAM_INTERVAL_SECONDS = float(os.getenv("TRANSCRIPTION_STREAM_INTERVAL_SECONDS", "1.0"))
+TRANSCRIPTION_SEGMENT_MIN_MS = int(os.getenv("TRANSCRIPTION_SEGMENT_MIN_MS", "2000"))
+TRANSCRIPTION_SEGMENT_MAX_MS = int(os.getenv("TRANSCRIPTION_SEGMENT_MAX_MS", "12000"))
+TRANSCRIPTION_SEGMENT_SILENCE_MS = int(os.getenv("TRANSCRIPTION_SEGMENT_SILENCE_MS", "400"))
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+
+STAGES = ("queue", "decode", "upload", "total")
+
+
+class TranscriptionService:
+    """
+    Shared speech-to-text pipeline for the WhatsApp webhook, POST /voice_chat
+    and /ws/voice_chat.
+
+    Formats the API accepts (ogg, webm, mp3, m4a/mp4, flac) are detected
+    from their magic bytes and uploaded unchanged. Anything else is converted
+    to 16 kHz mono FLAC in a bounded process pool. The upload goes through
+    AsyncOpenAI behind a semaphore, so a voice note never blocks the event
+    loop. Per-stage timings (waiting for a slot, decode, upload, total)
+    are logged per request and aggregated in stats().
+    """
+
+    def __init__(self):
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._client: Optional[AsyncOpenAI] = None
+        self._slots = asyncio.Semaphore(TRANSCRIPTION_MAX_CONCURRENCY)
+        self._timings: Dict[str, Dict[str, float]] = {stage: {"count": 0, "total_ms": 0.0, "max_ms": 0.0} for stage in STAGES}
+        self.requests = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_uploaded = 0
+        self.passthrough = 0
+        self.converted = 0
+        self.segments = 0
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=TRANSCRIPTION_DECODE_WORKERS)
+        return self._pool
+
+    def _openai(self) -> AsyncOpenAI:
+        if self._client is None:
+            self._client = AsyncOpenAI(timeout=TRANSCRIPTION_TIMEOUT_SECONDS)
+        return self._client
+
+    def _record(self, stage: str, elapsed_ms: float) -> None:
+        timing = self._timings[stage]
+        timing["count"] += 1
+        timing["total_ms"] += elapsed_ms
+        timing["max_ms"] = max(timing["max_ms"], elapsed_ms)
+
+    async def transcribe(self, audio_bytes: bytes, format: Optional[str] = None) -> str:
+        """
+        Returns the transcript of an audio clip. `format` is an ffmpeg format
+        hint (e.g. "webm") used only if the clip has to be converted; without
+        it ffmpeg probes the bytes. Raises on decode or API errors.
+        """
+        self.requests += 1
+        self.bytes_in += len(audio_bytes)
+        started = time.perf_counter()
+        timings: Dict[str, float] = {}
+        try:
+            async with self._slots:
+                acquired = time.perf_counter()
+                timings["queue"] = (acquired - started) * 1000
+
+                detected = sniff_format(audio_bytes)
+                if detected in PASSTHROUGH_FORMATS:
+                    self.passthrough += 1
+                    upload_bytes, extension = audio_bytes, detected
+                else:
+                    self.converted += 1
+                    loop = asyncio.get_running_loop()
+                    upload_bytes = await loop.run_in_executor(self._executor(), convert_to_flac, audio_bytes, format)
+                    extension = TARGET_FORMAT
+                    timings["decode"] = (time.perf_counter() - acquired) * 1000
+                decoded = time.perf_counter()
+                text = await self._upload(upload_bytes, extension)
+                timings["upload"] = (time.perf_counter() - decoded) * 1000
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            timings["total"] = (time.perf_counter() - started) * 1000
+            for stage, elapsed_ms in timings.items():
+                self._record(stage, elapsed_ms)
+
+        logger.info(
+            f"Transcribed {len(audio_bytes)} bytes ({detected or 'unknown'} -> {extension}, {len(upload_bytes)} bytes uploaded): "
+            + ", ".join(f"{stage} {timings[stage]:.0f} ms" for stage in STAGES if stage in timings)
+        )
+        return text
+
+    async def transcribe_segment(
+        self,
+        audio_bytes: bytes,
+        start_ms: int,
+        final: bool,
+        format: Optional[str] = None,
+        prompt: Optional[str] = None,
+    ) -> Tuple[str, int, int]:
+        """
+        Transcribes the next segment of a recording that is still growing and
+        cannot be decoded incrementally. `audio_bytes` is the whole recording
+        so far and `start_ms` the end of the previous segment. Returns
+        (text, end_ms, total_ms); text is "" and end_ms is start_ms when no
+        segment is ready yet. `prompt` (the transcript so far) keeps wording
+        consistent across segment boundaries.
+        """
+        text, end_ms, total_ms = await self._transcribe_cut(
+            f"segment from {start_ms} ms",
+            extract_segment,
+            (audio_bytes, format, start_ms, final,
+             TRANSCRIPTION_SEGMENT_MIN_MS, TRANSCRIPTION_SEGMENT_MAX_MS, TRANSCRIPTION_SEGMENT_SILENCE_MS),
+            prompt,
+        )
+        return text, end_ms, total_ms
+
+    async def transcribe_pcm_segment(self, pcm: bytes, final: bool, prompt: Optional[str] = None) -> Tuple[str, int]:
+        """
+        Transcribes the next segment of streamed PCM that starts at the
+        previous cut (see PcmStreamDecoder). Returns (text, ms consumed);
+        0 ms when no segment is ready yet.
+        """
+        text, consumed_ms = await self._transcribe_cut(
+            "streamed segment",
+            cut_pcm_segment,
+            (pcm, final, TRANSCRIPTION_SEGMENT_MIN_MS, TRANSCRIPTION_SEGMENT_MAX_MS, TRANSCRIPTION_SEGMENT_SILENCE_MS),
+            prompt,
+        )
+        return text, consumed_ms
+
+    async def _transcribe_cut(self, label: str, cut, args: tuple, prompt: Optional[str]) -> tuple:
+        """
+        Runs `cut(*args)` in the process pool; it returns (segment bytes or
+        None, *positions). A segment is uploaded and its text returned with
+        the positions. Only the upload takes one of the shared slots, so
+        passes that find no segment never hold up other transcriptions.
+        """
+        started = time.perf_counter()
+        timings: Dict[str, float] = {}
+        try:
+            loop = asyncio.get_running_loop()
+            segment, *positions = await loop.run_in_executor(self._executor(), cut, *args)
+            decoded = time.perf_counter()
+            timings["decode"] = (decoded - started) * 1000
+            if segment is None:
+                return ("", *positions)
+            self.requests += 1
+            self.segments += 1
+            async with self._slots:
+                acquired = time.perf_counter()
+                timings["queue"] = (acquired - decoded) * 1000
+                text = await self._upload(segment, TARGET_FORMAT, prompt)
+                timings["upload"] = (time.perf_counter() - acquired) * 1000
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            timings["total"] = (time.perf_counter() - started) * 1000
+            for stage, elapsed_ms in timings.items():
+                self._record(stage, elapsed_ms)
+
+        logger.info(
+            f"Transcribed {label} ({len(segment)} bytes uploaded): "
+            + ", ".join(f"{stage} {timings[stage]:.0f} ms" for stage in STAGES if stage in timings)
+        )
+        return (text, *positions)
+
+    async def _upload(self, upload_bytes: bytes, extension: str, prompt: Optional[str] = None) -> str:
+        # The API infers the container from the file name.
+        upload = io.BytesIO(upload_bytes)
+        upload.name = f"input.{extension}"
+        self.bytes_uploaded += len(upload_bytes)
+        options: Dict[str, Any] = {"prompt": prompt[-1000:]} if prompt else {}
+        transcription = await self._openai().audio.transcriptions.create(
+            model=TRANSCRIPTION_MODEL,
+            file=upload,
+            response_format="json",
+            **options,
+        )
+        return transcription.text
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "bytes_in": self.bytes_in,
+            "bytes_uploaded": self.bytes_uploaded,
+            "passthrough": self.passthrough,
+            "converted": self.converted,
+            "segments": self.segments,
+            "stages": {
+                stage: {
+                    "count": t["count"],
+                    "avg_ms": round(t["total_ms"] / t["count"], 1) if t["count"] else 0.0,
+                    "max_ms": round(t["max_ms"], 1),
+                }
+                for stage, t in self._timings.items()
+            },
+        }
+
+    async def close(self) -> None:
+        logger.info(f"Transcription stats: {self.stats()}")
+        if self._pool is not None:
+            # Waiting lets the pool's management thread exit cleanly; queued decodes are cancelled.
+            await asyncio.to_thread(self._pool.shutdown, wait=True, cancel_futures=True)
+            self._pool = None
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class PcmStreamDecoder:
+    """
+    One long-running ffmpeg process per streamed recording that decodes the
+    chunks as they arrive into 16 kHz mono PCM (see utils.audio), so each
+    byte is decoded once instead of the whole recording on every pass.
+
+    feed() queues compressed chunks; a writer task pipes them to ffmpeg and
+    a reader task collects the PCM in `pcm`. Consumers drop what they have
+    transcribed with discard(). close() flushes ffmpeg and waits for the
+    last samples.
+    """
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self._process = process
+        self.pcm = bytearray()
+        self._chunks: asyncio.Queue = asyncio.Queue()
+        self._writer = asyncio.create_task(self._write())
+        self._reader = asyncio.create_task(self._read())
+
+    @classmethod
+    async def start(cls, format: str) -> "PcmStreamDecoder":
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_BINARY, "-hide_banner", "-loglevel", "error",
+            # Start decoding from the first chunks instead of probing seconds of input.
+            "-fflags", "nobuffer", "-probesize", "32768", "-analyzeduration", "0",
+            "-f", format, "-i", "pipe:0",
+            "-f", "s16le", "-ac", "1", "-ar", str(TARGET_SAMPLE_RATE), "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        return cls(process)
+
+    @property
+    def pending_ms(self) -> int:
+        return len(self.pcm) // PCM_BYTES_PER_MS
+
+    def feed(self, chunk: bytes) -> None:
+        self._chunks.put_nowait(chunk)
+
+    def discard(self, ms: int) -> None:
+        del self.pcm[:ms * PCM_BYTES_PER_MS]
+
+    async def _write(self) -> None:
+        stdin = self._process.stdin
+        try:
+            while True:
+                chunk = await self._chunks.get()
+                if chunk is None:
+                    break
+                stdin.write(chunk)
+                await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            logger.warning(f"Streaming decoder stopped accepting audio: {e}")
+        finally:
+            stdin.close()
+
+    async def _read(self) -> None:
+        while True:
+            data = await self._process.stdout.read(65536)
+            if not data:
+                return
+            self.pcm.extend(data)
+
+    async def close(self) -> None:
+        """Decodes everything fed so far and stops ffmpeg."""
+        self._chunks.put_nowait(None)
+        await self._writer
+        await self._reader
+        await self._process.wait()
+
+    async def kill(self) -> None:
+        for task in (self._writer, self._reader):
+            task.cancel()
+        if self._process.returncode is None:
+            self._process.kill()
+        await self._process.wait()
+
+
+class StreamingTranscription:
+    """
+    Transcribes a recording while it is still arriving.
+
+    feed() appends chunks as they come off the socket; a background task
+    looks for a new segment at most every TRANSCRIPTION_STREAM_INTERVAL_SECONDS,
+    transcribes it and reports it through `on_segment(index, text)`. finish()
+    transcribes whatever is left after the last cut and returns the full
+    transcript, so only the tail of the recording is on the critical path.
+
+    Streamable formats (e.g. MediaRecorder WebM) go through a
+    PcmStreamDecoder, so a pass only cuts the PCM after the previous segment
+    and the recording is decoded once overall. Other formats are decoded
+    from the start on each pass, and a pass is skipped until at least
+    TRANSCRIPTION_SEGMENT_MIN_MS of new audio should have arrived. Either
+    way a pass that cannot produce a segment yet never reaches the pool.
+    A failed pass leaves the cursor where it was, so the next one retries.
+    """
+
+    def __init__(
+        self,
+        format: Optional[str] = None,
+        on_segment: Optional[Callable[[int, str], Awaitable[None]]] = None,
+        service: Optional[TranscriptionService] = None,
+    ):
+        self.format = format
+        self._on_segment = on_segment
+        self._service = service or transcription_service
+        self._buffer = bytearray()
+        self._cursor_ms = 0
+        self._segments: List[str] = []
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._decoder: Optional[PcmStreamDecoder] = None
+        # Non-streamable formats: buffer size and decoded length at the last pass.
+        self._last_pass_bytes = 0
+        self._last_pass_ms = 0
+
+    @property
+    def text(self) -> str:
+        return " ".join(segment for segment in self._segments if segment)
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def feed(self, chunk: bytes) -> None:
+        if not chunk or self._stopping.is_set():
+            return
+        self._buffer.extend(chunk)
+        if self._decoder is not None:
+            self._decoder.feed(chunk)
+        self._wakeup.set()
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def finish(self) -> str:
+        """Transcribes the rest of the recording and returns the full transcript."""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            await self._worker
+        if self._buffer:
+            if self._decoder is not None:
+                await self._decoder.close()
+            await self._next_segment(final=True)
+        return self.text
+
+    async def aclose(self) -> None:
+        """Stops the background task without transcribing the rest."""
+        self._stopping.set()
+        if self._worker is not None and not self._worker.done():
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        if self._decoder is not None:
+            await self._decoder.kill()
+
+    async def _start_decoder(self) -> None:
+        if self.format not in STREAMABLE_FORMATS:
+            return
+        try:
+            decoder = await PcmStreamDecoder.start(self.format)
+        except OSError as e:
+            logger.warning(f"Could not start the streaming decoder, decoding each pass from the start: {e}")
+            return
+        # Chunks received while ffmpeg started; later ones are fed by feed().
+        decoder.feed(bytes(self._buffer))
+        self._decoder = decoder
+
+    async def _run(self) -> None:
+        await self._start_decoder()
+        while not self._stopping.is_set():
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                return
+            try:
+                await self._next_segment(final=False)
+            except Exception as e:
+                logger.warning(f"Streaming transcription pass failed at {self._cursor_ms} ms: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), TRANSCRIPTION_STREAM_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    def _too_little_new_audio(self) -> bool:
+        """Non-streamable formats: estimates the new audio from the bitrate seen at the last pass."""
+        if not self._last_pass_bytes or not self._last_pass_ms:
+            return False
+        new_ms = (len(self._buffer) - self._last_pass_bytes) * self._last_pass_ms / self._last_pass_bytes
+        return new_ms < TRANSCRIPTION_SEGMENT_MIN_MS
+
+    async def _next_segment(self, final: bool) -> None:
+        prompt = self.text or None
+        if self._decoder is not None:
+            if not final and self._decoder.pending_ms < TRANSCRIPTION_SEGMENT_MIN_MS:
+                return
+            text, consumed_ms = await self._service.transcribe_pcm_segment(bytes(self._decoder.pcm), final, prompt=prompt)
+            if not consumed_ms:
+                return
+            self._decoder.discard(consumed_ms)
+            end_ms = self._cursor_ms + consumed_ms
+        else:
+            if not final and self._too_little_new_audio():
+                return
+            buffered = len(self._buffer)
+            text, end_ms, total_ms = await self._service.transcribe_segment(
+                bytes(self._buffer), self._cursor_ms, final, format=self.format, prompt=prompt
+            )
+            self._last_pass_bytes, self._last_pass_ms = buffered, total_ms
+            if end_ms == self._cursor_ms:
+                return
+        self._cursor_ms = end_ms
+        text = text.strip()
+        if not text:
+            return
+        self._segments.append(text)
+        if self._on_segment is not None:
+            try:
+                await self._on_segment(len(self._segments) - 1, text)
+            except Exception as e:
+                logger.warning(f"Could not deliver partial transcript: {e}")
+
+
+transcription_service = TranscriptionService()
+
+
+async def transcribe_audio(audio_bytes: bytes, format: Optional[str] = None) -> str:
+    return await transcription_service.transcribe(audio_bytes, format)
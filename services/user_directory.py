@@ -0,0 +1,223 @@
+# services/user_directory.py
+
+import os
+import time
+import asyncio
+import difflib
+import logging
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from dotenv import load_dotenv
+
+from db import get_db_connection
+from utils.db_helper import execute_query
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+USER_DIRECTORY_REFRESH_SECONDS = float(os.getenv("USER_DIRECTORY_REFRESH_SECONDS", "300"))
+# Same cutoff the per-agent difflib fallback used for "did you mean" suggestions.
+USER_DIRECTORY_SUGGESTION_CUTOFF = float(os.getenv("USER_DIRECTORY_SUGGESTION_CUTOFF", "0.8"))
+
+# Every lookup returns the same four columns so callers can go from any one of
+# them to the others. The WHERE clauses are plain equality on the columns
+# indexed in migrations/001_users_indexes.sql.
+USER_COLUMNS = "user_id, notion_user_id, phone_number, username"
+_LOOKUP_COLUMNS = ("user_id", "notion_user_id", "phone_number", "username")
+
+
+async def _get_user_by(column: str, value: Any) -> Optional[Dict[str, Any]]:
+    if column not in _LOOKUP_COLUMNS:
+        raise ValueError(f"Users cannot be looked up by '{column}'.")
+    if value is None or value == "":
+        return None
+    async for conn in get_db_connection():
+        row = await execute_query(
+            conn,
+            f"SELECT {USER_COLUMNS} FROM Users WHERE {column} = :value LIMIT 1",
+            {"value": value},
+            fetch_one=True
+        )
+    return dict(row) if row else None
+
+
+async def get_user_by_notion_id(notion_user_id: str) -> Optional[Dict[str, Any]]:
+    return user_directory.cached_by_notion_id(notion_user_id) or await _get_user_by("notion_user_id", notion_user_id)
+
+
+async def get_user_by_id(user_id: str) -> Optional[Dict[str, Any]]:
+    return user_directory.cached_by_user_id(user_id) or await _get_user_by("user_id", user_id)
+
+
+async def get_user_by_phone(phone_number: str) -> Optional[Dict[str, Any]]:
+    return user_directory.cached_by_phone(phone_number) or await _get_user_by("phone_number", phone_number)
+
+
+async def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
+    return await _get_user_by("username", username)
+
+
+async def get_users_by_notion_ids(notion_user_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Resolves several Notion user ids with a single `IN (...)` query.
+    Returns {notion_user_id: user}; ids without a matching user are left out.
+    """
+    ids: List[str] = list(dict.fromkeys(i for i in notion_user_ids if i))
+    found: Dict[str, Dict[str, Any]] = {}
+    for notion_user_id in ids:
+        user = user_directory.cached_by_notion_id(notion_user_id)
+        if user:
+            found[notion_user_id] = user
+    missing = [i for i in ids if i not in found]
+    if not missing:
+        return found
+    params = {f"id{n}": value for n, value in enumerate(missing)}
+    placeholders = ", ".join(f":{name}" for name in params)
+    async for conn in get_db_connection():
+        rows = await execute_query(
+            conn,
+            f"SELECT {USER_COLUMNS} FROM Users WHERE notion_user_id IN ({placeholders})",
+            params,
+            fetch_one=False
+        )
+    found.update({row["notion_user_id"]: dict(row) for row in rows})
+    return found
+
+
+# --- In-memory directory ---
+
+def normalize_name(name: str) -> str:
+    return " ".join((name or "").split()).casefold()
+
+
+def _trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class UserDirectory:
+    """
+    A process-wide snapshot of the Users table, loaded in one query and
+    refreshed on a timer (or explicitly via invalidate()).
+
+    Besides id/phone maps it keeps a trigram index over normalised usernames so
+    substring and "did you mean" searches only look at users that share
+    trigrams with the query instead of the whole table.
+    """
+
+    def __init__(self, refresh_seconds: float = USER_DIRECTORY_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._users: List[Dict[str, Any]] = []
+        self._names: List[str] = []
+        self._by_notion_id: Dict[str, Dict[str, Any]] = {}
+        self._by_user_id: Dict[Any, Dict[str, Any]] = {}
+        self._by_phone: Dict[str, Dict[str, Any]] = {}
+        self._trigram_index: Dict[str, Set[int]] = defaultdict(set)
+        self._loaded_at = 0.0
+        self._load_lock = asyncio.Lock()
+
+    @property
+    def is_fresh(self) -> bool:
+        return bool(self._loaded_at) and time.monotonic() - self._loaded_at < self.refresh_seconds
+
+    async def ensure_loaded(self) -> None:
+        if self.is_fresh:
+            return
+        async with self._load_lock:
+            if not self.is_fresh:
+                await self.refresh()
+
+    async def refresh(self) -> None:
+        """Reloads every user and rebuilds the lookup maps and trigram index."""
+        async for conn in get_db_connection():
+            rows = await execute_query(conn, f"SELECT {USER_COLUMNS} FROM Users", None, fetch_one=False)
+        users = [dict(row) for row in rows]
+        names = [normalize_name(user["username"]) for user in users]
+        trigram_index: Dict[str, Set[int]] = defaultdict(set)
+        for position, name in enumerate(names):
+            for gram in _trigrams(name):
+                trigram_index[gram].add(position)
+
+        # Swap everything in at once so concurrent readers never see a half-built index.
+        self._users, self._names, self._trigram_index = users, names, trigram_index
+        self._by_notion_id = {u["notion_user_id"]: u for u in users if u.get("notion_user_id")}
+        self._by_user_id = {u["user_id"]: u for u in users}
+        self._by_phone = {u["phone_number"]: u for u in users if u.get("phone_number")}
+        self._loaded_at = time.monotonic()
+        logger.info(f"User directory loaded {len(users)} users.")
+
+    def invalidate(self) -> None:
+        """Forces a reload on the next lookup, e.g. after Users was modified."""
+        self._loaded_at = 0.0
+
+    async def run_refresh_loop(self) -> None:
+        """Keeps the snapshot warm; started as a background task on startup."""
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"User directory refresh failed: {e}")
+            await asyncio.sleep(self.refresh_seconds)
+
+    # --- Lookups ---
+
+    def cached_by_notion_id(self, notion_user_id: str) -> Optional[Dict[str, Any]]:
+        return self._by_notion_id.get(notion_user_id) if self.is_fresh else None
+
+    def cached_by_user_id(self, user_id: Any) -> Optional[Dict[str, Any]]:
+        return self._by_user_id.get(user_id) if self.is_fresh else None
+
+    def cached_by_phone(self, phone_number: str) -> Optional[Dict[str, Any]]:
+        return self._by_phone.get(phone_number) if self.is_fresh else None
+
+    async def search(self, name: str, limit: int = 10) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Resolves a (possibly partial or misspelt) username.
+
+        Returns a dict with three lists of users:
+            exact:       usernames equal to name (case/whitespace-insensitive)
+            partial:     usernames containing name
+            suggestions: close spellings, only filled when nothing else matched
+        """
+        await self.ensure_loaded()
+        needle = normalize_name(name)
+        result: Dict[str, List[Dict[str, Any]]] = {"exact": [], "partial": [], "suggestions": []}
+        if not needle:
+            return result
+
+        if len(needle) >= 3:
+            # Every username containing the needle holds all of its inner trigrams.
+            inner = [needle[i:i + 3] for i in range(len(needle) - 2)]
+            candidates = set.intersection(*(self._trigram_index.get(gram, set()) for gram in inner))
+        else:
+            candidates = set(range(len(self._names)))
+
+        for position in sorted(candidates):
+            if self._names[position] == needle:
+                result["exact"].append(self._users[position])
+            elif needle in self._names[position] and len(result["partial"]) < limit:
+                result["partial"].append(self._users[position])
+
+        if not result["exact"] and not result["partial"]:
+            result["suggestions"] = self._suggest(needle, limit)
+        return result
+
+    def _suggest(self, needle: str, limit: int) -> List[Dict[str, Any]]:
+        # Rank users by shared trigrams, then confirm with difflib on that short list.
+        shared: Dict[int, int] = defaultdict(int)
+        for gram in _trigrams(needle):
+            for position in self._trigram_index.get(gram, ()):
+                shared[position] += 1
+        shortlist = sorted(shared, key=shared.get, reverse=True)[:50]
+        scored = []
+        for position in shortlist:
+            ratio = difflib.SequenceMatcher(None, needle, self._names[position]).ratio()
+            if ratio >= USER_DIRECTORY_SUGGESTION_CUTOFF:
+                scored.append((ratio, position))
+        scored.sort(reverse=True)
+        return [self._users[position] for _, position in scored[:limit]]
+
+
+user_directory = UserDirectory()
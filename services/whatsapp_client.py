@@ -0,0 +1,180 @@
+# services/whatsapp_client.py
+
+import os
+import time
+import random
+import asyncio
+import logging
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+try:
+    import h2  # noqa: F401  (httpx needs it for HTTP/2)
+except ImportError:  # optional, installed by httpx[http2]
+    h2 = None
+
+logger = logging.getLogger(__name__)
+
+# --- SETUP ---
+load_dotenv()
+WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
+WHATSAPP_GRAPH_URL = os.getenv("WHATSAPP_GRAPH_URL", "https://graph.facebook.com/v18.0")
+WHATSAPP_HTTP2 = os.getenv("WHATSAPP_HTTP2", "true").lower() in ("1", "true", "yes")
+WHATSAPP_MAX_CONNECTIONS = int(os.getenv("WHATSAPP_MAX_CONNECTIONS", "20"))
+WHATSAPP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("WHATSAPP_MAX_KEEPALIVE_CONNECTIONS", "10"))
+WHATSAPP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("WHATSAPP_KEEPALIVE_EXPIRY_SECONDS", "60"))
+WHATSAPP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("WHATSAPP_CONNECT_TIMEOUT_SECONDS", "5"))
+WHATSAPP_TIMEOUT_SECONDS = float(os.getenv("WHATSAPP_TIMEOUT_SECONDS", "20"))
+WHATSAPP_MAX_RETRIES = int(os.getenv("WHATSAPP_MAX_RETRIES", "3"))
+WHATSAPP_RETRY_BASE_SECONDS = float(os.getenv("WHATSAPP_RETRY_BASE_SECONDS", "0.5"))
+# Longest wait we honour from a Retry-After header before giving up.
+WHATSAPP_RETRY_MAX_SECONDS = float(os.getenv("WHATSAPP_RETRY_MAX_SECONDS", "30"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Graph may already have accepted a POST that failed with 5xx, so sends are only
+# retried when it was certainly rejected; the job queue retries 5xx sends once.
+POST_RETRY_STATUSES = {429}
+# Failures where the request never reached Graph, so even a send is safe to repeat.
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def _retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class WhatsAppClient:
+    """
+    One pooled (HTTP/2 when h2 is installed) connection to the Graph API for
+    the whole process. Sending messages and downloading media reuse its
+    TLS connections instead of paying a handshake per call.
+
+    GETs answered with 429 or 5xx are retried up to WHATSAPP_MAX_RETRIES
+    times, waiting for Retry-After when Graph sends it and for exponential
+    backoff with jitter otherwise. Other requests (message sends) are retried
+    here only on 429 and on connection failures where the request never went
+    out; a 5xx or a timeout after sending may mean Graph accepted the message,
+    so it is raised and left to the caller's single retry layer (the job
+    queue). Per-operation latency and error counts are kept in stats().
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+        self._metrics: Dict[str, Dict[str, float]] = {}
+
+    def start(self) -> None:
+        if self._client is not None:
+            return
+        http2 = WHATSAPP_HTTP2 and h2 is not None
+        if WHATSAPP_HTTP2 and h2 is None:
+            logger.warning("WHATSAPP_HTTP2 is set but the h2 package is not installed; using HTTP/1.1.")
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            headers={"Authorization": f"Bearer {WHATSAPP_TOKEN}"},
+            limits=httpx.Limits(
+                max_connections=WHATSAPP_MAX_CONNECTIONS,
+                max_keepalive_connections=WHATSAPP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=WHATSAPP_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            timeout=httpx.Timeout(WHATSAPP_TIMEOUT_SECONDS, connect=WHATSAPP_CONNECT_TIMEOUT_SECONDS),
+        )
+        logger.info(f"WhatsApp client started ({'HTTP/2' if http2 else 'HTTP/1.1'}).")
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            # Scripts and workers that never ran the app startup hook.
+            self.start()
+        return self._client
+
+    def _metric(self, operation: str) -> Dict[str, float]:
+        metric = self._metrics.get(operation)
+        if metric is None:
+            metric = self._metrics[operation] = {
+                "requests": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0,
+            }
+        return metric
+
+    async def request(self, operation: str, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Sends a request with retries and returns the final response, raising
+        httpx.HTTPStatusError for error statuses. `url` is relative to
+        WHATSAPP_GRAPH_URL unless absolute (media download URLs are).
+        `operation` labels the request in stats().
+        """
+        if not url.startswith("http"):
+            url = f"{WHATSAPP_GRAPH_URL}/{url.lstrip('/')}"
+        metric = self._metric(operation)
+        metric["requests"] += 1
+        started = time.perf_counter()
+        retry_statuses = RETRY_STATUSES if method.upper() == "GET" else POST_RETRY_STATUSES
+        attempt = 0
+        try:
+            while True:
+                delay = None
+                try:
+                    response = await self._http().request(method, url, **kwargs)
+                    if response.status_code in retry_statuses and attempt < WHATSAPP_MAX_RETRIES:
+                        delay = _retry_after_seconds(response)
+                        if delay is not None and delay > WHATSAPP_RETRY_MAX_SECONDS:
+                            delay = None
+                            attempt = WHATSAPP_MAX_RETRIES  # too far out; fail now
+                        elif delay is None:
+                            delay = self._backoff(attempt)
+                    if delay is None:
+                        response.raise_for_status()
+                        return response
+                    logger.warning(f"WhatsApp {operation} got {response.status_code}; retrying in {delay:.1f}s.")
+                except httpx.TransportError as e:
+                    retryable = isinstance(e, _NOT_SENT_ERRORS) or method.upper() == "GET"
+                    if not retryable or attempt >= WHATSAPP_MAX_RETRIES:
+                        raise
+                    delay = self._backoff(attempt)
+                    logger.warning(f"WhatsApp {operation} failed ({type(e).__name__}); retrying in {delay:.1f}s.")
+                attempt += 1
+                metric["retries"] += 1
+                await asyncio.sleep(delay)
+        except Exception:
+            metric["errors"] += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            metric["total_ms"] += elapsed_ms
+            metric["max_ms"] = max(metric["max_ms"], elapsed_ms)
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        delay = min(WHATSAPP_RETRY_MAX_SECONDS, WHATSAPP_RETRY_BASE_SECONDS * (2 ** attempt))
+        return delay * random.uniform(0.5, 1.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            operation: {
+                "requests": int(m["requests"]),
+                "errors": int(m["errors"]),
+                "retries": int(m["retries"]),
+                "avg_ms": round(m["total_ms"] / m["requests"], 1) if m["requests"] else 0.0,
+                "max_ms": round(m["max_ms"], 1),
+            }
+            for operation, m in self._metrics.items()
+        }
+
+    async def close(self) -> None:
+        logger.info(f"WhatsApp client stats: {self.stats()}")
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+whatsapp_client = WhatsAppClient()
@@ -0,0 +1,165 @@
+# utils/audio.py
+
+import io
+from typing import Optional, Tuple
+
+from pydub import AudioSegment
+from pydub.silence import detect_silence
+
+# Containers the transcription API accepts as-is. WAV is accepted too, but
+# it is uncompressed, so it is worth converting.
+PASSTHROUGH_FORMATS = {"ogg", "webm", "mp3", "m4a", "mp4", "flac"}
+
+# Target for everything else: speech needs no more than 16 kHz mono, and
+# FLAC is lossless and several times smaller than PCM WAV.
+TARGET_SAMPLE_RATE = 16000
+TARGET_FORMAT = "flac"
+
+# Raw PCM from a streaming decode (services/transcription.PcmStreamDecoder):
+# signed 16-bit little-endian, mono, TARGET_SAMPLE_RATE.
+PCM_SAMPLE_WIDTH = 2
+PCM_BYTES_PER_MS = TARGET_SAMPLE_RATE * PCM_SAMPLE_WIDTH // 1000
+
+# Containers ffmpeg can decode from a pipe as the bytes arrive. MP4/M4A keep
+# their index at the end, so they are only decodable once complete.
+STREAMABLE_FORMATS = {"webm", "ogg", "mp3", "flac", "wav"}
+
+# ISO base media brands that are audio/video mp4 (3GP/3G2 are not accepted).
+_MP4_BRANDS = (b"M4A ", b"M4B ", b"mp41", b"mp42", b"isom", b"iso2", b"dash", b"MSNV", b"avc1")
+
+
+def sniff_format(data: bytes) -> Optional[str]:
+    """
+    Identifies the audio container from its magic bytes.
+    Returns one of ogg, webm, mp3, m4a, mp4, flac, wav, or None if unknown
+    (e.g. AMR or 3GP voice notes).
+    """
+    head = data[:16]
+    if head.startswith(b"OggS"):
+        return "ogg"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):  # EBML: WebM/Matroska
+        return "webm"
+    if head.startswith(b"fLaC"):
+        return "flac"
+    if head.startswith(b"RIFF") and head[8:12] == b"WAVE":
+        return "wav"
+    if head[4:8] == b"ftyp":
+        brand = head[8:12]
+        if brand in (b"M4A ", b"M4B "):
+            return "m4a"
+        if brand in _MP4_BRANDS:
+            return "mp4"
+        return None
+    if head.startswith(b"ID3"):
+        return "mp3"
+    # MPEG audio frame sync; layer bits 00 would be AAC ADTS, not MP3.
+    if len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0 and (head[1] & 0x06) != 0:
+        return "mp3"
+    return None
+
+
+def convert_to_flac(audio_bytes: bytes, format: Optional[str] = None) -> bytes:
+    """
+    Decodes any ffmpeg-readable audio and re-encodes it as 16 kHz mono FLAC.
+
+    CPU-bound (ffmpeg subprocesses), so callers on the event loop run it in
+    the transcription service's process pool. It lives in this small module
+    so pool workers only import pydub.
+    """
+    audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format=format)
+    audio = audio.set_frame_rate(TARGET_SAMPLE_RATE).set_channels(1)
+    buffer = io.BytesIO()
+    audio.export(buffer, format=TARGET_FORMAT)
+    return buffer.getvalue()
+
+
+def _cut_point(pending: AudioSegment, min_segment_ms: int, max_segment_ms: int, min_silence_ms: int) -> Optional[int]:
+    """
+    Where the next segment of `pending` (audio not yet transcribed) ends, in
+    ms from its start: the middle of the last pause of at least
+    `min_silence_ms` once the segment is `min_segment_ms` long, or all of it
+    after `max_segment_ms` without a pause. None means wait for more audio.
+    """
+    if len(pending) < min_segment_ms:
+        return None
+    # Relative threshold, so quiet microphones still find their pauses.
+    threshold = pending.dBFS - 16 if pending.dBFS != float("-inf") else -60
+    pauses = [
+        (begin + stop) // 2
+        for begin, stop in detect_silence(pending, min_silence_len=min_silence_ms, silence_thresh=threshold, seek_step=10)
+        if (begin + stop) // 2 >= min_segment_ms
+    ]
+    if pauses:
+        return pauses[-1]
+    if len(pending) >= max_segment_ms:
+        return len(pending)
+    return None
+
+
+def _encode_segment(segment: AudioSegment) -> bytes:
+    segment = segment.set_frame_rate(TARGET_SAMPLE_RATE).set_channels(1)
+    buffer = io.BytesIO()
+    segment.export(buffer, format=TARGET_FORMAT)
+    return buffer.getvalue()
+
+
+def extract_segment(
+    audio_bytes: bytes,
+    format: Optional[str],
+    start_ms: int,
+    final: bool,
+    min_segment_ms: int = 2000,
+    max_segment_ms: int = 12000,
+    min_silence_ms: int = 400,
+    guard_ms: int = 250,
+) -> Tuple[Optional[bytes], int, int]:
+    """
+    Cuts the next speech segment out of a growing recording that cannot be
+    decoded incrementally (see STREAMABLE_FORMATS and cut_pcm_segment).
+
+    `audio_bytes` is everything received so far and `start_ms` is where the
+    previous segment ended; the cut is placed as described in _cut_point.
+    The last `guard_ms` are left alone because a partial final frame may
+    decode as silence. With final=True the rest of the recording is taken.
+
+    Returns (16 kHz mono FLAC bytes, end_ms, total_ms), or (None, start_ms,
+    total_ms) when there is no segment to cut yet. Runs in the transcription
+    process pool.
+    """
+    audio = AudioSegment.from_file(io.BytesIO(audio_bytes), format=format)
+    total_ms = len(audio)
+    if final:
+        end_ms = total_ms
+    else:
+        pending = audio[start_ms:max(start_ms, total_ms - guard_ms)]
+        cut = _cut_point(pending, min_segment_ms, max_segment_ms, min_silence_ms)
+        if cut is None:
+            return None, start_ms, total_ms
+        end_ms = start_ms + cut
+
+    if end_ms - start_ms < 100:
+        return None, start_ms, total_ms
+    return _encode_segment(audio[start_ms:end_ms]), end_ms, total_ms
+
+
+def cut_pcm_segment(
+    pcm: bytes,
+    final: bool,
+    min_segment_ms: int = 2000,
+    max_segment_ms: int = 12000,
+    min_silence_ms: int = 400,
+) -> Tuple[Optional[bytes], int]:
+    """
+    The same cut on raw PCM (PCM_SAMPLE_WIDTH, mono, TARGET_SAMPLE_RATE)
+    that starts at the previous cut, so a pass only looks at audio that has
+    not been transcribed yet. With final=True all of it is taken.
+
+    Returns (FLAC bytes, ms consumed), or (None, 0) when there is no segment
+    to cut yet. Runs in the transcription process pool.
+    """
+    pcm = pcm[:len(pcm) - len(pcm) % PCM_SAMPLE_WIDTH]
+    audio = AudioSegment(data=pcm, sample_width=PCM_SAMPLE_WIDTH, frame_rate=TARGET_SAMPLE_RATE, channels=1)
+    end_ms = len(audio) if final else _cut_point(audio, min_segment_ms, max_segment_ms, min_silence_ms)
+    if end_ms is None or end_ms < 100:
+        return None, 0
+    return _encode_segment(audio[:end_ms]), end_ms
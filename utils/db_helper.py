@@ -1,6 +1,8 @@
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from db import in_unit_of_work
+
 async def execute_query(
     session: AsyncSession,
     query: str,
@@ -18,7 +20,10 @@ async def execute_query(
 
     Returns:
         - dict | list[dict] for SELECT
-        - None for INSERT/UPDATE/DELETE
+        - the number of affected rows for INSERT/UPDATE/DELETE
+
+    Writes are committed immediately unless the session belongs to a
+    db.unit_of_work(), which commits once at the end.
     """
     result = await session.execute(text(query), params or {})
 
@@ -26,5 +31,6 @@ async def execute_query(
         rows = result.mappings()
         return rows.first() if fetch_one else rows.all()
     else:
-        await session.commit() 
-        return None
+        if not in_unit_of_work(session):
+            await session.commit() 
+        return result.rowcount
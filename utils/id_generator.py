@@ -0,0 +1,59 @@
+# utils/id_generator.py
+
+import os
+import re
+import time
+import uuid
+import threading
+from typing import Optional
+
+# Ids for our own tables (Threads, Notifications, Messages, WebhookJobs) are
+# generated locally as UUIDv7: 48 bits of Unix milliseconds, then a counter
+# and random bits. They sort by creation time, so inserts land at the right
+# edge of the primary key index instead of at random pages, and they are
+# plain 36-character UUID strings that fit the existing columns.
+
+_lock = threading.Lock()
+_last_ms = 0
+_counter = 0
+
+# Ids created before the switch: random UUID4s and OpenAI Assistants thread
+# ids ("thread_..."). They stay valid everywhere; they just carry no time.
+_UUID_RE = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$", re.IGNORECASE)
+_LEGACY_THREAD_RE = re.compile(r"^thread_[A-Za-z0-9]+$")
+
+
+def new_id() -> str:
+    """
+    Returns a new UUIDv7 string. Ids from this process are strictly
+    increasing, even within the same millisecond (a 12-bit counter is
+    used before random bits take over).
+    """
+    global _last_ms, _counter
+    with _lock:
+        now_ms = time.time_ns() // 1_000_000
+        if now_ms > _last_ms:
+            _last_ms = now_ms
+            _counter = int.from_bytes(os.urandom(2), "big") & 0x7FF  # leave room to count up
+        else:
+            _counter += 1
+            if _counter > 0xFFF:
+                # Counter exhausted (or the clock went backwards): borrow the next millisecond.
+                _last_ms += 1
+                _counter = 0
+        ms, counter = _last_ms, _counter
+
+    rand_b = int.from_bytes(os.urandom(8), "big") & ((1 << 62) - 1)
+    value = (ms & ((1 << 48) - 1)) << 80
+    value |= 0x7 << 76
+    value |= counter << 64
+    value |= 0b10 << 62
+    value |= rand_b
+    return str(uuid.UUID(int=value))
+
+
+def is_valid_id(value: Optional[str]) -> bool:
+    """Accepts UUIDv7 ids as well as the UUID4 and "thread_..." ids already in the database."""
+    if not value or not isinstance(value, str):
+        return False
+    return bool(_UUID_RE.match(value) or _LEGACY_THREAD_RE.match(value))
@@ -0,0 +1,48 @@
+# utils/lanes.py
+
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Hashable, List
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedLock:
+    """
+    One asyncio.Lock per key: callers with the same key run one at a time,
+    callers with different keys never wait for each other. A key's lock is
+    dropped as soon as nobody holds or waits for it, so memory tracks the
+    number of active keys rather than every key ever seen.
+    """
+
+    def __init__(self, name: str = "keyed_lock"):
+        self.name = name
+        self._locks: Dict[Hashable, List[Any]] = {}  # key -> [lock, users]
+        self.acquisitions = 0
+        self.contended = 0
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.contended += 1
+            async with entry[0]:
+                self.acquisitions += 1
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._locks.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "active_keys": len(self._locks),
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+        }
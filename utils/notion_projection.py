@@ -0,0 +1,176 @@
+# utils/notion_projection.py
+
+import os
+import json
+import random
+import logging
+from typing import Any, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# The task properties the agents actually read. 'Created by' is kept because the
+# response agent reports it as "Assigned by".
+TASK_PROPERTIES = ("Status", "Due Date", "Priority", "Assignee", "Created by")
+
+
+def plain_text(rich_text: Optional[Iterable[Dict[str, Any]]]) -> str:
+    """Concatenates the plain_text of a rich text array, dropping annotations and links."""
+    return "".join(part.get("plain_text", "") for part in rich_text or [])
+
+
+def property_value(prop: Optional[Dict[str, Any]]) -> Any:
+    """
+    Reduces a Notion property value object to the bare value it holds, e.g.
+    {"type": "select", "select": {"name": "High", "color": "red", ...}} -> "High".
+    """
+    if not prop:
+        return None
+    kind = prop.get("type")
+    value = prop.get(kind)
+    if kind in ("title", "rich_text"):
+        return plain_text(value)
+    if kind in ("status", "select"):
+        return value.get("name") if value else None
+    if kind == "multi_select":
+        return [option.get("name") for option in value or []]
+    if kind in ("people", "created_by", "last_edited_by"):
+        people = value if isinstance(value, list) else [value] if value else []
+        return [person.get("name") or person.get("id") for person in people]
+    if kind == "date":
+        if not value:
+            return None
+        return {"start": value.get("start"), "end": value["end"]} if value.get("end") else value.get("start")
+    if kind == "relation":
+        return [related.get("id") for related in value or []]
+    if kind in ("formula", "rollup"):
+        return value.get(value.get("type")) if value else None
+    if kind == "files":
+        return [f.get("name") for f in value or []]
+    # number, checkbox, url, email, phone_number, created_time, last_edited_time, ...
+    return value
+
+
+def project_task(page: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Flattens a task page from databases.query into
+    {"id", "url", "Task", "Status", "Due Date", "Priority", "Assignee", "Created by"}.
+    The title is exposed as "Task" whatever the title property is called.
+    """
+    properties = page.get("properties") or {}
+    task: Dict[str, Any] = {"id": page.get("id"), "url": page.get("url")}
+    task["Task"] = next(
+        (plain_text(prop.get("title")) for prop in properties.values() if prop.get("type") == "title"),
+        "",
+    )
+    for name in TASK_PROPERTIES:
+        if name in properties:
+            task[name] = property_value(properties[name])
+    return task
+
+
+def _user_ref(user: Optional[Dict[str, Any]]) -> Optional[str]:
+    """Partial user objects only carry an id; full ones also have a name."""
+    if not user:
+        return None
+    return user.get("name") or user.get("id")
+
+
+def project_page(page: Dict[str, Any]) -> Dict[str, Any]:
+    """A page reduced to its id, url, editor and flattened property values."""
+    projected: Dict[str, Any] = {
+        "id": page.get("id"),
+        "url": page.get("url"),
+        "last_edited_by": _user_ref(page.get("last_edited_by")),
+        "last_edited_time": page.get("last_edited_time"),
+        "properties": {name: property_value(prop) for name, prop in (page.get("properties") or {}).items()},
+    }
+    if page.get("archived") or page.get("in_trash"):
+        projected["archived"] = True
+    return projected
+
+
+def project_block(block: Dict[str, Any]) -> Dict[str, Any]:
+    """A content block reduced to its type and plain text (plus the checkbox for to-dos)."""
+    kind = block.get("type")
+    body = block.get(kind) or {}
+    projected: Dict[str, Any] = {"id": block.get("id"), "type": kind}
+    if "rich_text" in body:
+        projected["text"] = plain_text(body.get("rich_text"))
+    elif kind == "child_page":
+        projected["text"] = body.get("title", "")
+    if kind == "to_do":
+        projected["checked"] = bool(body.get("checked"))
+    if block.get("has_children"):
+        projected["has_children"] = True
+    return projected
+
+
+def project_comment(comment: Dict[str, Any]) -> Dict[str, Any]:
+    """A comment reduced to its author, timestamp and plain text."""
+    return {
+        "id": comment.get("id"),
+        "created_by": _user_ref(comment.get("created_by")),
+        "created_time": comment.get("created_time"),
+        "text": plain_text(comment.get("rich_text")),
+    }
+
+
+def project_user(user: Dict[str, Any]) -> Dict[str, Any]:
+    """A user reduced to id, name, type and (for people) email."""
+    projected = {"id": user.get("id"), "name": user.get("name"), "type": user.get("type")}
+    email = (user.get("person") or {}).get("email")
+    if email:
+        projected["email"] = email
+    return projected
+
+
+def project_list(response: Dict[str, Any], project: Callable[[Dict[str, Any]], Any]) -> Dict[str, Any]:
+    """Projects every item of a Notion list response, keeping the cursor only when there is more."""
+    projected: Dict[str, Any] = {"results": [project(item) for item in response.get("results", [])]}
+    if response.get("has_more"):
+        projected["has_more"] = True
+        projected["next_cursor"] = response.get("next_cursor")
+    return projected
+
+
+# --- Serialisation for tool output ---
+
+# Running totals per tool of the characters we would have sent as pretty-printed
+# raw JSON versus what was actually sent. Tokens are estimated at ~4 chars each.
+_projection_stats: Dict[str, Dict[str, int]] = {}
+# Measuring means serialising the whole raw payload, so only a sample of calls
+# pays for it (all of them when debug logging is on).
+NOTION_PROJECTION_SAMPLE_RATE = float(os.getenv("NOTION_PROJECTION_SAMPLE_RATE", "0"))
+
+
+def projection_sampled() -> bool:
+    """Whether this tool call should measure its savings against the raw payload."""
+    return logger.isEnabledFor(logging.DEBUG) or random.random() < NOTION_PROJECTION_SAMPLE_RATE
+
+
+def to_tool_json(tool_name: str, payload: Any, raw: Any = None, sampled: Optional[bool] = None) -> str:
+    """
+    Serialises a tool result as compact JSON for the LLM.
+
+    When the raw Notion object is passed as well and the call is sampled, the
+    size difference against the old json.dumps(raw, indent=2) output is
+    recorded for `tool_name`. Callers that decided up front (to keep raw rows
+    only when needed) pass sampled=True.
+    """
+    text = json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+    if raw is not None and (sampled if sampled is not None else projection_sampled()):
+        baseline = len(json.dumps(raw, indent=2))
+        stats = _projection_stats.setdefault(tool_name, {"calls": 0, "raw_chars": 0, "sent_chars": 0})
+        stats["calls"] += 1
+        stats["raw_chars"] += baseline
+        stats["sent_chars"] += len(text)
+        logger.debug(f"{tool_name}: sent {len(text)} chars instead of {baseline} (~{(baseline - len(text)) // 4} tokens saved)")
+    return text
+
+
+def get_projection_stats() -> Dict[str, Dict[str, int]]:
+    """Per-tool call counts, character totals and estimated tokens saved."""
+    return {
+        tool: {**stats, "tokens_saved": (stats["raw_chars"] - stats["sent_chars"]) // 4}
+        for tool, stats in _projection_stats.items()
+    }
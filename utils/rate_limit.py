@@ -0,0 +1,74 @@
+# utils/rate_limit.py
+
+import time
+import asyncio
+from typing import Any, Dict
+
+
+class TokenBucket:
+    """
+    Async token bucket: `rate` tokens per second, holding at most `burst`.
+    acquire() waits until a token is available, and waiters are served in
+    arrival order so a steady stream of callers cannot starve an earlier one.
+    try_acquire() never waits, for callers that would rather come back later.
+    Not thread-safe; it is meant to be used from the event loop. State is
+    per process: every instance has its own bucket.
+    """
+
+    def __init__(self, rate: float, burst: float, name: str = "bucket"):
+        self.rate = rate
+        self.burst = burst
+        self.name = name
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.acquired = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, tokens: float = 1.0) -> float:
+        """Seconds until `tokens` are available (0.0 if they are now); takes nothing."""
+        self._refill()
+        if self._lock.locked():
+            # Someone is already waiting in acquire(); don't jump the queue.
+            return tokens / self.rate
+        return max(0.0, tokens - self._tokens) / self.rate
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        """Takes `tokens` if they are available right now."""
+        if self.wait_time(tokens) > 0:
+            return False
+        self._tokens -= tokens
+        self.acquired += 1
+        return True
+
+    async def acquire(self, tokens: float = 1.0) -> float:
+        """Takes `tokens`, waiting as long as needed. Returns the seconds waited."""
+        started = time.monotonic()
+        async with self._lock:
+            self._refill()
+            if self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
+        waited = time.monotonic() - started
+        self.acquired += 1
+        if waited > 0.001:
+            self.waited += 1
+            self.wait_seconds += waited
+        return waited
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "rate": self.rate,
+            "burst": self.burst,
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
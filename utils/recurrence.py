@@ -0,0 +1,226 @@
+# utils/recurrence.py
+
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Optional, Tuple, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# A subset of RFC 5545 RRULE, enough for "every Monday at 9", "every 2 weeks
+# on Tue and Thu", "daily" or "monthly on the 1st":
+#   FREQ=DAILY|WEEKLY|MONTHLY, INTERVAL=n, BYDAY=MO,TU,..., BYMONTHDAY=1,15,-1,
+#   BYHOUR=h, BYMINUTE=m, UNTIL=YYYYMMDD[THHMMSS]
+# Occurrences are computed in the user's local wall time, so "9:00" stays
+# 9:00 across DST changes, and stored as naive UTC like Notifications.created_at.
+
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+FREQUENCIES = ("DAILY", "WEEKLY", "MONTHLY")
+# Longest run of non-matching days we search (e.g. BYMONTHDAY=31 with INTERVAL=12).
+_MAX_SEARCH_DAYS = 366 * 12
+
+
+class RecurrenceError(ValueError):
+    """The rule is malformed or uses a part this module does not support."""
+
+
+@dataclass(frozen=True)
+class Recurrence:
+    freq: str
+    interval: int = 1
+    by_day: Tuple[int, ...] = ()          # weekday numbers, Monday = 0
+    by_month_day: Tuple[int, ...] = ()    # 1..31, or -1 for the last day
+    by_hour: Optional[int] = None
+    by_minute: Optional[int] = None
+    until: Optional[datetime] = None      # local wall time
+
+    def __str__(self) -> str:
+        parts = [f"FREQ={self.freq}"]
+        if self.interval != 1:
+            parts.append(f"INTERVAL={self.interval}")
+        if self.by_day:
+            parts.append("BYDAY=" + ",".join(WEEKDAYS[d] for d in self.by_day))
+        if self.by_month_day:
+            parts.append("BYMONTHDAY=" + ",".join(str(d) for d in self.by_month_day))
+        if self.by_hour is not None:
+            parts.append(f"BYHOUR={self.by_hour}")
+        if self.by_minute is not None:
+            parts.append(f"BYMINUTE={self.by_minute}")
+        if self.until is not None:
+            parts.append(f"UNTIL={self.until:%Y%m%dT%H%M%S}")
+        return ";".join(parts)
+
+
+def _int(name: str, value: str, low: int, high: int) -> int:
+    try:
+        number = int(value)
+    except ValueError:
+        raise RecurrenceError(f"{name} must be a number, got '{value}'.")
+    if not low <= number <= high:
+        raise RecurrenceError(f"{name} must be between {low} and {high}, got {number}.")
+    return number
+
+
+def _until(value: str) -> datetime:
+    value = value.rstrip("Z")
+    for fmt in ("%Y%m%dT%H%M%S", "%Y%m%d", "%Y-%m-%d"):
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        # A bare date means "through the end of that day".
+        return parsed if "T" in value else parsed.replace(hour=23, minute=59, second=59)
+    raise RecurrenceError(f"UNTIL must look like YYYYMMDD or YYYYMMDDTHHMMSS, got '{value}'.")
+
+
+def parse_rule(rule: Union[str, Recurrence]) -> Recurrence:
+    """Parses an RRULE string (with or without the 'RRULE:' prefix)."""
+    if isinstance(rule, Recurrence):
+        return rule
+    text = (rule or "").strip()
+    if text.upper().startswith("RRULE:"):
+        text = text[len("RRULE:"):]
+    if not text:
+        raise RecurrenceError("The recurrence rule is empty.")
+
+    fields = {}
+    for part in text.split(";"):
+        if not part.strip():
+            continue
+        key, sep, value = part.partition("=")
+        if not sep:
+            raise RecurrenceError(f"Expected KEY=VALUE in the recurrence rule, got '{part}'.")
+        fields[key.strip().upper()] = value.strip().upper()
+
+    freq = fields.pop("FREQ", None)
+    if freq not in FREQUENCIES:
+        raise RecurrenceError(f"FREQ must be one of {', '.join(FREQUENCIES)}.")
+    kwargs = {"freq": freq}
+    if "INTERVAL" in fields:
+        kwargs["interval"] = _int("INTERVAL", fields.pop("INTERVAL"), 1, 366)
+    if "BYDAY" in fields:
+        days = []
+        for day in fields.pop("BYDAY").split(","):
+            if day not in WEEKDAYS:
+                # Ordinals such as 1MO ("first Monday") are not supported.
+                raise RecurrenceError(f"BYDAY values must be MO..SU, got '{day}'.")
+            days.append(WEEKDAYS.index(day))
+        kwargs["by_day"] = tuple(sorted(set(days)))
+    if "BYMONTHDAY" in fields:
+        month_days = []
+        for day in fields.pop("BYMONTHDAY").split(","):
+            number = _int("BYMONTHDAY", day, -1, 31)
+            if number == 0:
+                raise RecurrenceError("BYMONTHDAY cannot be 0.")
+            month_days.append(number)
+        kwargs["by_month_day"] = tuple(sorted(set(month_days)))
+    if "BYHOUR" in fields:
+        kwargs["by_hour"] = _int("BYHOUR", fields.pop("BYHOUR"), 0, 23)
+    if "BYMINUTE" in fields:
+        kwargs["by_minute"] = _int("BYMINUTE", fields.pop("BYMINUTE"), 0, 59)
+    if "UNTIL" in fields:
+        kwargs["until"] = _until(fields.pop("UNTIL"))
+    if fields:
+        raise RecurrenceError(f"Unsupported recurrence rule part(s): {', '.join(sorted(fields))}.")
+    return Recurrence(**kwargs)
+
+
+def _months_between(start: date, day: date) -> int:
+    return (day.year - start.year) * 12 + day.month - start.month
+
+
+def _last_day_of_month(day: date) -> int:
+    next_month = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return (next_month - timedelta(days=1)).day
+
+
+def _matches(recurrence: Recurrence, anchor: date, day: date) -> bool:
+    if recurrence.freq == "DAILY":
+        if (day - anchor).days % recurrence.interval:
+            return False
+        return not recurrence.by_day or day.weekday() in recurrence.by_day
+    if recurrence.freq == "WEEKLY":
+        anchor_week = anchor - timedelta(days=anchor.weekday())
+        if ((day - anchor_week).days // 7) % recurrence.interval:
+            return False
+        return day.weekday() in (recurrence.by_day or (anchor.weekday(),))
+    # MONTHLY
+    if _months_between(anchor, day) % recurrence.interval:
+        return False
+    if recurrence.by_day and not recurrence.by_month_day:
+        return day.weekday() in recurrence.by_day
+    month_days = recurrence.by_month_day or (anchor.day,)
+    last = _last_day_of_month(day)
+    if day.day not in month_days and not (day.day == last and -1 in month_days):
+        return False
+    return not recurrence.by_day or day.weekday() in recurrence.by_day
+
+
+def next_occurrence(
+    rule: Union[str, Recurrence],
+    anchor: datetime,
+    after: Optional[datetime] = None,
+    inclusive: bool = False,
+) -> Optional[datetime]:
+    """
+    The first occurrence after `after` (default: the anchor itself), in local
+    wall time, or None once UNTIL has passed.
+
+    `anchor` is a previous (or the intended first) occurrence. It sets the
+    phase of INTERVAL and the defaults for the weekday, day of month and
+    time of day, so chaining next_occurrence from each occurrence to the
+    next follows the same series. With inclusive=True, `after` itself
+    counts if it matches.
+    """
+    recurrence = parse_rule(rule)
+    anchor = anchor.replace(tzinfo=None, second=0, microsecond=0)
+    after = (after or anchor).replace(tzinfo=None)
+    at = time(
+        anchor.hour if recurrence.by_hour is None else recurrence.by_hour,
+        anchor.minute if recurrence.by_minute is None else recurrence.by_minute,
+    )
+    day = min(anchor.date(), after.date()) if inclusive else after.date()
+    day = max(day, anchor.date())
+    for _ in range(_MAX_SEARCH_DAYS):
+        candidate = datetime.combine(day, at)
+        if recurrence.until is not None and candidate > recurrence.until:
+            return None
+        if (candidate >= after if inclusive else candidate > after) and _matches(recurrence, anchor.date(), day):
+            return candidate
+        day += timedelta(days=1)
+    return None
+
+
+def _zone(timezone_name: Optional[str]) -> ZoneInfo:
+    try:
+        return ZoneInfo(timezone_name or "UTC")
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo("UTC")
+
+
+def local_to_utc(local: datetime, timezone_name: Optional[str]) -> datetime:
+    return local.replace(tzinfo=_zone(timezone_name)).astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def utc_to_local(utc: datetime, timezone_name: Optional[str]) -> datetime:
+    return utc.replace(tzinfo=timezone.utc).astimezone(_zone(timezone_name)).replace(tzinfo=None)
+
+
+def first_run_utc(rule: Union[str, Recurrence], start_local: datetime, timezone_name: Optional[str]) -> Optional[datetime]:
+    """
+    The first occurrence at or after `start_local` (the requested date and
+    time) that is still in the future, as naive UTC.
+    """
+    now_local = utc_to_local(datetime.now(timezone.utc).replace(tzinfo=None), timezone_name)
+    first = next_occurrence(rule, start_local, after=max(start_local, now_local), inclusive=start_local >= now_local)
+    return local_to_utc(first, timezone_name) if first else None
+
+
+def next_run_utc(rule: Union[str, Recurrence], previous_utc: datetime, timezone_name: Optional[str]) -> Optional[datetime]:
+    """
+    The occurrence following `previous_utc` that is still in the future, as
+    naive UTC. Occurrences missed while nothing was running are skipped
+    rather than replayed one after another.
+    """
+    previous_local = utc_to_local(previous_utc, timezone_name)
+    now_local = utc_to_local(datetime.now(timezone.utc).replace(tzinfo=None), timezone_name)
+    following = next_occurrence(rule, previous_local, after=max(previous_local, now_local))
+    return local_to_utc(following, timezone_name) if following else None
@@ -1,14 +1,70 @@
 # utils/whatsapp_utils.py
 
 import os
+import re
 import httpx
 import logging
-import asyncio
+from typing import List, Optional
+
+from services.whatsapp_client import whatsapp_client
 
 logger = logging.getLogger(__name__)
-WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
 WHATSAPP_PHONE_NUMBER_ID = os.getenv("WHATSAPP_PHONE_NUMBER_ID")
 
+# WhatsApp caps a text body at 4096 characters; leave room for the "(i/n) " prefix.
+WHATSAPP_TEXT_LIMIT = 4070
+
+
+def split_message(message: str, limit: int = WHATSAPP_TEXT_LIMIT) -> List[str]:
+    """
+    Splits a message into parts of at most `limit` characters, breaking at
+    paragraph, then line, then sentence, then word boundaries, so a task
+    list never splits in the middle of an item. Parts are numbered
+    "(i/n) " when there is more than one.
+    """
+    if len(message) <= limit:
+        return [message]
+
+    budget = limit - 15  # room for the "(i/n) " prefix
+    parts: List[str] = []
+    rest = message
+    while len(rest) > budget:
+        window = rest[:budget + 1]
+        cut = -1
+        for pattern in (r"\n\s*\n", r"\n", r"[.!?]\s", r"\s"):
+            matches = [m.end() for m in re.finditer(pattern, window)]
+            # Breaks in the first half would leave tiny parts; look further down the list.
+            matches = [end for end in matches if end > budget // 2]
+            if matches:
+                cut = matches[-1]
+                break
+        if cut <= 0:
+            cut = budget
+        parts.append(rest[:cut].rstrip())
+        rest = rest[cut:].lstrip("\n")
+    if rest.strip():
+        parts.append(rest)
+
+    total = len(parts)
+    return [f"({i}/{total}) {part}" for i, part in enumerate(parts, start=1)]
+
+
+async def send_whatsapp_text(to_number: str, body: str) -> Optional[str]:
+    """
+    Sends one text message (at most 4096 characters) and returns its WhatsApp
+    message id, which the `statuses` webhook events refer to. Raises
+    httpx.HTTPStatusError if Graph rejects it after retries.
+    """
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": to_number,
+        "type": "text",
+        "text": {"body": body},
+    }
+    response = await whatsapp_client.request("send_message", "POST", f"{WHATSAPP_PHONE_NUMBER_ID}/messages", json=payload)
+    messages = response.json().get("messages") or [{}]
+    return messages[0].get("id")
+
 # --- ADD THIS NEW FUNCTION ---
 async def get_whatsapp_media_bytes(media_id: str) -> bytes | None:
     """
@@ -21,18 +77,13 @@ async def get_whatsapp_media_bytes(media_id: str) -> bytes | None:
         The raw bytes of the media file, or None if an error occurs.
     """
     # Step 1: Get the media URL from the media ID
-    url_step1 = f"https://graph.facebook.com/v18.0/{media_id}"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
-    
     media_url = ""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url_step1, headers=headers)
-            response.raise_for_status()
-            media_url = response.json().get("url")
-            if not media_url:
-                logger.error(f"Could not retrieve media URL for media_id: {media_id}")
-                return None
+        response = await whatsapp_client.request("media_lookup", "GET", media_id)
+        media_url = response.json().get("url")
+        if not media_url:
+            logger.error(f"Could not retrieve media URL for media_id: {media_id}")
+            return None
     except httpx.HTTPStatusError as e:
         logger.error(f"HTTP error getting media URL: {e.response.text}")
         return None
@@ -40,12 +91,10 @@ async def get_whatsapp_media_bytes(media_id: str) -> bytes | None:
         logger.error(f"Unexpected error getting media URL: {e}")
         return None
 
-    # Step 2: Download the actual media file from the URL
+    # Step 2: Download the actual media file from the URL (same pooled client)
     try:
-        async with httpx.AsyncClient() as client:
-            download_response = await client.get(media_url, headers=headers)
-            download_response.raise_for_status()
-            return download_response.content
+        download_response = await whatsapp_client.request("media_download", "GET", media_url)
+        return download_response.content
     except httpx.HTTPStatusError as e:
         logger.error(f"HTTP error downloading media file: {e.response.text}")
         return None
@@ -53,67 +102,26 @@ async def get_whatsapp_media_bytes(media_id: str) -> bytes | None:
         logger.error(f"Unexpected error downloading media file: {e}")
         return None
 
-# --- YOUR EXISTING send_whatsapp_message FUNCTION REMAINS UNCHANGED ---
 async def send_whatsapp_message(to_number: str, message: str):
     """
-    Sends a message to a WhatsApp number. If the message exceeds the
-    4096 character limit, it is automatically split into multiple,
-    numbered messages.
+    Sends a message to a WhatsApp number right away, split into numbered
+    parts (see split_message) if it exceeds the 4096 character limit.
+
+    Callers that don't need to wait for delivery should use
+    services.outbound_dispatcher.dispatch_whatsapp_message, which queues
+    the parts and rate-limits them.
     """
-    # (Your existing code for this function is perfect, no changes needed)
-    url = f"https://graph.facebook.com/v18.0/{WHATSAPP_PHONE_NUMBER_ID}/messages"
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json",
-    }
+    parts = split_message(message)
+    if len(parts) > 1:
+        logger.info(f"Message is too long ({len(message)} chars). Splitting into {len(parts)} parts.")
 
-    if len(message) <= 4070:
-        payload = {
-            "messaging_product": "whatsapp",
-            "to": to_number,
-            "type": "text",
-            "text": {"body": message},
-        }
+    for part_number, part in enumerate(parts, start=1):
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(url, headers=headers, json=payload)
-                response.raise_for_status()
-                logger.info(f"WhatsApp API response (single message): {response.json()}")
+            message_id = await send_whatsapp_text(to_number, part)
+            logger.info(f"Sent part {part_number}/{len(parts)} to {to_number} ({message_id})")
         except httpx.HTTPStatusError as e:
-            logger.error(f"HTTP error sending single message: {e.response.text}")
+            logger.error(f"HTTP error sending part {part_number}/{len(parts)}: {e.response.text}")
+            break
         except Exception as e:
-            logger.error(f"Unexpected error sending single message: {e}")
-        return
-
-    logger.info(f"Message is too long ({len(message)} chars). Splitting into multiple parts.")
-    
-    chunk_size = 4070 - 15
-    parts = [message[i:i + chunk_size] for i in range(0, len(message), chunk_size)]
-    total_parts = len(parts)
-
-    async with httpx.AsyncClient() as client:
-        for i, part in enumerate(parts):
-            part_number = i + 1
-            part_message = f"({part_number}/{total_parts}) {part}"
-            
-            payload = {
-                "messaging_product": "whatsapp",
-                "to": to_number,
-                "type": "text",
-                "text": {"body": part_message},
-            }
-            
-            try:
-                response = await client.post(url, headers=headers, json=payload)
-                response.raise_for_status()
-                logger.info(f"Sent part {part_number}/{total_parts} to {to_number}")
-                
-                if part_number < total_parts:
-                    await asyncio.sleep(0.75)
-                    
-            except httpx.HTTPStatusError as e:
-                logger.error(f"HTTP error sending part {part_number}/{total_parts}: {e.response.text}")
-                break 
-            except Exception as e:
-                logger.error(f"Unexpected error sending part {part_number}/{total_parts}: {e}")
-                break
\ No newline at end of file
+            logger.error(f"Unexpected error sending part {part_number}/{len(parts)}: {e}")
+            break